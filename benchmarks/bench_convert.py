@@ -0,0 +1,69 @@
+"""
+Compare the compiled row converters used by load() with the per-cell
+validate()/convert() path on a synthetic stop_times.txt.
+
+    python -m benchmarks.bench_convert [stop_times]
+"""
+
+import csv
+import sys
+import tempfile
+import time
+
+import gtfs_loader
+from gtfs_loader import schema
+from benchmarks import synthetic
+
+
+def per_cell_parse_rows(gtfs, file_schema, fields, header_row, reader):
+    for lineno, row in enumerate(reader, 2):
+        if len(row) == 0:
+            continue
+
+        entity = file_schema.class_def()
+        entity._gtfs = gtfs
+
+        for name, value in zip(header_row, row):
+            config = fields[name]
+            if config.required and not value:
+                raise gtfs_loader.ParseError(
+                    f'{file_schema.filename}:{lineno}: required field {name} is empty')
+
+            entity[name] = gtfs_loader.validate(
+                config, value,
+                context_fn=lambda: f'{file_schema.filename}:{lineno} field {name} = {repr(value)}')
+
+        yield entity
+
+
+def read_rows(filepath):
+    with open(filepath, encoding='utf-8') as f:
+        rows = list(csv.reader(f, skipinitialspace=True))
+    return rows[0], rows[1:]
+
+
+def time_parse(parse_fn, file_schema, header_row, rows):
+    fields = gtfs_loader.merge_header_and_declared_fields(file_schema, header_row)
+    start = time.perf_counter()
+    count = sum(1 for _ in parse_fn(None, file_schema, fields, header_row, iter(rows)))
+    return count, time.perf_counter() - start
+
+
+def main(stop_times=500_000):
+    file_schema = schema.GTFS_SUBSET_SCHEMA['stop_times.txt']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gtfs_dir = synthetic.write_feed(tmp_dir, stop_times=stop_times)
+        header_row, rows = read_rows(gtfs_dir / 'stop_times.txt')
+
+        count, per_cell = time_parse(per_cell_parse_rows, file_schema, header_row, rows)
+        _, compiled = time_parse(gtfs_loader.parse_rows, file_schema, header_row, rows)
+
+    print(f'{count} stop_times rows')
+    print(f'per-cell validate(): {per_cell:.2f}s ({count / per_cell:,.0f} rows/s)')
+    print(f'compiled converters: {compiled:.2f}s ({count / compiled:,.0f} rows/s)')
+    print(f'speedup: {per_cell / compiled:.2f}x')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
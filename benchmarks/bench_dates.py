@@ -0,0 +1,69 @@
+"""
+Compare parsing and formatting of GTFSDate with the original strptime() and
+strftime() implementation, and time loading a synthetic calendar_dates.txt.
+
+    python -m benchmarks.bench_dates [calendar_dates]
+"""
+
+import csv
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import gtfs_loader
+from gtfs_loader import types
+from benchmarks import synthetic
+
+
+def reference_parse(date_str):
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%d')
+    except ValueError:
+        return datetime.strptime(date_str, '%Y%m%d')
+
+
+def reference_format(value):
+    return value.strftime('%Y%m%d')
+
+
+def read_dates(filepath):
+    with open(filepath, encoding='utf-8') as f:
+        reader = csv.reader(f)
+        column = next(reader).index('date')
+        return [row[column] for row in reader]
+
+
+def timed(fn, values):
+    start = time.perf_counter()
+    results = list(map(fn, values))
+    return results, time.perf_counter() - start
+
+
+def main(calendar_dates=1_000_000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gtfs_dir = synthetic.write_feed(tmp_dir, stop_times=0, calendar_dates=calendar_dates)
+        date_strs = read_dates(gtfs_dir / 'calendar_dates.txt')
+
+        start = time.perf_counter()
+        gtfs_loader.load(gtfs_dir, files=['calendar_dates'], verbose=False)
+        load_time = time.perf_counter() - start
+
+    expected, reference_parse_time = timed(reference_parse, date_strs)
+    dates, parse_time = timed(types.parse_date, date_strs)
+    assert dates == expected
+
+    expected, reference_format_time = timed(reference_format, expected)
+    formatted, format_time = timed(types.value_serializer(), dates)
+    assert formatted == expected == date_strs
+
+    print(f'{len(date_strs)} dates, {len(set(date_strs))} distinct')
+    print(f'parse: {reference_parse_time:.2f}s strptime(), {parse_time:.2f}s parse_date() '
+          f'({reference_parse_time / parse_time:.1f}x)')
+    print(f'format: {reference_format_time:.2f}s strftime(), {format_time:.2f}s value_serializer() '
+          f'({reference_format_time / format_time:.1f}x)')
+    print(f'load calendar_dates: {load_time:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,52 @@
+"""
+Compare memory use and construction time of regular entities with the slotted
+classes generated by Entity._compact_class(), on synthetic stop_times rows.
+
+    python -m benchmarks.bench_entities [rows]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from gtfs_loader import schema, types
+
+HEADER = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'pickup_type', 'drop_off_type']
+
+
+def make_rows(count):
+    rows = []
+    for i in range(count):
+        time_value = types.GTFSTime(6 * 3600 + i % 60000)
+        rows.append([f't{i // 20}', time_value, time_value, f's{i % 5000}', i % 20,
+                     schema.PickupType.REGULARLY_SCHEDULED, schema.DropOffType.REGULARLY_SCHEDULED])
+    return rows
+
+
+def measure(entity_def, rows):
+    create_entity = entity_def._row_factory(HEADER)
+
+    start = time.perf_counter()
+    entities = [create_entity(None, values) for values in rows]
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    entities = [create_entity(None, values) for values in rows]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del entities
+    return elapsed, memory
+
+
+def main(count=500_000):
+    rows = make_rows(count)
+
+    for label, entity_def in (('regular', schema.StopTime), ('slotted', schema.StopTime._compact_class())):
+        elapsed, memory = measure(entity_def, rows)
+        print(f'{label}: {elapsed:.2f}s to create {count} entities, '
+              f'{memory / count:.0f} bytes per entity')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
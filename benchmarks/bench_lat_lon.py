@@ -0,0 +1,51 @@
+"""
+Compare the LatLon methods with their array versions in lat_lon_batch, on
+random point pairs around a city.
+
+    python -m benchmarks.bench_lat_lon [pairs]
+"""
+
+import random
+import sys
+import time
+
+import numpy as np
+
+from gtfs_loader import lat_lon_batch
+from gtfs_loader.lat_lon import LatLon
+
+
+def random_points(count, rng):
+    return [LatLon(45.5 + rng.uniform(-0.5, 0.5), -73.6 + rng.uniform(-0.5, 0.5)) for _ in range(count)]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main(count=1_000_000):
+    rng = random.Random(0)
+    xs, l1s, l2s = (random_points(count, rng) for _ in range(3))
+    x, l1, l2 = (lat_lon_batch.from_lat_lons(points) for points in (xs, l1s, l2s))
+
+    cases = (
+        ('distance', lambda: [a.distance_to(b) for a, b in zip(xs, l1s)],
+         lambda: lat_lon_batch.distance(*x, *l1)),
+        ('bearing', lambda: [a.bearing_to(b) for a, b in zip(xs, l1s)],
+         lambda: lat_lon_batch.bearing(*x, *l1)),
+        ('distance_to_segment', lambda: [a.distance_to_segment(b, c) for a, b, c in zip(xs, l1s, l2s)],
+         lambda: lat_lon_batch.distance_to_segment(*x, *l1, *l2)),
+    )
+
+    for label, scalar_fn, batch_fn in cases:
+        scalar_time, expected = timed(scalar_fn)
+        batch_time, actual = timed(batch_fn)
+        error = np.max(np.abs(np.asarray(expected) - actual))
+        print(f'{label}: LatLon {scalar_time:.2f}s, lat_lon_batch {batch_time:.3f}s '
+              f'({scalar_time / batch_time:.0f}x) for {count} pairs, max difference {error:.2e}')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
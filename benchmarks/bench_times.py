@@ -0,0 +1,72 @@
+"""
+Compare parsing and formatting of GTFSTime with the original split()/divmod()
+implementation, on the times of a synthetic stop_times.txt.
+
+    python -m benchmarks.bench_times [stop_times]
+"""
+
+import csv
+import sys
+import tempfile
+import time
+
+from gtfs_loader import types
+from benchmarks import synthetic
+
+
+def reference_parse(time_str):
+    if time_str == '':
+        return -1
+
+    h, m, s = time_str.split(':')
+    if int(h) > types.GTFSTime.MAX_HOUR_REPRESENTATION:
+        raise ValueError('Refusing to consider a service day longer than 36 hours')
+
+    return 3600 * int(h) + 60 * int(m) + int(s)
+
+
+def reference_format(value):
+    if value == -1:
+        return ''
+
+    hours, rem = divmod(value, 3600)
+    mins, secs = divmod(rem, 60)
+    return '%02d:%02d:%02d' % (hours, mins, secs)
+
+
+def read_times(filepath):
+    with open(filepath, encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header_row = next(reader)
+        columns = [header_row.index('arrival_time'), header_row.index('departure_time')]
+        return [row[column] for row in reader for column in columns]
+
+
+def timed(fn, values):
+    start = time.perf_counter()
+    results = list(map(fn, values))
+    return results, time.perf_counter() - start
+
+
+def main(stop_times=500_000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        time_strs = read_times(synthetic.write_feed(tmp_dir, stop_times=stop_times) / 'stop_times.txt')
+
+    expected, reference_parse_time = timed(reference_parse, time_strs)
+    times, parse_time = timed(types.parse_time, time_strs)
+    assert times == expected
+
+    expected, reference_format_time = timed(reference_format, expected)
+    formatted, format_time = timed(types.value_serializer(), times)
+    assert formatted == expected == time_strs
+
+    count = len(time_strs)
+    print(f'{count} times, {len(set(time_strs))} distinct')
+    print(f'parse: {reference_parse_time:.2f}s split()/int(), {parse_time:.2f}s parse_time() '
+          f'({reference_parse_time / parse_time:.1f}x)')
+    print(f'format: {reference_format_time:.2f}s divmod(), {format_time:.2f}s value_serializer() '
+          f'({reference_format_time / format_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
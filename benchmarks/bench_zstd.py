@@ -0,0 +1,106 @@
+"""
+Compression throughput and ratio of the zstd settings of patch(compression=...)
+on stop_times and shapes content, and the gain of a dictionary on small files.
+
+    python -m benchmarks.bench_zstd [stop_times]
+"""
+
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import gtfs_loader
+from benchmarks.synthetic import write_feed
+
+LEVELS = (1, 3, 9, 19)
+THREADS = (0, -1)
+
+# Sizes of the small files compressed with and without a dictionary
+SMALL_FILE_SIZES = (1024, 4096, 16384)
+
+
+def shapes_content(points, rng):
+    lines = ['shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled']
+    shape_id, lat, lon, distance = 0, 45.5, -73.6, 0.0
+    for sequence in range(points):
+        if sequence % 500 == 0:
+            shape_id, lat, lon, distance = shape_id + 1, 45.5 + rng.uniform(-0.2, 0.2), -73.6, 0.0
+
+        lat += rng.uniform(-0.0005, 0.0005)
+        lon += rng.uniform(-0.0005, 0.0005)
+        distance += rng.uniform(10, 60)
+        lines.append(f'shape_{shape_id},{lat:.6f},{lon:.6f},{sequence % 500},{distance:.1f}')
+
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def measure(filename, data, compression):
+    compressor = gtfs_loader.zstd_compressor(filename, compression)
+    start = time.perf_counter()
+    compressed = compressor.compress(data)
+    compress_time = time.perf_counter() - start
+
+    decompressor = gtfs_loader.zstd_decompressor(filename, compression)
+    start = time.perf_counter()
+    decompressor.decompressobj().decompress(compressed)
+    decompress_time = time.perf_counter() - start
+
+    return len(compressed), compress_time, decompress_time
+
+
+def matrix(filename, data):
+    megabytes = len(data) / 1e6
+    print(f'{filename}: {megabytes:.1f}MB')
+    for level in LEVELS:
+        for threads in THREADS:
+            for long_distance_matching in (False, True):
+                size, compress_time, decompress_time = measure(filename, data, {
+                    'level': level, 'threads': threads, 'long_distance_matching': long_distance_matching})
+                print(f'  level {level:2d} threads {threads:2d} ldm {long_distance_matching:d}: '
+                      f'ratio {len(data) / size:5.2f}, compression {megabytes / compress_time:6.1f}MB/s, '
+                      f'decompression {megabytes / decompress_time:6.1f}MB/s')
+
+
+def dictionary_gain(filename, data, file_size):
+    header, _, rows = data.partition(b'\n')
+    lines = rows.splitlines(keepends=True)
+    files, current = [], []
+    for line in lines:
+        current.append(line)
+        if sum(map(len, current)) >= file_size:
+            files.append(header + b'\n' + b''.join(current))
+            current = []
+
+    training, testing = files[:len(files) // 2], files[len(files) // 2:]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i, content in enumerate(training):
+            path = Path(tmp_dir) / f'{i}.txt'
+            path.write_bytes(content)
+            paths.append(path)
+
+        dictionary = gtfs_loader.train_zstd_dictionary(paths)
+
+    name = filename.name.split('.', 1)[0]
+    total = sum(map(len, testing))
+    plain = sum(measure(filename, content, None)[0] for content in testing)
+    with_dictionary = sum(measure(filename, content, {'dictionaries': {name: dictionary}})[0] for content in testing)
+    print(f'  {len(testing)} files of {file_size // 1024}KB: ratio {total / plain:.2f} without '
+          f'dictionary, {total / with_dictionary:.2f} with a {len(dictionary) // 1024}KB dictionary')
+
+
+def main(stop_times=500_000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stop_times_data = (write_feed(Path(tmp_dir), stop_times=stop_times) / 'stop_times.txt').read_bytes()
+
+    shapes_data = shapes_content(stop_times, random.Random(0))
+    for filename, data in ((Path('stop_times.txt'), stop_times_data), (Path('shapes.txt'), shapes_data)):
+        matrix(filename, data)
+        for file_size in SMALL_FILE_SIZES:
+            dictionary_gain(filename, data, file_size)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,66 @@
+"""
+Compare two result files of benchmarks.suite, e.g. of a base commit and of a
+change, and exit with status 1 if a case got slower by more than the
+threshold. The fastest of the repeated runs of each case is compared, being
+the least affected by noise; cases shorter than min_seconds are too noisy to
+be reported as regressions.
+
+    python -m benchmarks.compare base.json head.json [--threshold 0.1] [--min-seconds 0.05]
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+def compare(base, head, threshold, min_seconds=0.0):
+    """
+    Return the (case, base seconds, head seconds, ratio) of the cases of both
+    results, and the names of the cases slower by more than threshold.
+    """
+
+    rows = []
+    regressions = []
+    for case, head_result in head['results'].items():
+        base_result = base['results'].get(case)
+        if base_result is None:
+            continue
+
+        ratio = head_result['min'] / base_result['min'] if base_result['min'] else float('inf')
+        rows.append((case, base_result['min'], head_result['min'], ratio))
+        if ratio > 1 + threshold and head_result['min'] >= min_seconds:
+            regressions.append(case)
+
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression (default: 0.1)')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='shortest duration reported as a regression (default: 0.05)')
+    args = parser.parse_args(argv)
+
+    base = json.loads(Path(args.base).read_text())
+    head = json.loads(Path(args.head).read_text())
+    rows, regressions = compare(base, head, args.threshold, args.min_seconds)
+
+    print(f'base {base["environment"].get("commit")}, head {head["environment"].get("commit")}')
+    width = max((len(case) for case, *_ in rows), default=0)
+    for case, base_seconds, head_seconds, ratio in rows:
+        flag = '  REGRESSION' if case in regressions else ''
+        print(f'{case:<{width}}  {base_seconds:9.3f}s  {head_seconds:9.3f}s  {ratio - 1:+7.1%}{flag}')
+
+    missing = base['results'].keys() - head['results'].keys()
+    if missing:
+        print(f'{len(missing)} cases missing from {args.head}: {", ".join(sorted(missing))}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Time load(), patch() and clone() on synthetic feeds of several sizes, in the
+default and itinerary formats, with and without ZSTD compression, and write
+the results as JSON to compare them between commits (see benchmarks.compare).
+
+    python -m benchmarks.suite --sizes 1K,100K,1M --output results.json
+    python -m benchmarks.compare base.json results.json
+
+Sizes are numbers of stop times, e.g. 50M for a large national feed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import gtfs_loader
+from benchmarks import synthetic
+
+SCHEMAS = ('default', 'itineraries')
+COMPRESSIONS = ('plain', 'zstd')
+
+SIZE_SUFFIXES = {'K': 1_000, 'M': 1_000_000}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+
+    return int(size)
+
+
+def operations(gtfs_dir, out_dir, itineraries, compressed):
+    """
+    Return the timed operations as name: (setup, run) pairs, run being called
+    with the result of setup.
+    """
+
+    def load(**options):
+        return gtfs_loader.load(gtfs_dir, verbose=False, itineraries=itineraries, **options)
+
+    def patch(gtfs, **options):
+        gtfs_loader.patch(gtfs, gtfs_dir, out_dir, verbose=False, itineraries=itineraries,
+                          export_compressed=compressed, **options)
+
+    def clone(gtfs):
+        # Every trip, with its stop times in the default format
+        grouped_name = None if itineraries else 'stop_times'
+        for trip_id in list(gtfs.trips):
+            gtfs_loader.clone(gtfs.trips, trip_id, f'{trip_id}_clone')
+            if grouped_name:
+                gtfs_loader.clone(gtfs[grouped_name], trip_id, f'{trip_id}_clone')
+
+    loaded = {}
+
+    def shared_feed():
+        # Loaded once for the operations that do not modify the feed
+        if 'gtfs' not in loaded:
+            loaded['gtfs'] = load()
+        return loaded['gtfs']
+
+    return {
+        'load': (lambda: None, lambda _: load()),
+        'load_sorted_read': (lambda: None, lambda _: load(sorted_read=True)),
+        'load_columnar': (lambda: None, lambda _: load(columnar=True)),
+        'load_parallel': (lambda: None, lambda _: load(workers=os.cpu_count())),
+        'patch': (shared_feed, patch),
+        'patch_sorted_output': (shared_feed, lambda gtfs: patch(gtfs, sorted_output=True)),
+        'clone': (load, clone),
+    }
+
+
+def measure(setup, run, repeat):
+    seconds = []
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        run(argument)
+        seconds.append(time.perf_counter() - start)
+
+    return seconds
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run_suite(sizes, schemas=SCHEMAS, compressions=COMPRESSIONS, selected=None, repeat=3, verbose=True):
+    results = {}
+    for schema in schemas:
+        itineraries = schema == 'itineraries'
+        for compression in compressions:
+            compressed = compression == 'zstd'
+            for size in sizes:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    gtfs_dir = synthetic.write_feed(Path(tmp_dir) / 'input', stop_times=size,
+                                                    itineraries=itineraries, compressed=compressed)
+                    out_dir = Path(tmp_dir) / 'output'
+
+                    for name, (setup, run) in operations(gtfs_dir, out_dir, itineraries, compressed).items():
+                        if selected and name not in selected:
+                            continue
+
+                        case = f'{schema}/{compression}/{size}/{name}'
+                        seconds = measure(setup, run, repeat)
+                        results[case] = {
+                            'stop_times': size,
+                            'seconds': seconds,
+                            'min': min(seconds),
+                            'median': statistics.median(seconds),
+                        }
+                        if verbose:
+                            print(f'{case}: {min(seconds):.3f}s', file=sys.stderr)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1K,100K', help='comma-separated numbers of stop times (default: 1K,100K)')
+    parser.add_argument('--schemas', default=','.join(SCHEMAS))
+    parser.add_argument('--compressions', default=','.join(COMPRESSIONS))
+    parser.add_argument('--operations', default=None, help='comma-separated operations to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='JSON file to write (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = run_suite([parse_size(size) for size in args.sizes.split(',')],
+                        schemas=args.schemas.split(','),
+                        compressions=args.compressions.split(','),
+                        selected=set(args.operations.split(',')) if args.operations else None,
+                        repeat=args.repeat)
+
+    report = json.dumps({'environment': environment(), 'results': results}, indent=2)
+    if args.output:
+        Path(args.output).write_text(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
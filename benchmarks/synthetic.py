@@ -0,0 +1,141 @@
+"""
+Deterministic generator of synthetic GTFS feeds, used by the benchmarks.
+
+The generated feed is valid for the default schema: every trip visits a run of
+stops of its route at regular intervals, so the output is reproducible for a
+given size and seed. With itineraries=True, the same trips are written in the
+Transit itinerary format instead, following a few itineraries per route.
+"""
+
+import random
+from datetime import date
+from pathlib import Path
+
+import gtfs_loader
+
+# Distinct runs of stops of each route, in the itinerary format
+ITINERARIES_PER_ROUTE = 4
+
+
+def write_feed(gtfs_dir, stop_times=100_000, stops_per_trip=20, seed=0, calendar_dates=0, itineraries=False,
+               compressed=False):
+    """
+    Write a feed with approximately `stop_times` rows in stop_times.txt to
+    gtfs_dir, and return the directory. With calendar_dates, that many rows
+    are written to calendar_dates.txt, for services running on every day of
+    2024.
+
+    With itineraries, the times of the trips are written in trips.txt and their
+    stops in itinerary_cells.txt. With compressed, CSV files are then
+    compressed with ZSTD.
+    """
+
+    gtfs_dir = Path(gtfs_dir)
+    gtfs_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+
+    num_trips = max(1, stop_times // stops_per_trip)
+    num_routes = max(1, num_trips // 50)
+    num_stops = max(stops_per_trip, num_routes * stops_per_trip // 4)
+
+    with open(gtfs_dir / 'agency.txt', 'w', encoding='utf-8') as f:
+        f.write('agency_id,agency_name,agency_url,agency_timezone\n')
+        f.write('A,Synthetic Transit,https://example.com,America/Montreal\n')
+
+    with open(gtfs_dir / 'calendar.txt', 'w', encoding='utf-8') as f:
+        f.write('service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n')
+        f.write('weekday,1,1,1,1,1,0,0,20240101,20241231\n')
+        f.write('weekend,0,0,0,0,0,1,1,20240101,20241231\n')
+
+    if calendar_dates:
+        with open(gtfs_dir / 'calendar_dates.txt', 'w', encoding='utf-8') as f:
+            f.write('service_id,date,exception_type\n')
+            first_day = date(2024, 1, 1).toordinal()
+            for row in range(calendar_dates):
+                day = date.fromordinal(first_day + row % 366)
+                f.write(f'c{row // 366},{day:%Y%m%d},1\n')
+
+    with open(gtfs_dir / 'routes.txt', 'w', encoding='utf-8') as f:
+        f.write('route_id,agency_id,route_short_name,route_type\n')
+        for route in range(num_routes):
+            f.write(f'r{route},A,{route},3\n')
+
+    with open(gtfs_dir / 'stops.txt', 'w', encoding='utf-8') as f:
+        f.write('stop_id,stop_name,stop_lat,stop_lon\n')
+        for stop in range(num_stops):
+            lat = 45.4 + rng.uniform(-0.2, 0.2)
+            lon = -73.6 + rng.uniform(-0.3, 0.3)
+            f.write(f's{stop},"Stop {stop}",{lat:.6f},{lon:.6f}\n')
+
+    if itineraries:
+        write_itineraries(gtfs_dir, rng, num_trips, num_routes, num_stops, stops_per_trip)
+    else:
+        write_stop_times(gtfs_dir, rng, num_trips, num_routes, num_stops, stops_per_trip)
+
+    if compressed:
+        for filepath in gtfs_dir.glob('*.txt'):
+            compress(filepath)
+
+    return gtfs_dir
+
+
+def write_stop_times(gtfs_dir, rng, num_trips, num_routes, num_stops, stops_per_trip):
+    with open(gtfs_dir / 'trips.txt', 'w', encoding='utf-8') as trips_f, \
+            open(gtfs_dir / 'stop_times.txt', 'w', encoding='utf-8') as st_f:
+        trips_f.write('route_id,trip_id,service_id,block_id\n')
+        st_f.write('trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type,drop_off_type\n')
+
+        for trip in range(num_trips):
+            route = trip % num_routes
+            service = 'weekday' if trip % 3 else 'weekend'
+            trips_f.write(f'r{route},t{trip},{service},b{trip // 10}\n')
+
+            first_stop = rng.randrange(num_stops - stops_per_trip + 1)
+            time = rng.randrange(5 * 3600, 24 * 3600)
+            for sequence in range(stops_per_trip):
+                hms = f'{time // 3600:02d}:{time // 60 % 60:02d}:{time % 60:02d}'
+                st_f.write(f't{trip},{hms},{hms},s{first_stop + sequence},{sequence},0,0\n')
+                time += rng.randrange(45, 180)
+
+
+def write_itineraries(gtfs_dir, rng, num_trips, num_routes, num_stops, stops_per_trip):
+    first_stops = [rng.randrange(num_stops - stops_per_trip + 1)
+                   for _ in range(num_routes * ITINERARIES_PER_ROUTE)]
+
+    with open(gtfs_dir / 'itinerary_cells.txt', 'w', encoding='utf-8') as f:
+        f.write('itinerary_index,stop_sequence,stop_id\n')
+        for itinerary, first_stop in enumerate(first_stops):
+            for sequence in range(stops_per_trip):
+                f.write(f'{itinerary},{sequence},s{first_stop + sequence}\n')
+
+    with open(gtfs_dir / 'trips.txt', 'w', encoding='utf-8') as f:
+        f.write('route_id,trip_id,service_id,block_id,itinerary_index,departure_times,arrival_times,'
+                'start_pickup_drop_off_windows,end_pickup_drop_off_windows\n')
+        no_windows = '"[' + ','.join(['-1'] * stops_per_trip) + ']"'
+
+        for trip in range(num_trips):
+            route = trip % num_routes
+            itinerary = route * ITINERARIES_PER_ROUTE + trip // num_routes % ITINERARIES_PER_ROUTE
+            service = 'weekday' if trip % 3 else 'weekend'
+
+            time = rng.randrange(5 * 3600, 24 * 3600)
+            times = []
+            for _ in range(stops_per_trip):
+                times.append(time)
+                time += rng.randrange(45, 180)
+
+            times = '"[' + ','.join(map(str, times)) + ']"'
+            f.write(f'r{route},t{trip},{service},b{trip // 10},{itinerary},{times},{times},'
+                    f'{no_windows},{no_windows}\n')
+
+
+def compress(filepath):
+    """
+    Compress a file with ZSTD in place.
+    """
+
+    compressed_path = filepath.with_name(filepath.name + '.zst')
+    with open(filepath, 'rb') as input_f, open(compressed_path, 'wb') as output_f:
+        gtfs_loader.zstd_compressor(filepath).copy_stream(input_f, output_f)
+
+    compressed_path.replace(filepath)
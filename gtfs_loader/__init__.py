@@ -1,12 +1,20 @@
+import contextlib
 import csv
 import enum
 import json
+import operator
 import shutil
+import time
 import typing
 from io import TextIOWrapper
-from zstandard import ZstdDecompressor, ZstdCompressor
+import zstandard
+from zstandard import ZstdCompressionDict, ZstdCompressionParameters, ZstdDecompressor, ZstdCompressor
 from pathlib import Path
 from . import schema_classes, types, schema
+from . import columnar as columnar_storage
+from . import archive, instrumentation, parallel, snapshot
+from .lazy import LazyFeed
+from .snapshot import load_snapshot, save_snapshot
 
 # Exact codecs to use for encoding / decoding the files on import / export
 UTF_8_ENCODING_FOR_IMPORT = 'utf-8-sig'
@@ -15,75 +23,467 @@ UTF_8_ENCODING_FOR_EXPORT = 'utf-8'
 class ParseError(ValueError):
     pass
 
+# Files filtered along with another one by load(where=..., cascade=True), as
+# name: (parent name, parent field, field)
+CASCADES = {
+    'routes': ('agency', 'agency_id', 'agency_id'),
+    'trips': ('routes', 'route_id', 'route_id'),
+    'stop_times': ('trips', 'trip_id', 'trip_id'),
+    'itinerary_cells': ('trips', 'itinerary_index', 'itinerary_index'),
+}
+
 def get_files(files):
     return schema.FileCollection(*(schema.GTFS_FILENAMES[f] for f in files)).values()
 
 
-def load(gtfs_dir, sorted_read=False, files=None, verbose=True, itineraries=False):
-    gtfs_dir = Path(gtfs_dir)
+def load(gtfs_dir, sorted_read=False, files=None, verbose=True, itineraries=False, columnar=False, workers=None,
+         cache_dir=None, lazy=False, on_file_loaded=None, drop_unknown_columns=False, columns=None, where=None,
+         cascade=False, compression=None, on_file_stats=None):
     gtfs = types.Entity()
 
     files_to_load = get_files(files) if files else schema.GTFS_SUBSET_SCHEMA_ITINERARIES.values() if itineraries else schema.GTFS_SUBSET_SCHEMA.values()
 
-    for file_schema in files_to_load:
-        if verbose:
-            print(f'Loading {file_schema.name}')
-        filepath = gtfs_dir / file_schema.filename
-        gtfs[file_schema.name] = types.EntityDict(
-            file_schema.get_declared_fields())
+    # Only the listed columns of these files are loaded, see select_columns()
+    check_file_options('columns', columns, files_to_load)
+    # Only the dictionaries are used for decompression, see zstd_decompressor()
+    check_compression_settings(compression)
+
+    if where:
+        # Only the entities for which where[name](entity) is true are kept, see get_row_filters()
+        check_file_options('where', where, files_to_load)
+        if lazy or cache_dir is not None:
+            raise ValueError('where cannot be combined with lazy or cache_dir')
+        if cascade:
+            files_to_load = sorted(files_to_load, key=lambda file_schema: cascade_depth(file_schema.name))
+
+    # on_file_stats(stats) is called after each file parsed, see instrumentation.FileStats
+
+    if lazy:
+        # Files are loaded on first access, on_file_loaded(name, seconds) being called after each
+        if cache_dir is not None or (workers and workers > 1):
+            raise ValueError('lazy loading cannot be combined with workers or cache_dir')
+
+        return LazyFeed(gtfs_dir, files_to_load, on_file_loaded, sorted_read=sorted_read, verbose=verbose,
+                        columnar=columnar, drop_unknown_columns=drop_unknown_columns, columns=columns,
+                        compression=compression, on_file_stats=on_file_stats)
+
+    # A directory or a zip archive, see archive.open_feed()
+    with archive.open_feed(gtfs_dir) as gtfs_dir:
+        if cache_dir is not None:
+            return snapshot.cached_load(
+                gtfs_dir, cache_dir, files_to_load,
+                lambda: load(gtfs_dir, sorted_read=sorted_read, files=files, verbose=verbose,
+                             itineraries=itineraries, columnar=columnar, workers=workers,
+                             drop_unknown_columns=drop_unknown_columns, columns=columns, compression=compression,
+                             on_file_stats=on_file_stats),
+                verbose=verbose, sorted_read=sorted_read, columnar=columnar,
+                drop_unknown_columns=drop_unknown_columns, columns=columns, compression=compression)
+
+        workers = parallel.worker_count(workers)
+        if workers > 1:
+            parallel.load_files(gtfs, gtfs_dir, files_to_load, workers, sorted_read=sorted_read, verbose=verbose,
+                                columnar=columnar, drop_unknown_columns=drop_unknown_columns, columns=columns,
+                                where=where, cascade=cascade, compression=compression, on_file_stats=on_file_stats)
+        else:
+            for file_schema in files_to_load:
+                load_file(gtfs, gtfs_dir, file_schema, sorted_read=sorted_read, verbose=verbose, columnar=columnar,
+                          drop_unknown_columns=drop_unknown_columns, columns=columns, where=where, cascade=cascade,
+                          compression=compression, on_file_stats=on_file_stats)
+
+    mark_unmodified(gtfs)
+    if where:
+        # Filtered files differ from the input files
+        for file_schema in files_to_load:
+            if is_filtered(file_schema.name, where, cascade):
+                types.mark_modified(gtfs, file_schema.name)
+
+    return gtfs
+
+
+def check_file_options(option_name, options, files_to_load):
+    if not options:
+        return
+
+    unknown_files = options.keys() - {file_schema.name for file_schema in files_to_load}
+    if unknown_files:
+        raise ValueError(f'{option_name} given for files that are not loaded: {", ".join(sorted(unknown_files))}')
+
+
+def cascade_depth(name):
+    return cascade_depth(CASCADES[name][0]) + 1 if name in CASCADES else 0
+
+
+def is_filtered(name, where, cascade=False):
+    """
+    Return whether load(where=..., cascade=...) filters a file, directly or
+    through its parent files.
+    """
+
+    if name in where:
+        return True
 
+    return cascade and name in CASCADES and is_filtered(CASCADES[name][0], where, cascade)
+
+
+def get_row_filters(gtfs, file_schema, where=None, cascade=False):
+    """
+    Return the predicate on entities of where and the (field, allowed values)
+    pair of the cascade of the file, both None if the file is not filtered.
+
+    With a cascade, rows are kept when their field matches a loaded entity of
+    the parent file, e.g. stop times whose trip_id is that of a loaded trip,
+    without creating entities for the others. Empty values are kept as long as
+    the parent file is not empty, as routes may omit the agency_id of the only
+    agency.
+    """
+
+    if not where:
+        return None, None
+
+    allowed = None
+    if cascade and file_schema.name in CASCADES:
+        parent_name, parent_field, field_name = CASCADES[file_schema.name]
+        parents = gtfs.get(parent_name)
+        if parents is not None and is_filtered(parent_name, where, cascade):
+            values = {entity[parent_field] for entity in parents.values()}
+            if values:
+                values.update(('', None))
+            allowed = field_name, values
+
+    return where.get(file_schema.name), allowed
+
+
+def mark_unmodified(gtfs):
+    """
+    Consider all the files of the feed as unmodified, see patch(only_modified=True).
+    """
+
+    for entities in gtfs.values():
+        if isinstance(entities, types.EntityDict):
+            entities.mark_unmodified()
+
+
+def load_file(gtfs, gtfs_dir, file_schema, sorted_read=False, verbose=True, columnar=False,
+              drop_unknown_columns=False, columns=None, where=None, cascade=False, compression=None,
+              on_file_stats=None):
+    if verbose:
+        print(f'Loading {file_schema.name}')
+    stats = instrumentation.FileStats(file_schema.name, 'load') if on_file_stats else None
+    filepath = gtfs_dir / file_schema.filename
+    gtfs[file_schema.name] = types.EntityDict(
+        file_schema.get_declared_fields())
+
+    if not filepath.exists():
+        if file_schema.required:
+            raise ParseError(
+                f'{file_schema.filename}: required file is missing')
+        else:
+            return
+
+    if file_schema.fileType is schema_classes.FileType.CSV:
+        file_columns = columns.get(file_schema.name) if columns else None
+        file_where, allowed = get_row_filters(gtfs, file_schema, where, cascade)
+        load_csv(gtfs, filepath, file_schema, sorted_read=is_sorted_read(file_schema, sorted_read),
+                 columnar=columnar, drop_unknown_columns=drop_unknown_columns, columns=file_columns,
+                 where=file_where, allowed=allowed, compression=compression, stats=stats)
+        if file_columns is not None:
+            gtfs[file_schema.name]._projected = True
+    elif file_schema.fileType is schema_classes.FileType.GEOJSON:
+        load_json(gtfs, filepath, file_schema)
+
+    if stats is not None:
+        stats.bytes_read = archive.file_size(filepath)
+        stats.finish()
+        on_file_stats(stats)
+
+
+def get_file_schema(name, itineraries=False):
+    """
+    Return the schema of a file from its entity name, e.g. 'stop_times'.
+    """
+
+    collection = schema.GTFS_SUBSET_SCHEMA_ITINERARIES if itineraries else schema.GTFS_SUBSET_SCHEMA
+    for file_schema in collection.values():
+        if file_schema.name == name:
+            return file_schema
+
+    return next(iter(get_files([name])))
+
+
+def iter_file(gtfs_dir, name, chunk_size=None, grouped=False, itineraries=False, compression=None):
+    """
+    Iterate over the entities of a CSV file without loading it in memory.
+
+    Entities are not linked to a feed, so cross-references such as trip.route
+    are unavailable. With grouped=True, yield (id, entities) pairs instead, the
+    entities sharing an ID being ordered by group_id; the file must already be
+    sorted by ID (e.g. stop_times by trip_id). With chunk_size, yield lists of
+    at most chunk_size entities (or groups).
+    """
+
+    file_schema = get_file_schema(name, itineraries)
+    if file_schema.fileType is not schema_classes.FileType.CSV:
+        raise ValueError(f'{file_schema.filename}: only CSV files can be iterated')
+
+    with archive.open_feed(gtfs_dir) as gtfs_dir:
+        filepath = gtfs_dir / file_schema.filename
         if not filepath.exists():
             if file_schema.required:
                 raise ParseError(
                     f'{file_schema.filename}: required file is missing')
-            else:
-                continue
+            return
 
-        if file_schema.fileType is schema_classes.FileType.CSV:
-            load_csv(gtfs, filepath, file_schema, sorted_read=(True if file_schema.name == 'stop_times' or file_schema.name == 'shapes' else sorted_read))
-        elif file_schema.fileType is schema_classes.FileType.GEOJSON:
-            load_json(gtfs, filepath, file_schema)
+        entities = iter_csv(filepath, file_schema, compression)
+        if grouped:
+            entities = group_sorted_entities(file_schema, entities)
+        if chunk_size:
+            entities = chunk_entities(entities, chunk_size)
 
-    return gtfs
+        yield from entities
+
+
+def iter_csv(filepath, file_schema, compression=None):
+    with open_csv(filepath, compression) as csv_reader:
+        header_row = next(csv_reader, None)
+        if not check_header(file_schema, header_row):
+            return
+
+        resolved_fields = merge_header_and_declared_fields(
+            file_schema, header_row)
+        yield from parse_rows(None, file_schema, resolved_fields, header_row, csv_reader)
+
+
+def group_sorted_entities(file_schema, entities):
+    """
+    Group consecutive entities sharing an ID, raise if an ID appears again
+    after its group was closed.
+    """
+
+    group_key = file_schema.group_id
+    seen = set()
+    current_id = None
+    group = []
+
+    for entity in entities:
+        entity_id = entity[file_schema.id]
+        if group and entity_id != current_id:
+            yield current_id, sort_group(group, group_key)
+            seen.add(current_id)
+            group = []
+
+        if not group and entity_id in seen:
+            raise ParseError(
+                f'{file_schema.filename}: not sorted by {file_schema.id}, {entity_id!r} appears in several places')
+
+        current_id = entity_id
+        group.append(entity)
+
+    if group:
+        yield current_id, sort_group(group, group_key)
+
+
+def sort_group(group, group_key):
+    if group_key:
+        with key_errors(group_key):
+            group.sort(key=operator.attrgetter(group_key))
+
+    return group
+
+
+def chunk_entities(entities, chunk_size):
+    chunk = []
+    for entity in entities:
+        chunk.append(entity)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def is_sorted_read(file_schema, sorted_read):
+    return True if file_schema.name == 'stop_times' or file_schema.name == 'shapes' else sorted_read
+
+
+@contextlib.contextmanager
+def open_csv(filepath, compression=None, stats=None):
+    """
+    Open a CSV file, ZSTD-compressed or not, and return an iterator over its
+    records, as lists of str like those of a csv.reader.
+
+    With stats, the time spent reading lines is added to its read phase.
+    """
+
+    def lines(text_lines):
+        return instrumentation.timed(text_lines, stats, 'read') if stats is not None else text_lines
+
+    with archive.open_file(filepath) as file_reader:
+        if not check_if_file_zstd_compressed(file_reader):
+            with TextIOWrapper(file_reader, encoding=UTF_8_ENCODING_FOR_IMPORT) as text_reader:
+                yield csv.reader(lines(text_reader), skipinitialspace=True)
+            return
 
-def load_csv(gtfs, filepath, file_schema, sorted_read=False):
-    with open(filepath, 'rb') as file_reader:
-        # Either reading from a ZSTD-decompressor or from the file directly
         # Important: No need to wrap into a with-statement - Closed automatically by the text-reader (Cascading close-calls)
-        if check_if_file_zstd_compressed(file_reader):
-            raw_reader = ZstdDecompressor().stream_reader(file_reader, closefd=True)
-        else:
-            raw_reader = file_reader
-        
-        # Regardless of whether reading from file directly or from a ZSTD stream, the data needs to be decoded to UTF8
+        raw_reader = zstd_decompressor(filepath, compression).stream_reader(file_reader, closefd=True)
+
+        # The data from the ZSTD stream needs to be decoded to UTF8
         with TextIOWrapper(raw_reader, encoding=UTF_8_ENCODING_FOR_IMPORT) as text_reader:
-            csv_reader = csv.reader(text_reader, skipinitialspace=True)
-            header_row = next(csv_reader, None)
-            if not header_row:
-                if file_schema.required:
-                    raise ParseError(
-                        f'{file_schema.filename}: required file is empty')
-                else:
-                    return
-
-            resolved_fields = merge_header_and_declared_fields(
-                file_schema, header_row)
-            entities = {}
-            for entity in parse_rows(gtfs, file_schema, resolved_fields,
-                                    header_row, csv_reader):
+            yield csv.reader(lines(text_reader), skipinitialspace=True)
+
+
+def load_csv(gtfs, filepath, file_schema, sorted_read=False, columnar=False, drop_unknown_columns=False,
+             columns=None, where=None, allowed=None, compression=None, stats=None):
+    with open_csv(filepath, compression, stats) as csv_reader:
+        if stats is not None:
+            csv_reader = instrumentation.timed(csv_reader, stats, 'tokenize')
+
+        header_row = next(csv_reader, None)
+        if not check_header(file_schema, header_row):
+            return
+
+        indices = select_columns(file_schema, header_row, drop_unknown_columns, columns)
+        if indices is not None:
+            header_row = [header_row[i] for i in indices]
+            csv_reader = project_rows(csv_reader, indices)
+
+        resolved_fields = merge_header_and_declared_fields(
+            file_schema, header_row)
+        rows = convert_rows(file_schema, resolved_fields, header_row, csv_reader)
+        if stats is None:
+            store_rows(gtfs, file_schema, resolved_fields, header_row, rows,
+                       sorted_read=sorted_read, columnar=columnar, where=where, allowed=allowed)
+            return
+
+        start = time.perf_counter()
+        store_rows(gtfs, file_schema, resolved_fields, header_row,
+                   instrumentation.timed(rows, stats, 'convert', count_rows=True),
+                   sorted_read=sorted_read, columnar=columnar, where=where, allowed=allowed, stats=stats)
+        stats.add('index', time.perf_counter() - start)
+
+    # Each phase was timed pulling rows from the previous one
+    stats.nest('index', 'sort')
+    stats.nest('index', 'convert')
+    stats.nest('convert', 'tokenize')
+    stats.nest('tokenize', 'read')
+
+
+def select_columns(file_schema, header_row, drop_unknown_columns=False, columns=None):
+    """
+    Return the indices of the header columns to load, or None to load them all.
+
+    With columns, only the listed columns are loaded, along with the required
+    fields and keys of the file.
+    """
+
+    declared_fields = file_schema.get_declared_fields()
+    # Keys may not be declared fields, e.g. the itinerary_index of itinerary cells
+    keys = {file_schema.id, file_schema.group_id}
+
+    if columns is not None:
+        for name in columns:
+            if name not in declared_fields and name not in header_row:
+                raise ValueError(f'{file_schema.filename}: unknown column {name}')
+
+        kept = {*columns, *keys, *(name for name, config in declared_fields.items() if config.required)}
+    elif drop_unknown_columns:
+        kept = {*declared_fields, *keys}
+    else:
+        return None
+
+    indices = [i for i, name in enumerate(header_row) if name in kept]
+    return indices if len(indices) < len(header_row) else None
+
+
+def project_rows(rows, indices):
+    """
+    Keep the values of the given columns in each row. Short rows keep the
+    values they have, as missing values are set to their default later on.
+    """
+
+    width = indices[-1] + 1 if indices else 0
+    for row in rows:
+        if len(row) >= width:
+            yield [row[i] for i in indices]
+        else:
+            yield [row[i] for i in indices if i < len(row)]
+
+
+def check_header(file_schema, header_row):
+    """
+    Return whether the file has a header, raise if it is required and empty.
+    """
+
+    if not header_row:
+        if file_schema.required:
+            raise ParseError(
+                f'{file_schema.filename}: required file is empty')
+        else:
+            return False
+
+    return True
+
+
+def store_rows(gtfs, file_schema, fields, header_row, rows, sorted_read=False, columnar=False, where=None,
+               allowed=None, stats=None):
+    """
+    Create the entities of a file from converted rows (see convert_rows) and
+    store them as gtfs.<name>, keeping those matching the filters of
+    get_row_filters(). With stats, the time spent sorting is added to its sort
+    phase.
+    """
+
+    if allowed is not None:
+        rows = filter_rows(header_row, rows, *allowed)
+
+    create_entity = file_schema.entity_def._row_factory(header_row)
+
+    if columnar and file_schema.name in columnar_storage.COLUMNAR_FILES:
+        if where is not None:
+            # Entities only created to be tested, the table being built from rows
+            rows = (values for values in rows if where(create_entity(gtfs, values)))
+        gtfs[file_schema.name] = columnar_storage.load_columns(
+            gtfs, file_schema, fields, header_row, rows, sorted_read=sorted_read)
+        return
+
+    entities = {}
+    if sorted_read:
+        new_entities = (create_entity(gtfs, values) for values in rows)
+        in_order = index_entities(file_schema, entities,
+                                  new_entities if where is None else filter(where, new_entities))
+    else:
+        for values in rows:
+            entity = create_entity(gtfs, values)
+            if where is None or where(entity):
                 index_entity(file_schema, entities, entity)
 
-            if sorted_read:
-                processed_entities = sorted_entities(file_schema, entities)
-            else:
-                processed_entities = entities.items()
+    if sorted_read and not in_order:
+        start = time.perf_counter()
+        processed_entities = sorted_entities(file_schema, entities)
+        if stats is not None:
+            stats.add('sort', time.perf_counter() - start)
+    else:
+        processed_entities = entities.items()
+
+    gtfs[file_schema.name] = types.EntityDict(fields=fields,
+                                              values=processed_entities)
+
 
-            gtfs[file_schema.name] = types.EntityDict(fields=resolved_fields,
-                                                      values=processed_entities)
+def filter_rows(header_row, rows, field_name, values):
+    """
+    Keep the converted rows whose value of a field is in values.
+    """
+
+    if field_name not in header_row:
+        # Missing values are empty
+        return rows if None in values else iter(())
+
+    index = header_row.index(field_name)
+    return (row for row in rows if (row[index] if index < len(row) else None) in values)
 
 
 def load_json(gtfs, filepath, file_schema):
-    with open(filepath, 'r', encoding=UTF_8_ENCODING_FOR_IMPORT) as f:
+    with TextIOWrapper(archive.open_file(filepath), encoding=UTF_8_ENCODING_FOR_IMPORT) as f:
         json_data = json.load(f)
 
         gtfs[file_schema.name] = visit_json(json_data, file_schema.class_def())
@@ -141,27 +541,89 @@ def merge_header_and_declared_fields(file_schema, header_row):
 
 
 def parse_rows(gtfs, file_schema, fields, header_row, reader):
+    create_entity = file_schema.entity_def._row_factory(header_row)
+
+    for values in convert_rows(file_schema, fields, header_row, reader):
+        yield create_entity(gtfs, values)
+
+
+def convert_rows(file_schema, fields, header_row, reader):
+    convert_row = compile_row_converter(file_schema, fields, header_row)
+
     for lineno, row in enumerate(reader, 2):
         if len(row) == 0:
             continue  # empty row, just skip it
 
-        entity = file_schema.class_def()
-        entity._gtfs = gtfs
+        yield convert_row(lineno, row)
+
 
-        for name, value in zip(header_row, row):
-            config = fields[name]
-            if config.required and not value:
+def compile_row_converter(file_schema, fields, header_row):
+    """
+    Build a function turning a raw CSV row into a list of typed values, one per
+    header column. Type dispatch is resolved once per column instead of once per
+    cell; errors are reported exactly like validate() would.
+    """
+
+    filename = file_schema.filename
+    columns = [(name, fields[name].required, compile_converter(fields[name]))
+               for name in header_row]
+
+    def convert_row(lineno, row):
+        values = []
+        for (name, required, converter), value in zip(columns, row):
+            if required and not value:
+                raise ParseError(
+                    f'{filename}:{lineno}: required field {name} is empty')
+
+            try:
+                values.append(converter(value))
+            except Exception as exc:
                 raise ParseError(
-                    f'{file_schema.filename}:{lineno}: required field {name} is empty'
-                )
+                    f'{filename}:{lineno} field {name} = {repr(value)}: {exc.args[0]}'
+                ) from None
+
+        return values
 
-            entity[name] = validate(
-                config,
-                value,
-                context_fn=lambda:
-                f'{file_schema.filename}:{lineno} field {name} = {repr(value)}')
+    return convert_row
 
-        yield entity
+
+def compile_converter(config):
+    """
+    Specialized equivalent of convert() for a single field configuration.
+    """
+
+    if typing.get_origin(config.type) is list:
+        def converter(value):
+            return list(json.loads(value))
+    else:
+        config_type = get_inner_type(config.type)
+        if issubclass(config_type, enum.IntEnum):
+            def converter(value):
+                return config_type(int(value))
+        elif config_type is bool:
+            def converter(value):
+                return bool(int(value))
+        elif config_type is str:
+            converter = None
+        elif config_type is types.GTFSTime:
+            converter = types.parse_time
+        elif config_type is types.GTFSDate:
+            converter = types.parse_date
+        else:
+            converter = config_type
+
+    if config.required:
+        return converter if converter else _identity
+
+    default = config.default
+    if not converter:
+        return lambda value: value if value != '' else default
+
+    return lambda value: converter(value) if value != '' else default
+
+
+def _identity(value):
+    return value
 
 
 def validate(config, value, context_fn):
@@ -220,95 +682,363 @@ def index_entity(file_schema, entities, entity):
         entities.setdefault(key, []).append(entity)
 
 
+def index_entities(file_schema, entities, new_entities):
+    """
+    Index entities as index_entity() does, and return whether they came in the
+    order of sorted_entities(), e.g. stop times by trip_id then stop_sequence,
+    so that sorting them is unnecessary.
+    """
+
+    get_key = operator.attrgetter(file_schema.id)
+    in_order = True
+    previous_key = _START
+
+    if not file_schema.group_id:
+        with key_errors(file_schema.id):
+            for entity in new_entities:
+                key = get_key(entity)
+                if in_order and previous_key is not _START:
+                    in_order = _ordered(previous_key, key)
+
+                entities[key] = entity
+                previous_key = key
+
+        return in_order
+
+    get_group_key = operator.attrgetter(file_schema.group_id)
+    inner_dict = file_schema.inner_dict
+    previous_group_key = group = None
+    with key_errors(file_schema.id, file_schema.group_id):
+        for entity in new_entities:
+            key = get_key(entity)
+            group_key = get_group_key(entity)
+            if key == previous_key:
+                if in_order:
+                    in_order = _ordered(previous_group_key, group_key)
+            else:
+                # Keys are only new for sure while they are increasing
+                if in_order and previous_key is not _START:
+                    in_order = _ordered(previous_key, key)
+
+                group = entities.get(key) if not in_order else None
+                if group is None:
+                    group = entities[key] = {} if inner_dict else []
+
+            if inner_dict:
+                group[group_key] = entity
+            else:
+                group.append(entity)
+
+            previous_key, previous_group_key = key, group_key
+
+    return in_order
+
+
+@contextlib.contextmanager
+def key_errors(*field_names):
+    """
+    Raise the KeyError of entity[name] when one of these fields is missing from
+    an entity, which operator.attrgetter() reports as an AttributeError of the
+    entity class.
+    """
+
+    try:
+        yield
+    except AttributeError as e:
+        if e.name in field_names and isinstance(e.obj, types.Entity):
+            raise KeyError(e.name) from None
+        raise
+
+
+# Marks the absence of a previous key in index_entities()
+_START = object()
+
+
+def _ordered(previous, value):
+    try:
+        return not value < previous
+    except TypeError:
+        return False  # Left to sorted_entities() to report
+
+
 def sorted_entities(file_schema, entities):
     if file_schema.group_id:
         if file_schema.inner_dict:
             for group_key, group in entities.items():
                 entities[group_key] = dict(
-                    sorted(group.items(), key=lambda kv: kv[0]))
+                    sorted(group.items(), key=operator.itemgetter(0)))
         else:
-            for group in entities.values():
-                group.sort(key=lambda entity: entity[file_schema.group_id])
+            get_group_key = operator.attrgetter(file_schema.group_id)
+            with key_errors(file_schema.group_id):
+                for group in entities.values():
+                    group.sort(key=get_group_key)
 
-    return sorted(entities.items(), key=lambda kv: kv[0])
+    return sorted(entities.items(), key=operator.itemgetter(0))
 
 
-def patch(gtfs, gtfs_in_dir, gtfs_out_dir, files=None, sorted_output=False, verbose=True, itineraries=False, export_compressed=False):
-    gtfs_in_dir = Path(gtfs_in_dir)
-    gtfs_out_dir = Path(gtfs_out_dir)
-    gtfs_out_dir.mkdir(parents=True, exist_ok=True)
+def patch(gtfs, gtfs_in_dir, gtfs_out_dir, files=None, sorted_output=False, verbose=True, itineraries=False, export_compressed=False,
+          only_modified=False, allow_projected=False, compression=None, on_file_stats=None):
+    """
+    Write the feed to gtfs_out_dir, other files of gtfs_in_dir being copied.
 
-    for import_filename in gtfs_in_dir.iterdir():
-        export_filename = gtfs_out_dir / import_filename.name
+    With only_modified=True, files whose entities did not change since they
+    were loaded, or that were never accessed in a lazy feed, are copied from
+    gtfs_in_dir as they are instead of being written again. Changes made in
+    place to the lists of grouped entities that keep their number of
+    entities (e.g. replacing a stop time of a trip) are not detected: assign
+    the list again, or call mark_modified() on the file, see
+    EntityDict.is_modified().
 
-        # Copying non-CSV files without extra logic (Should not be compressed in the first place)
-        if not import_filename.name.endswith(schema_classes.CSV_EXTENSION):
-            copy_file_silently(import_filename, export_filename)
-        else:
-            copy_csv(import_filename, export_filename, export_compressed)
+    Files loaded with a subset of their columns (see load(columns=...)) would
+    be written without the other columns, so they are refused unless
+    allow_projected=True.
+
+    compression overrides ZSTD_COMPRESSION_SETTINGS for compressed output,
+    see zstd_compressor().
+
+    gtfs_in_dir may be a zip archive, and gtfs_out_dir is written as one if
+    it ends with .zip (see archive.open_output()).
+
+    on_file_stats(stats) is called after each file written or copied, see
+    instrumentation.FileStats.
+    """
+
+    check_compression_settings(compression)
 
     files_to_patch = get_files(files) if files else schema.GTFS_SUBSET_SCHEMA_ITINERARIES.values() if itineraries else schema.GTFS_SUBSET_SCHEMA.values()
 
+    files_to_write = []
     for file_schema in files_to_patch:
-        if verbose:
-            print(f'Writing {file_schema.name}')
+        if only_modified and isinstance(gtfs, LazyFeed) and not gtfs.is_loaded(file_schema.name):
+            continue  # Never accessed, so never modified
+
+        # Files of lazy feeds never accessed are loaded here, to be written like the others
         entities = gtfs.get(file_schema.name)
-        if not entities:
-            (gtfs_out_dir / file_schema.filename).unlink(missing_ok=True)
+        if only_modified and isinstance(entities, types.EntityDict) and not entities.is_modified():
+            continue
+
+        # Checked before writing anything, not to leave a partial output behind
+        if getattr(entities, '_projected', False) and not allow_projected:
+            raise ValueError(f'{file_schema.filename}: loaded with a subset of its columns, '
+                             f'pass allow_projected=True to write it anyway')
+
+        files_to_write.append((file_schema, entities))
+
+    # The input is closed before the output replaces it, when patching an archive in place
+    with archive.open_output(gtfs_out_dir) as gtfs_out_dir, archive.open_feed(gtfs_in_dir) as gtfs_in_dir:
+        # Files written below are not copied, as files cannot be replaced in archives
+        written_filenames = {file_schema.filename for file_schema, _ in files_to_write}
+
+        for import_filename in gtfs_in_dir.iterdir():
+            if import_filename.name in written_filenames or import_filename.is_dir():
+                continue
+
+            export_filename = gtfs_out_dir / import_filename.name
+            stats = instrumentation.FileStats(import_filename.name.split('.', 1)[0], 'patch') \
+                if on_file_stats else None
+            start = time.perf_counter()
+
+            # Copying non-CSV files without extra logic (Should not be compressed in the first place)
+            if not import_filename.name.endswith(schema_classes.CSV_EXTENSION):
+                copy_file_silently(import_filename, export_filename)
+            else:
+                copy_csv(import_filename, export_filename, export_compressed, compression)
+
+            if stats is not None:
+                stats.add('copy', time.perf_counter() - start)
+                report_written(stats, import_filename, export_filename, on_file_stats)
+
+        for file_schema, entities in files_to_write:
+            if verbose:
+                print(f'Writing {file_schema.name}')
+            if not entities:
+                if isinstance(gtfs_out_dir, Path):
+                    (gtfs_out_dir / file_schema.filename).unlink(missing_ok=True)
+                continue
+
+            stats = instrumentation.FileStats(file_schema.name, 'patch') if on_file_stats else None
+            if file_schema.fileType is schema_classes.FileType.CSV:
+                save_csv(file_schema, entities, gtfs_out_dir, sorted_output, export_compressed, compression, stats)
+            elif file_schema.fileType is schema_classes.FileType.GEOJSON:
+                save_json(file_schema, entities, gtfs_out_dir)
+
+            if stats is not None:
+                report_written(stats, None, gtfs_out_dir / file_schema.filename, on_file_stats)
+
+
+def report_written(stats, import_filename, export_filename, on_file_stats):
+    if import_filename is not None:
+        stats.bytes_read = archive.file_size(import_filename)
+    stats.bytes_written = archive.file_size(export_filename)
+    stats.finish()
+    on_file_stats(stats)
+
+
+def transform(gtfs_in_dir, gtfs_out_dir, callbacks, verbose=True, itineraries=False, export_compressed=False,
+              compression=None):
+    """
+    Rewrite a feed one row at a time, without loading it in memory.
+
+    callbacks maps file names (e.g. 'stop_times') to functions called with
+    each entity of the file, in file order. A callback returns the entity to
+    write (possibly modified, e.g. with a new ID), None to drop it, or an
+    iterable of entities to write instead. Other files are copied unchanged.
+
+    Entities are not linked to a feed, so cross-references such as trip.route
+    are unavailable in callbacks. gtfs_in_dir may be a zip archive.
+    """
+
+    check_compression_settings(compression)
+
+    gtfs_out_dir = Path(gtfs_out_dir)
+    gtfs_out_dir.mkdir(parents=True, exist_ok=True)
+
+    schemas = {}
+    for name, callback in callbacks.items():
+        file_schema = get_file_schema(name, itineraries)
+        schemas[file_schema.filename] = file_schema, callback
+
+    with archive.open_feed(gtfs_in_dir) as gtfs_in_dir:
+        # Listed upfront, as temporary files are created while transforming in place
+        for import_filename in list(gtfs_in_dir.iterdir()):
+            export_filename = gtfs_out_dir / import_filename.name
+
+            if import_filename.name in schemas:
+                file_schema, callback = schemas[import_filename.name]
+                if verbose:
+                    print(f'Transforming {file_schema.name}')
+                transform_csv(file_schema, callback, import_filename, export_filename, export_compressed,
+                              compression)
+            elif not import_filename.name.endswith(schema_classes.CSV_EXTENSION):
+                copy_file_silently(import_filename, export_filename)
+            else:
+                copy_csv(import_filename, export_filename, export_compressed, compression)
+
+
+def transform_csv(file_schema, callback, import_filename, export_filename, export_compressed=False,
+                  compression=None):
+    if file_schema.fileType is not schema_classes.FileType.CSV:
+        raise ValueError(f'{file_schema.filename}: only CSV files can be transformed')
+
+    # Written aside first, as the output may replace the input
+    tmp_filename = export_filename.with_name(export_filename.name + '.tmp')
+
+    with open_csv(import_filename, compression) as csv_reader:
+        header_row = next(csv_reader, None)
+        if not check_header(file_schema, header_row):
+            copy_csv(import_filename, export_filename, export_compressed, compression)
+            return
+
+        fields = merge_header_and_declared_fields(file_schema, header_row)
+        with open_csv_writer(tmp_filename, export_compressed, compression) as csv_writer:
+            csv_writer.writerow(fields.keys())
+            write_entities(csv_writer, fields, transform_entities(
+                callback, parse_rows(None, file_schema, fields, header_row, csv_reader)))
+
+    tmp_filename.replace(export_filename)
+
+
+def transform_entities(callback, entities):
+    for entity in entities:
+        result = callback(entity)
+        if result is None:
             continue
 
-        if file_schema.fileType is schema_classes.FileType.CSV:
-            save_csv(file_schema, entities, gtfs_out_dir, sorted_output, export_compressed)
-        elif file_schema.fileType is schema_classes.FileType.GEOJSON:
-            save_json(file_schema, entities, gtfs_out_dir)
+        if isinstance(result, types.Entity):
+            yield result
+        else:
+            yield from result
 
 
-def copy_csv(import_filename, export_filename, export_compressed = False):
-    with open(import_filename, 'rb') as import_f:
+def copy_csv(import_filename, export_filename, export_compressed = False, compression=None):
+    # Written aside first when the output replaces the input, which is still being read
+    in_place = is_same_file(import_filename, export_filename)
+    output_filename = export_filename.with_name(export_filename.name + '.tmp') if in_place else export_filename
+
+    with archive.open_file(import_filename) as import_f:
         import_compressed = check_if_file_zstd_compressed(import_f)
 
         # Copying differently depending on whether the input is compressed and whether output should be compressed
         if import_compressed == export_compressed:
             # 1) Compression-states match (both input and output are compressed / uncompressed) -> Simple copying
             copy_file_silently(import_filename, export_filename)
-        else:
-            with open(export_filename, 'wb') as export_f:
-                # 2) Compression-states do NOT match (compression / decompression is required with copying)
-                if import_compressed:
-                    # 2.1) Input is compressed, but output should not be compressed -> Copying with decompression
-                    ZstdDecompressor().copy_stream(import_f, export_f)
-                else:
-                    # 2.2) Input is uncompressed, but output should be compressed -> Copying with compression
-                    ZstdCompressor(**ZSTD_COMPRESSION_SETTINGS).copy_stream(import_f, export_f)
+            return
 
+        with archive.open_file(output_filename, 'wb') as export_f:
+            # 2) Compression-states do NOT match (compression / decompression is required with copying)
+            if import_compressed:
+                # 2.1) Input is compressed, but output should not be compressed -> Copying with decompression
+                zstd_decompressor(import_filename, compression).copy_stream(import_f, export_f)
+            else:
+                # 2.2) Input is uncompressed, but output should be compressed -> Copying with compression
+                zstd_compressor(export_filename, compression).copy_stream(import_f, export_f)
 
-def save_csv(file_schema, entities, gtfs_out_dir, sorted_output=False, export_compressed=False):
+    if in_place:
+        output_filename.replace(export_filename)
+
+
+def is_same_file(filepath, other_filepath):
+    # Files in zip archives are never replaced in place, archives being read or written as a whole
+    return (isinstance(filepath, Path) and isinstance(other_filepath, Path) and other_filepath.exists()
+            and filepath.samefile(other_filepath))
+
+
+def save_csv(file_schema, entities, gtfs_out_dir, sorted_output=False, export_compressed=False, compression=None,
+             stats=None):
+    start = time.perf_counter()
     if sorted_output:
         processed_entities = dict(sorted_entities(file_schema, entities))
+        if stats is not None:
+            stats.add('sort', time.perf_counter() - start)
     else:
         processed_entities = entities.copy()
 
-    flat_entities = flatten_entities(file_schema, processed_entities)
     fields = entities._resolved_fields
 
-    with open(gtfs_out_dir / (file_schema.filename), 'wb') as file_writer:
+    start = time.perf_counter()
+    with open_csv_writer(gtfs_out_dir / file_schema.filename, export_compressed, compression) as csv_writer:
+        csv_writer.writerow(fields.keys())
+        if isinstance(entities, columnar_storage.ColumnarEntityDict):
+            entities.write_rows(csv_writer, processed_entities.values(), stats)
+        else:
+            write_entities(csv_writer, fields, flatten_entities(file_schema, processed_entities), stats)
+
+    if stats is not None:
+        # Rows are serialized as they are written
+        stats.add('write', time.perf_counter() - start)
+        stats.nest('write', 'serialize')
+
+
+@contextlib.contextmanager
+def open_csv_writer(filepath, export_compressed=False, compression=None):
+    """
+    Create a CSV file, ZSTD-compressed or not, and return a csv.writer over it.
+    """
+
+    with archive.open_file(filepath, 'wb') as file_writer:
         # Important: No need to wrap into a with-statement - Closed automatically by the text-writer (Cascading close-calls)
         if export_compressed:
-            raw_writer = ZstdCompressor(**ZSTD_COMPRESSION_SETTINGS).stream_writer(file_writer, closefd=True)
+            raw_writer = zstd_compressor(filepath, compression).stream_writer(file_writer, closefd=True)
         else:
             raw_writer = file_writer
 
         # Using with-statement is necessary for proper flushing and closing on finishing
         with TextIOWrapper(raw_writer, encoding=UTF_8_ENCODING_FOR_EXPORT) as text_writer:
-            csv_writer = csv.writer(text_writer)
-            csv_writer.writerow(fields.keys())
-            for entity in flat_entities:
-                csv_writer.writerow(
-                    types.serialize(entity.get(name, '')) for name in fields)
+            yield csv.writer(text_writer)
+
+
+def write_entities(csv_writer, fields, entities, stats=None):
+    serialize = types.value_serializer()
+    rows = ([serialize(entity.get(name, '')) for name in fields] for entity in entities)
+    if stats is not None:
+        rows = instrumentation.timed(rows, stats, 'serialize', count_rows=True)
+
+    csv_writer.writerows(rows)
 
 
 def save_json(file_schema, entities, gtfs_out_dir):
-    with open(gtfs_out_dir / (file_schema.filename), 'w', encoding=UTF_8_ENCODING_FOR_EXPORT) as f:
+    with TextIOWrapper(archive.open_file(gtfs_out_dir / file_schema.filename, 'wb'),
+                       encoding=UTF_8_ENCODING_FOR_EXPORT) as f:
         f.write(json.dumps(entities, indent=4, default=vars))
 
 
@@ -328,7 +1058,7 @@ def clone(entities, key, new_key):
         return
 
     entries = entities[key]
-    if isinstance(entries, list):
+    if isinstance(entries, (list, columnar_storage.ColumnarGroup)):
         entities[new_key] = [
             clone_and_index(entity, new_key) for entity in entries
         ]
@@ -345,6 +1075,12 @@ def clone_and_index(entity, new_key):
     return new_entity
 
 def copy_file_silently(original_filename, new_filename):
+    if not (isinstance(original_filename, Path) and isinstance(new_filename, Path)):
+        # From or to a zip archive
+        with archive.open_file(original_filename) as original_f, archive.open_file(new_filename, 'wb') as new_f:
+            shutil.copyfileobj(original_f, new_f)
+        return
+
     try:
         shutil.copy2(original_filename, new_filename)
     except shutil.SameFileError:
@@ -358,8 +1094,78 @@ def copy_file_silently(original_filename, new_filename):
 #   -> Allows determining whether a file is ZSTD-compressed or not
 ZSTD_HEADER_MAGIC_NUMBER = bytearray([0x28, 0xB5, 0x2F, 0xFD])
 
-# Settings to use for compression
+# Settings to use for compression, which compression=... arguments override:
+#   level: compression level, from 1 (fastest) to 22
+#   threads: number of compression threads, -1 for one per CPU
+#   long_distance_matching: look for matches further back, for large files with repeated content
+#   dictionaries: dictionaries by file name (e.g. 'stop_times'), see train_zstd_dictionary()
 ZSTD_COMPRESSION_SETTINGS = { 'level': 3 }
+ZSTD_SETTING_NAMES = {'level', 'threads', 'long_distance_matching', 'dictionaries'}
+
+
+def check_compression_settings(compression):
+    unknown_settings = (compression or {}).keys() - ZSTD_SETTING_NAMES
+    if unknown_settings:
+        raise ValueError(f'unknown compression settings: {", ".join(sorted(unknown_settings))}')
+
+
+def get_zstd_dictionary(filepath, compression=None):
+    """
+    Return the dictionary of a file in the compression settings, if any.
+    """
+
+    dictionaries = (compression or {}).get('dictionaries')
+    # e.g. stop_times.txt, or stop_times.txt.tmp while transforming
+    dictionary = dictionaries.get(filepath.name.split('.', 1)[0]) if dictionaries else None
+    return ZstdCompressionDict(dictionary) if dictionary is not None else None
+
+
+def zstd_compressor(filepath, compression=None):
+    """
+    Return the ZstdCompressor of a file, from ZSTD_COMPRESSION_SETTINGS
+    overridden by compression.
+    """
+
+    settings = {**ZSTD_COMPRESSION_SETTINGS, **(compression or {})}
+    dictionary = get_zstd_dictionary(filepath, settings)
+    threads = settings.get('threads', 0)
+
+    if settings.get('long_distance_matching'):
+        params = ZstdCompressionParameters.from_level(settings['level'], enable_ldm=True, threads=threads)
+        return ZstdCompressor(compression_params=params, dict_data=dictionary)
+
+    return ZstdCompressor(level=settings['level'], dict_data=dictionary, threads=threads)
+
+
+def zstd_decompressor(filepath, compression=None):
+    """
+    Return the ZstdDecompressor of a file. Only the dictionaries of the
+    compression settings apply: zstd decompresses in a single thread.
+    """
+
+    return ZstdDecompressor(dict_data=get_zstd_dictionary(filepath, compression))
+
+
+def train_zstd_dictionary(filepaths, dict_size=112_640, sample_size=4096):
+    """
+    Train a dictionary on uncompressed files of the same type from several
+    feeds (e.g. their stop_times.txt), to be given as
+    compression={'dictionaries': {'stop_times': dictionary}}. Dictionaries
+    mostly help compress small files. Return it as bytes.
+    """
+
+    samples = []
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            header = f.readline()
+            while True:
+                lines = f.readlines(sample_size)
+                if not lines:
+                    break
+
+                samples.append(header + b''.join(lines))
+
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
 
 # Important: Expects file to be opened in binary-mode
 def check_if_file_zstd_compressed(f):
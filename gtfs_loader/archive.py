@@ -0,0 +1,95 @@
+"""
+Feeds in zip archives, read and written without extracting them.
+
+The files of an archive are reached through a zipfile.Path, which supports
+what is used of feed directories (/, exists(), iterdir() and name); they are
+opened with open_file() rather than open().
+"""
+
+import contextlib
+import zipfile
+from pathlib import Path
+
+ZIP_EXTENSION = '.zip'
+
+
+@contextlib.contextmanager
+def open_feed(gtfs_dir):
+    """
+    Return the directory of a feed as a Path, or as a zipfile.Path if it is a
+    zip archive, which is closed on exit. Archives with all their files in a
+    single folder are opened at that folder.
+    """
+
+    if isinstance(gtfs_dir, zipfile.Path):
+        yield gtfs_dir
+        return
+
+    gtfs_dir = Path(gtfs_dir)
+    if not gtfs_dir.is_file() or not zipfile.is_zipfile(gtfs_dir):
+        yield gtfs_dir
+        return
+
+    with zipfile.ZipFile(gtfs_dir) as archive_file:
+        root = zipfile.Path(archive_file)
+        entries = list(root.iterdir())
+        if len(entries) == 1 and entries[0].is_dir():
+            yield entries[0]
+        else:
+            yield root
+
+
+def archive_of(gtfs_dir):
+    """
+    Return the path of the zip archive of an open_feed(), None for directories.
+    """
+
+    return Path(gtfs_dir.root.filename) if isinstance(gtfs_dir, zipfile.Path) else None
+
+
+def open_file(filepath, mode='rb'):
+    """
+    Open a file of a feed directory or archive, in mode 'rb' or 'wb'.
+    """
+
+    if isinstance(filepath, zipfile.Path):
+        # The size of written files is unknown upfront, zip64 allows them over 2GB
+        return filepath.root.open(filepath.at, mode[0], force_zip64=mode == 'wb')
+
+    return open(filepath, mode)
+
+
+def file_size(filepath):
+    """
+    Return the size of a file of a feed directory or archive, as stored.
+    """
+
+    if isinstance(filepath, zipfile.Path):
+        return filepath.root.getinfo(filepath.at).compress_size
+
+    return filepath.stat().st_size
+
+
+@contextlib.contextmanager
+def open_output(gtfs_out_dir):
+    """
+    Return the output directory of a feed, created if needed. Paths ending in
+    .zip are written as archives, which replace the path once complete.
+    """
+
+    gtfs_out_dir = Path(gtfs_out_dir)
+    if gtfs_out_dir.suffix.lower() != ZIP_EXTENSION:
+        gtfs_out_dir.mkdir(parents=True, exist_ok=True)
+        yield gtfs_out_dir
+        return
+
+    # Written aside first, as the output may replace the input
+    tmp_path = gtfs_out_dir.with_name(gtfs_out_dir.name + '.tmp')
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as output:
+            yield zipfile.Path(output)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    tmp_path.replace(gtfs_out_dir)
@@ -0,0 +1,724 @@
+"""
+Columnar (struct-of-arrays) storage for the largest grouped files.
+
+With load(..., columnar=True), stop_times and itinerary_cells are stored as one
+typed column per field instead of one Entity per row. Rows of a group are kept
+contiguous, so gtfs.stop_times[trip_id] is a small ColumnarGroup pointing to a
+range of rows, and indexing it returns a lightweight view exposing the usual
+entity attributes and properties.
+
+Columnar storage is meant for read-mostly use: fields can be set in place, but
+groups cannot grow or shrink (no append/insert/remove). Assign a new list of
+entities to the group's ID instead, which appends its rows to the table. Views
+are created on each access, so compare them with == rather than is.
+
+Rows of groups that were replaced or removed stay in the table until it is
+compacted, which happens once they outnumber the other rows (see
+ColumnarEntityDict.compact()).
+"""
+
+import copy
+import enum
+import functools
+import operator
+import typing
+from array import array
+from collections.abc import Sequence
+
+from . import instrumentation, types
+
+# Files stored in columns when loading with columnar=True
+COLUMNAR_FILES = {'stop_times', 'itinerary_cells'}
+
+# Number of rows transposed into columns at once while loading
+BATCH_SIZE = 65536
+
+_NAN = float('nan')
+
+
+class Column:
+    """
+    A column of values backed by a plain list. Typed subclasses override
+    encode/decode to store values more compactly.
+    """
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else []
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, index):
+        return self.values[index]
+
+    def set(self, index, value):
+        self.values[index] = value
+
+    def extend(self, values):
+        self.values.extend(values)
+
+    def take(self, order):
+        values = self.values
+        self.values = [values[i] for i in order]
+
+    def permute(self, start, stop, order):
+        values = self.values
+        values[start:stop] = [values[start + i] for i in order]
+
+    def to_list(self):
+        return [self.get(i) for i in range(len(self))]
+
+    def serialize(self, start, stop):
+        return map(types.value_serializer(), self.values[start:stop])
+
+
+class ArrayColumn(Column):
+
+    def __init__(self, typecode, decode):
+        super().__init__(array(typecode))
+        self.decode = decode
+
+    def get(self, index):
+        return self.decode(self.values[index])
+
+    def set(self, index, value):
+        self.values[index] = self.encode(value)
+
+    def extend(self, values):
+        self.values.extend(map(self.encode, values))
+
+    def take(self, order):
+        values = self.values
+        self.values = array(values.typecode, [values[i] for i in order])
+
+    def permute(self, start, stop, order):
+        values = self.values
+        values[start:stop] = array(values.typecode, [values[start + i] for i in order])
+
+    @staticmethod
+    def encode(value):
+        return value
+
+    def serialize(self, start, stop):
+        return map(str, self.values[start:stop])
+
+
+class TimeColumn(ArrayColumn):
+
+    def __init__(self):
+        # Stored as plain ints, restored without going through GTFSTime parsing
+        super().__init__('i', functools.partial(int.__new__, types.GTFSTime))
+
+    def serialize(self, start, stop):
+        return map(types.GTFSTime.__str__, self.values[start:stop])
+
+
+class EnumColumn(ArrayColumn):
+
+    def __init__(self, enum_type):
+        super().__init__('b', enum_type)
+
+
+class BoolColumn(ArrayColumn):
+
+    def __init__(self):
+        super().__init__('b', bool)
+
+
+class FloatColumn(ArrayColumn):
+
+    def __init__(self):
+        super().__init__('d', FloatColumn.decode_float)
+
+    @staticmethod
+    def encode(value):
+        return _NAN if value is None else value
+
+    @staticmethod
+    def decode_float(value):
+        # NaN is used to represent None
+        return value if value == value else None
+
+    def serialize(self, start, stop):
+        return ('' if value != value else str(value) for value in self.values[start:stop])
+
+
+class StringColumn(Column):
+    """
+    Strings are interned in a per-column table and stored as integer codes, as
+    identifiers like stop_id repeat across many rows.
+    """
+
+    def __init__(self):
+        super().__init__(array('i'))
+        self.strings = []
+        self.codes = {}
+
+    def get(self, index):
+        return self.strings[self.values[index]]
+
+    def set(self, index, value):
+        self.values[index] = self.encode(value)
+
+    def encode(self, value):
+        if not isinstance(value, str):
+            raise TypeError(f'expected str, got {type(value).__name__}')
+
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(value)
+
+        return code
+
+    def extend(self, values):
+        self.values.extend(map(self.encode, values))
+
+    def take(self, order):
+        values = self.values
+        self.values = array('i', [values[i] for i in order])
+
+    def permute(self, start, stop, order):
+        values = self.values
+        values[start:stop] = array('i', [values[start + i] for i in order])
+
+    def serialize(self, start, stop):
+        return map(self.strings.__getitem__, self.values[start:stop])
+
+
+class DefaultColumn(Column):
+    """
+    A column holding only the default value of a field absent from the file. It
+    is materialized into its typed form the first time one of its rows is set.
+    """
+
+    def __init__(self, default):
+        super().__init__()
+        self.default = default
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def get(self, index):
+        if not -self.length <= index < self.length:
+            raise IndexError('column index out of range')
+
+        return self.default
+
+    def extend(self, values):
+        self.length += sum(1 for _ in values)
+
+    def take(self, order):
+        self.length = len(order)
+
+    def permute(self, start, stop, order):
+        pass
+
+    def serialize(self, start, stop):
+        return [types.serialize(self.default)] * (stop - start)
+
+
+def make_column(config):
+    if typing.get_origin(config.type) is list:
+        return Column()
+
+    # Imported here to avoid a circular import, as __init__ imports this module
+    from . import get_inner_type
+
+    config_type = get_inner_type(config.type)
+    optional = config_type is not config.type or not config.required
+
+    if issubclass(config_type, types.GTFSTime):
+        return TimeColumn()
+    if issubclass(config_type, enum.IntEnum):
+        return EnumColumn(config_type)
+    if config_type is bool:
+        return BoolColumn()
+    if config_type is float:
+        return FloatColumn()
+    if config_type is int and not optional:
+        return ArrayColumn('i', int)
+    if config_type is str:
+        return StringColumn()
+
+    return Column()
+
+
+class ColumnTable:
+    """
+    The columns of a file, in the order of its resolved fields.
+    """
+
+    def __init__(self, gtfs, file_schema, fields):
+        self.gtfs = gtfs
+        self.file_schema = file_schema
+        self.fields = fields
+        self.columns = {name: make_column(config) for name, config in fields.items()}
+        self.view_class = view_class(file_schema.class_def)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def get(self, name, index):
+        return self.columns[name].get(index)
+
+    def set(self, name, index, value):
+        types.mark_modified(self.gtfs, self.file_schema.name)
+        column = self.columns[name]
+        if isinstance(column, DefaultColumn):
+            column = self._materialize(name)
+
+        try:
+            column.set(index, value)
+        except (TypeError, OverflowError):
+            # The value does not fit the typed column, fall back to a list
+            column = self.columns[name] = Column(column.to_list())
+            column.set(index, value)
+
+    def _materialize(self, name):
+        default = self.columns[name]
+        column = make_column(self.fields[name])
+        try:
+            column.extend([default.default] * len(default))
+        except (TypeError, OverflowError):
+            column = Column([default.default] * len(default))
+
+        self.columns[name] = column
+        return column
+
+    def append_rows(self, rows):
+        """
+        Append rows given as lists of values in field order.
+        """
+
+        rows = list(rows)
+        if not rows:
+            return
+
+        start = self.length
+        for name, values in zip(self.columns, zip(*rows)):
+            column = self.columns[name]
+            try:
+                column.extend(values)
+            except (TypeError, OverflowError):
+                # The values do not fit the typed column, fall back to a list
+                del column.values[start:]
+                column = self.columns[name] = Column(column.to_list())
+                column.extend(values)
+
+        self.length += len(rows)
+
+    def append_entities(self, entities):
+        defaults = [config.default for config in self.fields.values()]
+        self.append_rows([entity.get(name, default)
+                          for name, default in zip(self.columns, defaults)]
+                         for entity in entities)
+
+    def take(self, order):
+        for column in self.columns.values():
+            column.take(order)
+
+    def copy(self, order):
+        """
+        Return a new table made of the given rows of this one, which is left
+        unchanged.
+        """
+
+        table = copy.copy(self)
+        table.columns = {name: _copy_column(column) for name, column in self.columns.items()}
+        table.length = len(order)
+        table.take(order)
+        return table
+
+    def view(self, index):
+        return self.view_class(self, index)
+
+
+def _copy_column(column):
+    column = copy.copy(column)
+    if isinstance(column, StringColumn):
+        # Shared otherwise, take() only replacing the codes
+        column.strings = list(column.strings)
+        column.codes = dict(column.codes)
+
+    return column
+
+
+class ColumnarGroup(Sequence):
+    """
+    The contiguous rows [start, stop) of a ColumnTable sharing the same ID.
+    Groups are read-only sequences, see the module documentation.
+    """
+
+    __slots__ = ('_table', 'start', 'stop')
+
+    def __init__(self, table, start, stop):
+        self._table = table
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._table.view(self.start + i) for i in range(*item.indices(len(self)))]
+
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('group index out of range')
+
+        return self._table.view(self.start + item)
+
+    def __iter__(self):
+        view = self._table.view
+        return (view(i) for i in range(self.start, self.stop))
+
+    def sort(self, key=None, reverse=False):
+        """
+        Sort the rows of the group in place, by default by the group field of
+        the file (e.g. stop_sequence), like sorted_entities().
+        """
+
+        if key is None:
+            key = operator.attrgetter(self._table.file_schema.group_id)
+
+        views = list(self)
+        order = sorted(range(len(views)), key=lambda i: key(views[i]), reverse=reverse)
+
+        if order != list(range(len(views))):
+            types.mark_modified(self._table.gtfs, self._table.file_schema.name)
+            for column in self._table.columns.values():
+                column.permute(self.start, self.stop, order)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class ColumnarEntityDict(types.EntityDict):
+    """
+    An EntityDict whose values are ColumnarGroups of a shared ColumnTable.
+    Assigning lists of entities, however they are assigned, appends them to the
+    table.
+    """
+
+    def __init__(self, fields, table, values=None):
+        super().__init__(fields, values)
+        self._table = table
+        # Rows of replaced or removed groups, still in the table
+        self._unused_rows = 0
+
+    def _as_group(self, value):
+        if isinstance(value, ColumnarGroup) and value._table is self._table:
+            return value
+
+        start = len(self._table)
+        self._table.append_entities(value)
+        return ColumnarGroup(self._table, start, len(self._table))
+
+    def _release(self, group):
+        if group._table is self._table:
+            self._unused_rows += len(group)
+
+    def _compact_if_needed(self):
+        if self._unused_rows * 2 > len(self._table):
+            self.compact()
+
+    def compact(self):
+        """
+        Move the rows of the groups to a new table without the rows of replaced
+        or removed groups. Groups are updated in place; views created before
+        keep reading the previous table, so changes made through them are lost.
+        """
+
+        groups = list({id(group): group for group in self.values()}.values())
+        order = [i for group in groups for i in range(group.start, group.stop)]
+        self._table = self._table.copy(order)
+
+        start = 0
+        for group in groups:
+            group._table = self._table
+            group.start, group.stop = start, start + len(group)
+            start = group.stop
+
+        self._unused_rows = 0
+
+    def __setitem__(self, key, value):
+        group = self._as_group(value)
+        previous = self.get(key)
+        super().__setitem__(key, group)
+        if previous is not None and previous is not group:
+            self._release(previous)
+            self._compact_if_needed()
+
+    def __delitem__(self, key):
+        group = self[key]
+        super().__delitem__(key)
+        self._release(group)
+        self._compact_if_needed()
+
+    def pop(self, key, *args):
+        if key not in self:
+            return super().pop(key, *args)
+
+        group = super().pop(key)
+        self._release(group)
+        self._compact_if_needed()
+        return group
+
+    def popitem(self):
+        item = super().popitem()
+        self._release(item[1])
+        self._compact_if_needed()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._table = self._table.copy([])
+        self._unused_rows = 0
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default if default is not None else []
+
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def write_rows(self, csv_writer, groups, stats=None):
+        for group in groups:
+            table = group._table
+            rows = zip(*(column.serialize(group.start, group.stop) for column in table.columns.values()))
+            if stats is not None:
+                rows = instrumentation.timed(rows, stats, 'serialize', count_rows=True)
+
+            csv_writer.writerows(rows)
+
+
+def load_columns(gtfs, file_schema, fields, header_row, rows, sorted_read=False):
+    """
+    Build a ColumnarEntityDict from converted rows (see convert_rows). Groups are
+    ordered like sorted_entities() would when sorted_read is set, otherwise in
+    order of first appearance.
+    """
+
+    table = ColumnTable(gtfs, file_schema, fields)
+    missing = [name for name in fields if name not in header_row]
+    header_width = len(header_row)
+    padding = {name: config.default for name, config in fields.items()}
+
+    # Columns absent from the file never need to be stored per row
+    for name in missing:
+        table.columns[name] = DefaultColumn(fields[name].default)
+
+    batch = []
+    for values in rows:
+        if len(values) < header_width:
+            values = [*values, *(padding[name] for name in header_row[len(values):])]
+        elif len(values) > header_width:
+            values = values[:header_width]
+
+        batch.append(values)
+        if len(batch) == BATCH_SIZE:
+            _append_batch(table, header_row, missing, batch)
+            batch = []
+
+    _append_batch(table, header_row, missing, batch)
+
+    order, groups = _group_rows(table, file_schema, sorted_read)
+    if order is not None:
+        table.take(order)
+
+    return ColumnarEntityDict(fields, table,
+                              ((key, ColumnarGroup(table, start, stop)) for key, start, stop in groups))
+
+
+def _append_batch(table, header_row, missing, batch):
+    if not batch:
+        return
+
+    # The table expects values in field order: header columns first, as returned
+    # by merge_header_and_declared_fields, followed by the missing ones
+    table.append_rows(batch if not missing else ([*values, *[None] * len(missing)] for values in batch))
+
+
+def _group_rows(table, file_schema, sorted_read):
+    """
+    Compute the row permutation needed to make groups contiguous (None if the
+    rows are already in place) and the (key, start, stop) range of each group.
+    """
+
+    ids = table.columns[file_schema.id]
+    if isinstance(ids, StringColumn):
+        # Codes are equal if and only if strings are, only compare strings per run
+        codes, key_of = ids.values, ids.strings.__getitem__
+    else:
+        codes, key_of = ids.to_list(), _identity
+
+    group_column = table.columns[file_schema.group_id]
+    if isinstance(group_column, ArrayColumn) and not isinstance(group_column, FloatColumn):
+        group_values = group_column.values
+    else:
+        group_values = group_column.to_list()
+
+    runs = []
+    in_place = True
+    seen = set()
+    for i, code in enumerate(codes):
+        if runs and runs[-1][0] == code:
+            continue
+
+        if code in seen or (sorted_read and runs and key_of(runs[-1][0]) > key_of(code)):
+            in_place = False
+            break
+
+        seen.add(code)
+        runs.append((code, i))
+
+    if in_place and sorted_read:
+        for (_, start), (_, stop) in zip(runs, runs[1:] + [(None, len(table))]):
+            if any(group_values[i] > group_values[i + 1] for i in range(start, stop - 1)):
+                in_place = False
+                break
+
+    if in_place:
+        bounds = [start for _, start in runs] + [len(table)]
+        return None, [(key_of(code), start, stop) for (code, start), stop in zip(runs, bounds[1:])]
+
+    if sorted_read:
+        # Keys computed once per row, looked up without a Python-level key function
+        sort_keys = list(zip(map(key_of, codes), group_values))
+        order = sorted(range(len(table)), key=sort_keys.__getitem__)
+    else:
+        first_seen = {}
+        for code in codes:
+            first_seen.setdefault(code, len(first_seen))
+        order = sorted(range(len(table)), key=list(map(first_seen.__getitem__, codes)).__getitem__)
+
+    groups = []
+    for i, row in enumerate(order):
+        code = codes[row]
+        if groups and groups[-1][0] == code:
+            groups[-1][2] = i + 1
+        else:
+            groups.append([code, i, i + 1])
+
+    return order, [(key_of(code), start, stop) for code, start, stop in groups]
+
+
+def _identity(value):
+    return value
+
+
+class ColumnarRow:
+    """
+    Base of the row views returned by ColumnarGroup. Field attributes are
+    generated per schema class by view_class().
+    """
+
+    __slots__ = ()
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    @property
+    def _gtfs(self):
+        return self._table.gtfs
+
+    def __getattr__(self, name):
+        # Columns that are not declared fields of the schema class
+        if not name.startswith('_') and name in self._table.columns:
+            return self._table.get(name, self._index)
+
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_') and name in self._table.columns:
+            self._table.set(name, self._index, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def __getitem__(self, item):
+        if item in self._table.columns:
+            return self._table.get(item, self._index)
+
+        return self.__dict__[item]
+
+    def __setitem__(self, key, value):
+        if key in self._table.columns:
+            self._table.set(key, self._index, value)
+        else:
+            self.__dict__[key] = value
+
+    def __delitem__(self, key):
+        raise TypeError('Fields of columnar entities cannot be deleted')
+
+    def __eq__(self, other):
+        # Views of the same row, created on each access
+        if isinstance(other, ColumnarRow):
+            return self._table is other._table and self._index == other._index
+
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self._table), self._index))
+
+    def keys(self):
+        return self._table.columns.keys()
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return f'{self.__class__.__name__} {repr(dict(self.items()))}'
+
+    def clone(self, **overrides):
+        merged = dict(self.items())
+        merged.update(overrides)
+        return self._table.file_schema.entity_def(**merged)
+
+
+def _column_property(name):
+    def fget(self):
+        return self._table.get(name, self._index)
+
+    def fset(self, value):
+        self._table.set(name, self._index, value)
+
+    return property(fget, fset)
+
+
+_VIEW_CLASSES = {}
+
+
+def view_class(class_def):
+    """
+    Return the row view class of a schema class: a subclass exposing fields as
+    properties reading the columns, so schema properties keep working.
+    """
+
+    if class_def not in _VIEW_CLASSES:
+        namespace = {name: _column_property(name) for name in class_def.__annotations__}
+        namespace['__slots__'] = ('_table', '_index')
+        _VIEW_CLASSES[class_def] = type(class_def.__name__, (ColumnarRow, class_def), namespace)
+
+    return _VIEW_CLASSES[class_def]
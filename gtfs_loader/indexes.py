@@ -0,0 +1,143 @@
+"""
+Secondary indexes over a loaded feed: trips by route, service and block, and
+stop times (or itineraries) by stop.
+
+Indexes are built in a single pass over their file the first time they are
+queried, and rebuilt when the file changed since (insertions, deletions,
+clone() or field writes, see EntityDict.is_modified). Lists of grouped
+entities modified in place must be assigned again to the feed to be seen,
+e.g. gtfs.stop_times[trip_id] = stop_times.
+
+Indexes are meant for read-mostly use: they are not updated incrementally, so
+any change to a file rebuilds its indexes in full at the next query.
+Alternating edits and queries costs a full rebuild each time, so edit in
+batches between queries, e.g. by collecting the trips of a route before
+modifying them.
+
+Stop references are stored as two arrays of ints per stop, the number of the
+group (trip or itinerary) and the position in the group, rather than as
+lists of entities.
+"""
+
+from array import array
+
+
+def indexes(gtfs):
+    """
+    Return the FeedIndexes of the feed, created on first use.
+    """
+
+    trips = gtfs.trips
+    cached = getattr(trips, '_feed_indexes', None)
+    if cached is None or cached._gtfs is not gtfs:
+        cached = trips._feed_indexes = FeedIndexes(gtfs)
+
+    return cached
+
+
+class FeedIndexes:
+
+    def __init__(self, gtfs):
+        self._gtfs = gtfs
+        self._trips = None
+        self._stops = None
+
+    def build(self):
+        """
+        Build all the indexes now rather than on first query.
+        """
+
+        self._trip_indexes()
+        self._stop_index()
+        return self
+
+    def _trip_indexes(self):
+        trips = self._gtfs.trips
+        if self._trips is None or self._trips[0] != trips._version:
+            by_route, by_service, by_block, by_itinerary = {}, {}, {}, {}
+            for trip_id, trip in trips.items():
+                by_route.setdefault(trip.route_id, []).append(trip_id)
+                by_service.setdefault(trip.service_id, []).append(trip_id)
+                if trip.block_id:
+                    by_block.setdefault(trip.block_id, []).append(trip_id)
+                itinerary_index = trip.get('itinerary_index')
+                if itinerary_index is not None:
+                    by_itinerary.setdefault(itinerary_index, []).append(trip_id)
+
+            self._trips = trips._version, {'route_id': by_route, 'service_id': by_service,
+                                           'block_id': by_block, 'itinerary_index': by_itinerary}
+
+        return self._trips[1]
+
+    def _resolve_trips(self, field_name, key):
+        trips = self._gtfs.trips
+        return [trips[trip_id] for trip_id in self._trip_indexes()[field_name].get(key, ())]
+
+    def trips_on_route(self, route_id):
+        return self._resolve_trips('route_id', route_id)
+
+    def trips_for_service(self, service_id):
+        return self._resolve_trips('service_id', service_id)
+
+    def trips_in_block(self, block_id):
+        return self._resolve_trips('block_id', block_id)
+
+    def _grouped_stops(self):
+        """
+        Return the name of the file grouping stops by trip or itinerary.
+        """
+
+        return 'itinerary_cells' if self._gtfs.get('stop_times') is None else 'stop_times'
+
+    def _stop_index(self):
+        name = self._grouped_stops()
+        groups = self._gtfs[name]
+        if self._stops is None or self._stops[0] != (name, groups._version):
+            group_keys = list(groups.keys())
+            refs = {}
+            for number, group in enumerate(groups.values()):
+                for position, entity in enumerate(group):
+                    stop_refs = refs.get(entity.stop_id)
+                    if stop_refs is None:
+                        stop_refs = refs[entity.stop_id] = array('i'), array('i')
+
+                    stop_refs[0].append(number)
+                    stop_refs[1].append(position)
+
+            self._stops = (name, groups._version), group_keys, refs
+
+        return self._stops[1:]
+
+    def stop_refs(self, stop_id):
+        """
+        Return the (group key, position) pairs of the entities referencing a
+        stop in stop_times (group key being a trip_id) or itinerary_cells (an
+        itinerary_index).
+        """
+
+        group_keys, refs = self._stop_index()
+        numbers, positions = refs.get(stop_id, ((), ()))
+        return [(group_keys[number], position) for number, position in zip(numbers, positions)]
+
+    def stop_times_at(self, stop_id):
+        """
+        Return the stop times (or itinerary cells) at a stop.
+        """
+
+        groups = self._gtfs[self._grouped_stops()]
+        return [groups[key][position] for key, position in self.stop_refs(stop_id)]
+
+    def trips_at_stop(self, stop_id):
+        """
+        Return the trips serving a stop, each once.
+        """
+
+        keys = dict.fromkeys(key for key, _ in self.stop_refs(stop_id))
+        if self._grouped_stops() == 'stop_times':
+            trip_ids = keys
+        else:
+            by_itinerary = self._trip_indexes()['itinerary_index']
+            trip_ids = dict.fromkeys(trip_id for key in keys for trip_id in by_itinerary.get(key, ()))
+
+        trips = self._gtfs.trips
+        return [trips[trip_id] for trip_id in trip_ids if trip_id in trips]
@@ -0,0 +1,115 @@
+"""
+Measurements of the loading and writing of files, for load(on_file_stats=...)
+and patch(on_file_stats=...).
+
+Loading a CSV file is a pipeline of generators, each phase pulling its input
+from the previous one: read (reading, decompressing and decoding lines),
+tokenize (CSV parsing), convert (typed values), then index (creating and
+indexing entities) and sort. Each phase is timed around the calls pulling its
+output, and the time of the phases it pulls from is subtracted afterwards.
+Timing adds a small cost per row, only paid when stats are requested.
+"""
+
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class FileStats:
+    """
+    Measurements of a file loaded by load() or written by patch().
+
+    timings maps phases to seconds:
+      - load: read, tokenize, convert, index and sort. With workers, the
+        first three run in worker processes and are reported together as
+        parse, the time spent waiting for them.
+      - patch: serialize and write (encoding, compressing and writing rows),
+        or copy for files copied from the input feed.
+
+    The bytes read and written are those stored on disk (or in the archive),
+    compressed or not. peak_rss_delta is the increase of the peak resident
+    memory of the process while handling the file, in bytes, or None where it
+    cannot be measured.
+    """
+
+    def __init__(self, name, operation):
+        self.name = name
+        self.operation = operation
+        self.seconds = 0.0
+        self.timings = {}
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss_delta = None
+
+        self._start = time.perf_counter()
+        self._start_peak_rss = peak_rss()
+
+    def add(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def nest(self, outer, inner):
+        """
+        Remove the time of the inner phase from the outer phase, which was
+        measured pulling rows from it.
+        """
+
+        if outer in self.timings and inner in self.timings:
+            self.timings[outer] -= self.timings[inner]
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+        end_peak_rss = peak_rss()
+        if end_peak_rss is not None and self._start_peak_rss is not None:
+            self.peak_rss_delta = end_peak_rss - self._start_peak_rss
+
+    def __repr__(self):
+        timings = ', '.join(f'{phase} {seconds:.3f}s' for phase, seconds in self.timings.items())
+        return (f'FileStats({self.operation} {self.name}: {self.seconds:.3f}s [{timings}], {self.rows} rows, '
+                f'{self.bytes_read} bytes read, {self.bytes_written} bytes written, '
+                f'peak RSS +{self.peak_rss_delta})')
+
+
+def timed(iterable, stats, phase, count_rows=False):
+    """
+    Yield the items of iterable, adding the time spent getting them to the
+    phase of stats.
+    """
+
+    perf_counter = time.perf_counter
+    iterator = iter(iterable)
+    elapsed = 0.0
+    rows = 0
+    try:
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += perf_counter() - start
+                return
+
+            elapsed += perf_counter() - start
+            rows += 1
+            yield item
+    finally:
+        stats.add(phase, elapsed)
+        if count_rows:
+            stats.rows += rows
+
+
+def peak_rss():
+    """
+    Return the peak resident memory of the process in bytes, or None.
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,238 @@
+"""
+Conversion of feeds between the GTFS format (stop_times.txt) and the Transit
+itinerary format (itinerary_cells.txt), see to_itineraries() and
+from_itineraries().
+
+In the itinerary format, trips visiting the same stops with the same
+attributes (stop_sequence, pickup_type, drop_off_type, ...) share an
+itinerary, listed once in itinerary_cells.txt; the times of each trip are
+stored as lists in trips.txt.
+
+Both conversions stream the file of the larger format one trip at a time,
+through iter_file(). Only the trips (for to_itineraries) or the itineraries
+are kept in memory, along with a hash of the itineraries seen so far to share
+them between trips.
+"""
+
+import contextlib
+from operator import attrgetter
+from pathlib import Path
+
+from . import archive, schema, types
+
+# Fields of stop times stored in lists per trip in the itinerary format, along
+# with the name of their list
+TIME_FIELDS = {
+    'departure_time': 'departure_times',
+    'arrival_time': 'arrival_times',
+    'start_pickup_drop_off_window': 'start_pickup_drop_off_windows',
+    'end_pickup_drop_off_window': 'end_pickup_drop_off_windows',
+}
+
+ITINERARY_INDEX = 'itinerary_index'
+ITINERARY_FIELDS = [ITINERARY_INDEX, *TIME_FIELDS.values()]
+
+
+def to_itineraries(gtfs_in_dir, gtfs_out_dir, verbose=True, export_compressed=False, compression=None):
+    """
+    Write the feed of gtfs_in_dir to gtfs_out_dir in the itinerary format,
+    other files being copied.
+
+    stop_times.txt must be grouped by trip_id (see iter_file(grouped=True)).
+    Trips without stop times cannot be represented and are dropped. Either
+    directory may be a zip archive, as with patch().
+    """
+
+    # Imported here to avoid a circular import, as __init__ imports this module
+    from . import ParseError, check_compression_settings, iter_file, open_csv_writer
+
+    check_compression_settings(compression)
+    with _open_input(gtfs_in_dir, gtfs_out_dir) as gtfs_in_dir:
+        trips_header = _read_header(gtfs_in_dir / schema.Trip._schema.filename, compression)
+        stop_times_header = _read_header(gtfs_in_dir / schema.StopTime._schema.filename, compression)
+
+        if verbose:
+            print('Loading trips')
+        trips = {trip.trip_id: trip for trip in iter_file(gtfs_in_dir, 'trips', compression=compression)}
+
+        cell_fields = [name for name in stop_times_header if name != 'trip_id' and name not in TIME_FIELDS]
+        trip_fields = [name for name in trips_header if name not in ITINERARY_FIELDS]
+        cells_header = [ITINERARY_INDEX, *cell_fields]
+
+        cell_values = _values_getter(cell_fields)
+        time_getters = [attrgetter(name) for name in TIME_FIELDS]
+        serialize = types.value_serializer()
+
+        # Itinerary index of each distinct tuple of cells
+        itineraries = {}
+
+        def itinerary_trip_rows():
+            for trip_id, stop_times in iter_file(gtfs_in_dir, 'stop_times', grouped=True, compression=compression):
+                trip = trips.pop(trip_id, None)
+                if trip is None:
+                    raise ParseError(f'{schema.StopTime._schema.filename}: unknown trip_id {trip_id!r}')
+
+                try:
+                    cells = tuple(map(cell_values, stop_times))
+                except AttributeError:
+                    # Columns absent from short rows are not set
+                    cells = tuple(tuple(stop_time.get(name, '') for name in cell_fields) for stop_time in stop_times)
+
+                itinerary_index = itineraries.setdefault(cells, str(len(itineraries)))
+                # Times as lists of seconds, -1 standing for empty values
+                times = ['[' + ','.join(map(int.__repr__, map(get_time, stop_times))) + ']'
+                         for get_time in time_getters]
+
+                yield [*(serialize(trip.get(name, '')) for name in trip_fields), itinerary_index, *times]
+
+        with archive.open_output(gtfs_out_dir) as gtfs_out_dir:
+            _copy_other_files(gtfs_in_dir, gtfs_out_dir, {schema.Trip._schema.filename,
+                                                          schema.StopTime._schema.filename},
+                              export_compressed, compression)
+
+            if verbose:
+                print('Writing trips')
+            with open_csv_writer(gtfs_out_dir / schema.ItineraryTrip._schema.filename, export_compressed,
+                                 compression) as csv_writer:
+                csv_writer.writerow([*trip_fields, *ITINERARY_FIELDS])
+                csv_writer.writerows(itinerary_trip_rows())
+
+            if verbose and trips:
+                print(f'Dropped {len(trips)} trips without stop times')
+
+            # Written once all trips are known, archives only allowing one file to be written at a time
+            if verbose:
+                print('Writing itinerary_cells')
+            with open_csv_writer(gtfs_out_dir / schema.ItineraryCell._schema.filename, export_compressed,
+                                 compression) as csv_writer:
+                csv_writer.writerow(cells_header)
+                csv_writer.writerows([itinerary_index, *map(serialize, cell)]
+                                     for cells, itinerary_index in itineraries.items()
+                                     for cell in cells)
+
+
+def from_itineraries(gtfs_in_dir, gtfs_out_dir, verbose=True, export_compressed=False, compression=None):
+    """
+    Write the feed of gtfs_in_dir, in the itinerary format, to gtfs_out_dir in
+    the GTFS format, other files being copied. Either directory may be a zip
+    archive, as with patch().
+    """
+
+    from . import ParseError, check_compression_settings, iter_file, load, open_csv_writer, write_entities
+
+    check_compression_settings(compression)
+    with _open_input(gtfs_in_dir, gtfs_out_dir) as gtfs_in_dir:
+        trips_header = _read_header(gtfs_in_dir / schema.ItineraryTrip._schema.filename, compression)
+        cells_header = _read_header(gtfs_in_dir / schema.ItineraryCell._schema.filename, compression)
+
+        itineraries = load(gtfs_in_dir, files=['itinerary_cells'], sorted_read=True, verbose=verbose,
+                           compression=compression).itinerary_cells
+
+        trip_fields = [name for name in trips_header if name not in ITINERARY_FIELDS]
+        cell_fields = [name for name in cells_header if name != ITINERARY_INDEX]
+        stop_time_fields = ['trip_id', 'arrival_time', 'departure_time', *cell_fields,
+                            'start_pickup_drop_off_window', 'end_pickup_drop_off_window']
+
+        # Serialized once per itinerary rather than for every trip following it
+        serialize = types.value_serializer()
+        cell_rows = {itinerary_index: [[serialize(cell.get(name, '')) for name in cell_fields] for cell in cells]
+                     for itinerary_index, cells in itineraries.items()}
+        del itineraries
+
+        format_time = types.GTFSTime.__str__
+
+        def itinerary_trips():
+            return iter_file(gtfs_in_dir, 'trips', itineraries=True, compression=compression)
+
+        def stop_time_rows():
+            for trip in itinerary_trips():
+                cells = cell_rows.get(trip.itinerary_index)
+                if cells is None:
+                    raise ParseError(f'{schema.ItineraryTrip._schema.filename}: trip {trip.trip_id!r} has unknown '
+                                     f'itinerary_index {trip.itinerary_index!r}')
+
+                for list_name in TIME_FIELDS.values():
+                    if len(trip[list_name]) != len(cells):
+                        raise ParseError(f'{schema.ItineraryTrip._schema.filename}: trip {trip.trip_id!r} has '
+                                         f'{len(trip[list_name])} {list_name} for an itinerary of {len(cells)} stops')
+
+                trip_id = trip.trip_id
+                for departure, arrival, start, end, cell in zip(map(format_time, trip.departure_times),
+                                                                map(format_time, trip.arrival_times),
+                                                                map(format_time, trip.start_pickup_drop_off_windows),
+                                                                map(format_time, trip.end_pickup_drop_off_windows),
+                                                                cells):
+                    yield [trip_id, arrival, departure, *cell, start, end]
+
+        with archive.open_output(gtfs_out_dir) as gtfs_out_dir:
+            _copy_other_files(gtfs_in_dir, gtfs_out_dir, {schema.ItineraryTrip._schema.filename,
+                                                          schema.ItineraryCell._schema.filename},
+                              export_compressed, compression)
+
+            # Trips are read twice rather than kept in memory, archives only
+            # allowing one file to be written at a time
+            if verbose:
+                print('Writing trips')
+            with open_csv_writer(gtfs_out_dir / schema.Trip._schema.filename, export_compressed,
+                                 compression) as csv_writer:
+                csv_writer.writerow(trip_fields)
+                write_entities(csv_writer, trip_fields, itinerary_trips())
+
+            if verbose:
+                print('Writing stop_times')
+            with open_csv_writer(gtfs_out_dir / schema.StopTime._schema.filename, export_compressed,
+                                 compression) as csv_writer:
+                csv_writer.writerow(stop_time_fields)
+                csv_writer.writerows(stop_time_rows())
+
+
+def _values_getter(names):
+    """
+    Return a function returning the values of the given attributes of an
+    entity, as a tuple.
+    """
+
+    if len(names) == 1:
+        getter = attrgetter(*names)
+        return lambda entity: (getter(entity),)
+
+    return attrgetter(*names)
+
+
+@contextlib.contextmanager
+def _open_input(gtfs_in_dir, gtfs_out_dir):
+    with archive.open_feed(gtfs_in_dir) as gtfs_in_dir:
+        input_path = archive.archive_of(gtfs_in_dir) or gtfs_in_dir
+        if Path(input_path).resolve() == Path(gtfs_out_dir).resolve():
+            raise ValueError('Feeds cannot be converted in place, gtfs_out_dir must differ from gtfs_in_dir')
+
+        yield gtfs_in_dir
+
+
+def _read_header(filepath, compression=None):
+    from . import ParseError, open_csv
+
+    if not filepath.exists():
+        raise ParseError(f'{filepath.name}: required file is missing')
+
+    with open_csv(filepath, compression) as csv_reader:
+        header_row = next(csv_reader, None)
+
+    if not header_row:
+        raise ParseError(f'{filepath.name}: required file is empty')
+
+    return header_row
+
+
+def _copy_other_files(gtfs_in_dir, gtfs_out_dir, converted_filenames, export_compressed, compression):
+    from . import copy_csv, copy_file_silently, schema_classes
+
+    for import_filename in gtfs_in_dir.iterdir():
+        if import_filename.name in converted_filenames or import_filename.is_dir():
+            continue
+
+        export_filename = gtfs_out_dir / import_filename.name
+        if not import_filename.name.endswith(schema_classes.CSV_EXTENSION):
+            copy_file_silently(import_filename, export_filename)
+        else:
+            copy_csv(import_filename, export_filename, export_compressed, compression)
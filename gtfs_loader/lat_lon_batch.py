@@ -0,0 +1,89 @@
+"""
+Array versions of the LatLon computations, to process many points at once
+(e.g. all the stops of all the trips of a feed).
+
+Points are given as separate arrays of latitudes and longitudes in radians, as
+stored by LatLon; arguments are broadcast against each other, so a single
+point can be compared with an array of points. Results match the LatLon
+methods of the same name.
+
+Requires NumPy, which can be installed with the numpy extra:
+
+    pip install py-gtfs-loader[numpy]
+"""
+
+try:
+    import numpy as np
+except ImportError as exc:
+    raise ImportError('gtfs_loader.lat_lon_batch requires NumPy: pip install py-gtfs-loader[numpy]') from exc
+
+from .lat_lon import LatLon
+
+
+def from_degrees(lats, lons):
+    """
+    Return (lats, lons) arrays in radians from coordinates in degrees.
+    """
+
+    return np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+
+
+def from_lat_lons(lat_lons):
+    """
+    Return (lats, lons) arrays in radians from a sequence of LatLon, such as
+    Trip.stop_shape.
+    """
+
+    coordinates = np.array([(lat_lon.lat, lat_lon.lon) for lat_lon in lat_lons], dtype=float).reshape(-1, 2)
+    return coordinates[:, 0], coordinates[:, 1]
+
+
+def angular_distance(lat1, lon1, lat2, lon2):
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * np.arcsin(np.sqrt(a))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    return LatLon.EARTH_RADIUS_M * angular_distance(lat1, lon1, lat2, lon2)
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    d_lon = lon2 - lon1
+    y = np.sin(d_lon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(d_lon)
+    return np.arctan2(y, x)
+
+
+def add_bearing_and_angular_distance(lat, lon, bearing, dist):
+    """
+    Return the (lats, lons) reached from each point along the given bearing.
+    """
+
+    new_lat = np.arcsin(np.sin(lat) * np.cos(dist) + np.cos(lat) * np.sin(dist) * np.cos(bearing))
+    new_lon = lon + np.arctan2(np.sin(bearing) * np.sin(dist) * np.cos(lat),
+                               np.cos(dist) - np.sin(lat) * np.sin(new_lat))
+    return new_lat, new_lon
+
+
+def distance_to_segment(x_lat, x_lon, l1_lat, l1_lon, l2_lat, l2_lon):
+    """
+    Return the distance in meters from each point x to the segment l1-l2, see
+    LatLon.distance_to_segment.
+    """
+
+    d_l1_x = angular_distance(l1_lat, l1_lon, x_lat, x_lon)
+    t_l1_x = bearing(l1_lat, l1_lon, x_lat, x_lon)
+    d_l1_l2 = angular_distance(l1_lat, l1_lon, l2_lat, l2_lon)
+    t_l1_l2 = bearing(l1_lat, l1_lon, l2_lat, l2_lon)
+    d_l2_x = angular_distance(l2_lat, l2_lon, x_lat, x_lon)
+
+    d_cross = np.arcsin(np.sin(d_l1_x) * np.sin(t_l1_x - t_l1_l2))
+    # Clipped as rounding can push the ratio slightly out of the domain of acos
+    d_along = np.arccos(np.clip(np.cos(d_l1_x) / np.cos(d_cross), -1, 1))
+
+    lx_lat, lx_lon = add_bearing_and_angular_distance(l1_lat, l1_lon, t_l1_l2, d_along)
+    d_lx_x = angular_distance(lx_lat, lx_lon, x_lat, x_lon)
+
+    # The closest point is along l1-l2 or else the nearest end
+    along = (d_along < d_l1_l2) & (d_lx_x < d_l1_x) & (d_lx_x < d_l2_x)
+    return LatLon.EARTH_RADIUS_M * np.where(along, d_lx_x, np.minimum(d_l1_x, d_l2_x))
@@ -0,0 +1,75 @@
+"""
+Lazy loading for load(..., lazy=True).
+
+The returned feed parses each file the first time it is accessed, whether
+directly (gtfs.trips, gtfs['trips'], gtfs.get('trips')) or through the
+properties of other entities (trip.route, stop_time.stop, ...), which all go
+through the feed. patch() loads the files not accessed yet, unless
+only_modified=True.
+"""
+
+import time
+
+from . import archive, types
+
+
+class LazyFeed(types.Entity):
+    """
+    A feed whose files are loaded on first access. Only loaded files are
+    listed by keys(), values() and items(), and written by patch().
+    """
+
+    __slots__ = ('_gtfs_dir', '_pending', '_on_file_loaded', '_load_options')
+
+    def __init__(self, gtfs_dir, files_to_load, on_file_loaded=None, **load_options):
+        super().__init__()
+        self._gtfs_dir = gtfs_dir
+        self._pending = {file_schema.name: file_schema for file_schema in files_to_load}
+        self._on_file_loaded = on_file_loaded
+        self._load_options = load_options
+
+    def is_loaded(self, name):
+        return name not in self._pending
+
+    def _load(self, name):
+        # Imported here to avoid a circular import, as __init__ imports this module
+        from . import load_file
+
+        start = time.perf_counter()
+        try:
+            # Archives are opened again for each file, not to keep them open
+            with archive.open_feed(self._gtfs_dir) as gtfs_dir:
+                load_file(self, gtfs_dir, self._pending[name], **self._load_options)
+        except BaseException:
+            # Do not leave the partially loaded file behind
+            self.__dict__.pop(name, None)
+            raise
+
+        del self._pending[name]
+        entities = self.__dict__[name]
+        if isinstance(entities, types.EntityDict):
+            entities.mark_unmodified()
+
+        if self._on_file_loaded:
+            self._on_file_loaded(name, time.perf_counter() - start)
+
+        return entities
+
+    def __getattr__(self, name):
+        # Only called when the attribute is not found, i.e. not loaded yet
+        if name.startswith('_') or name not in self._pending:
+            raise AttributeError(name)
+
+        return self._load(name)
+
+    def __getitem__(self, item):
+        if item in self._pending:
+            return self._load(item)
+
+        return super().__getitem__(item)
+
+    def get(self, key, default=None):
+        if key in self._pending:
+            return self._load(key)
+
+        return super().get(key, default)
@@ -0,0 +1,327 @@
+"""
+Parallel loading for load(..., workers=N).
+
+CSV files are parsed and converted in a pool of worker processes, large
+uncompressed files being split into byte ranges parsed separately. Workers
+return converted rows rather than entities, which are cheaper to transfer; the
+entities are then created, linked to the feed and indexed in the main process,
+file by file in the usual order.
+
+Starting workers and transferring their rows back costs more than it saves
+for small files, which are loaded in the main process, and on a single core,
+where load() falls back to loading sequentially (see worker_count()).
+"""
+
+import csv
+import enum
+import functools
+import io
+import os
+import time
+import zipfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from . import archive, instrumentation, schema_classes, types
+
+# Uncompressed files larger than this are split into ranges of about this size
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Files smaller than this, as stored, are loaded in the main process
+MIN_FILE_SIZE = 4 * 1024 * 1024
+
+CPU_COUNT = os.cpu_count() or 1
+
+
+def worker_count(workers):
+    """
+    Return the number of worker processes to use for load(workers=N), at most
+    one per core; 1 meaning to load sequentially.
+    """
+
+    return max(1, min(workers or 1, CPU_COUNT))
+
+
+def load_files(gtfs, gtfs_dir, files_to_load, workers, sorted_read=False, verbose=True, columnar=False,
+               drop_unknown_columns=False, columns=None, where=None, cascade=False, compression=None,
+               on_file_stats=None):
+    # Imported here to avoid a circular import, as __init__ imports this module
+    from . import get_row_filters, load_file
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Submit everything first so that files are parsed concurrently
+        pending = [(file_schema, _submit(executor, gtfs_dir, file_schema, drop_unknown_columns,
+                                         columns.get(file_schema.name) if columns else None, compression))
+                   for file_schema in files_to_load]
+
+        for file_schema, tasks in pending:
+            # Computed once the parent files are stored, in the usual order
+            row_filters = get_row_filters(gtfs, file_schema, where, cascade)
+            stats = instrumentation.FileStats(file_schema.name, 'load') if on_file_stats else None
+            if tasks is None or not _store_results(gtfs, file_schema, tasks, sorted_read, verbose, columnar,
+                                                   row_filters, stats):
+                # Missing files, GeoJSON and fallbacks go through the regular path
+                load_file(gtfs, gtfs_dir, file_schema, sorted_read=sorted_read, verbose=verbose, columnar=columnar,
+                          drop_unknown_columns=drop_unknown_columns, columns=columns, where=where, cascade=cascade,
+                          compression=compression, on_file_stats=on_file_stats)
+                continue
+
+            if columns and file_schema.name in columns:
+                gtfs[file_schema.name]._projected = True
+
+            if stats is not None:
+                stats.bytes_read = archive.file_size(gtfs_dir / file_schema.filename)
+                stats.finish()
+                on_file_stats(stats)
+
+
+def _submit(executor, gtfs_dir, file_schema, drop_unknown_columns=False, columns=None, compression=None):
+    """
+    Submit the parsing of a file, return its tasks as (kind, future) pairs or
+    None if the file should be loaded in the main process.
+    """
+
+    from . import check_if_file_zstd_compressed
+
+    filepath = gtfs_dir / file_schema.filename
+    if file_schema.fileType is not schema_classes.FileType.CSV or not filepath.exists():
+        return None
+
+    size = archive.file_size(filepath)
+    if size < MIN_FILE_SIZE:
+        return None
+
+    class_def = file_schema.class_def
+    if isinstance(filepath, zipfile.Path):
+        # Archives cannot be sent to workers, which open them again
+        return [('file', executor.submit(parse_file, class_def, (filepath.root.filename, filepath.at),
+                                         drop_unknown_columns, columns, compression))]
+
+    if size <= CHUNK_SIZE:
+        return [('file', executor.submit(parse_file, class_def, filepath, drop_unknown_columns, columns,
+                                         compression))]
+
+    with open(filepath, 'rb') as f:
+        if check_if_file_zstd_compressed(f):
+            return [('file', executor.submit(parse_file, class_def, filepath, drop_unknown_columns, columns,
+                                             compression))]
+
+        header_line = f.readline()
+        header_row = next(csv.reader(io.StringIO(header_line.decode('utf-8-sig')), skipinitialspace=True), None)
+        if not header_row:
+            return [('file', executor.submit(parse_file, class_def, filepath, drop_unknown_columns, columns,
+                                             compression))]
+
+        bounds = _split(f, f.tell(), size)
+
+    return [('chunk', executor.submit(parse_chunk, class_def, filepath, header_row, start, stop,
+                                      drop_unknown_columns, columns))
+            for start, stop in zip(bounds, bounds[1:])]
+
+
+def _split(f, data_start, size):
+    """
+    Return offsets splitting [data_start, size) into ranges of about CHUNK_SIZE
+    ending on line boundaries.
+    """
+
+    count = -(-(size - data_start) // CHUNK_SIZE)
+    bounds = [data_start]
+    for k in range(1, count):
+        f.seek(data_start + k * (size - data_start) // count)
+        f.readline()
+        offset = f.tell()
+        if bounds[-1] < offset < size:
+            bounds.append(offset)
+
+    bounds.append(size)
+    return bounds
+
+
+def _store_results(gtfs, file_schema, tasks, sorted_read, verbose, columnar, row_filters, stats=None):
+    """
+    Store the rows parsed by the workers, return False if the file must be
+    reloaded sequentially instead. With stats, the time spent waiting for the
+    workers is reported as the parse phase, and decoding their rows as convert.
+    """
+
+    from . import ParseError, check_header, is_sorted_read, merge_header_and_declared_fields, store_rows
+
+    rows = []
+    quotes = 0
+    parse_time = convert_time = 0.0
+    for kind, future in tasks:
+        start = time.perf_counter()
+        if kind == 'file':
+            header_row, payload = future.result()
+            parse_time += time.perf_counter() - start
+            rows = decode_rows(file_schema, header_row, payload)
+            convert_time += time.perf_counter() - start
+            continue
+
+        try:
+            header_row, payload, chunk_quotes = future.result()
+        except ParseError:
+            # Line numbers are relative to the chunk, reparse to report the error
+            return False
+
+        # An odd number of quotes before a boundary means it split a quoted
+        # field containing a line break
+        if quotes % 2:
+            return False
+
+        parse_time += time.perf_counter() - start
+        rows.extend(decode_rows(file_schema, header_row, payload))
+        convert_time += time.perf_counter() - start
+        quotes += chunk_quotes
+
+    if stats is not None:
+        stats.add('parse', parse_time)
+        stats.add('convert', convert_time - parse_time)
+        stats.rows = len(rows)
+
+    if verbose:
+        print(f'Loading {file_schema.name}')
+
+    gtfs[file_schema.name] = types.EntityDict(file_schema.get_declared_fields())
+    if not check_header(file_schema, header_row):
+        return True
+
+    resolved_fields = merge_header_and_declared_fields(file_schema, header_row)
+    where, allowed = row_filters
+    start = time.perf_counter()
+    store_rows(gtfs, file_schema, resolved_fields, header_row, rows,
+               sorted_read=is_sorted_read(file_schema, sorted_read), columnar=columnar, where=where, allowed=allowed,
+               stats=stats)
+    if stats is not None:
+        stats.add('index', time.perf_counter() - start)
+        stats.nest('index', 'sort')
+
+    return True
+
+
+def parse_file(class_def, filepath, drop_unknown_columns=False, columns=None, compression=None):
+    """
+    Worker: return the header and converted rows of a whole file, given as a
+    path or as the (archive, name) pair of a file in a zip archive.
+    """
+
+    from . import convert_rows, merge_header_and_declared_fields, open_csv
+
+    if isinstance(filepath, tuple):
+        with zipfile.ZipFile(filepath[0]) as archive_file:
+            return parse_file(class_def, zipfile.Path(archive_file, filepath[1]), drop_unknown_columns, columns,
+                              compression)
+
+    file_schema = class_def._schema
+    with open_csv(filepath, compression) as csv_reader:
+        header_row = next(csv_reader, None)
+        if not header_row:
+            return header_row, ('rows', [])
+
+        header_row, csv_reader = _project(file_schema, header_row, csv_reader, drop_unknown_columns, columns)
+
+        fields = merge_header_and_declared_fields(file_schema, header_row)
+        rows = list(convert_rows(file_schema, fields, header_row, csv_reader))
+
+    return header_row, encode_rows(file_schema, header_row, rows)
+
+
+def parse_chunk(class_def, filepath, header_row, start, stop, drop_unknown_columns=False, columns=None):
+    """
+    Worker: return the header, converted rows and number of quote characters of
+    the byte range [start, stop) of an uncompressed file.
+    """
+
+    from . import UTF_8_ENCODING_FOR_IMPORT, convert_rows, merge_header_and_declared_fields
+
+    file_schema = class_def._schema
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        data = f.read(stop - start)
+
+    with io.TextIOWrapper(io.BytesIO(data), encoding=UTF_8_ENCODING_FOR_IMPORT) as text_reader:
+        header_row, csv_reader = _project(file_schema, header_row, csv.reader(text_reader, skipinitialspace=True),
+                                          drop_unknown_columns, columns)
+        fields = merge_header_and_declared_fields(file_schema, header_row)
+        rows = list(convert_rows(file_schema, fields, header_row, csv_reader))
+
+    return header_row, encode_rows(file_schema, header_row, rows), data.count(b'"')
+
+
+def _project(file_schema, header_row, csv_reader, drop_unknown_columns, columns):
+    from . import project_rows, select_columns
+
+    indices = select_columns(file_schema, header_row, drop_unknown_columns, columns)
+    if indices is None:
+        return header_row, csv_reader
+
+    return [header_row[i] for i in indices], project_rows(csv_reader, indices)
+
+
+def encode_rows(file_schema, header_row, rows):
+    """
+    Prepare converted rows to be sent back from a worker. Rows are transposed
+    into columns, and integer-like columns (times, enums, ...) are packed in
+    arrays: pickling them value by value would cost more than parsing.
+    """
+
+    if any(len(values) != len(header_row) for values in rows):
+        return 'rows', rows
+
+    columns = []
+    for name, values in zip(header_row, zip(*rows)):
+        if _int_decoder(file_schema, name):
+            try:
+                values = array('q', values)
+            except (TypeError, OverflowError):
+                pass
+
+        columns.append(values)
+
+    return 'columns', (len(rows), columns)
+
+
+def decode_rows(file_schema, header_row, payload):
+    kind, data = payload
+    if kind == 'rows':
+        return data
+
+    length, columns = data
+    if not columns:
+        return [()] * length
+
+    decoded = []
+    for name, values in zip(header_row, columns):
+        decode = _int_decoder(file_schema, name)
+        decoded.append(list(map(decode, values)) if isinstance(values, array) else values)
+
+    return list(zip(*decoded))
+
+
+@functools.lru_cache(maxsize=None)
+def _int_decoder(file_schema, name):
+    """
+    Return the function restoring values of an integer-like field from plain
+    ints, or None if the field is not integer-like.
+    """
+
+    from . import get_inner_type
+
+    config = file_schema.get_declared_fields().get(name)
+    if not config:
+        return None
+
+    config_type = get_inner_type(config.type)
+    if not isinstance(config_type, type):
+        return None
+    if issubclass(config_type, types.GTFSTime):
+        return functools.partial(int.__new__, config_type)
+    if issubclass(config_type, enum.IntEnum):
+        return {member.value: member for member in config_type}.__getitem__
+    if config_type is bool:
+        return bool
+    if config_type is int:
+        return int
+
+    return None
@@ -427,6 +427,7 @@ GTFS_FILENAMES = {
     Locations._schema.name: Locations,
     LocationGroups._schema.name: LocationGroups,
     Routes._schema.name: Routes,
+    Shape._schema.name: Shape,
     Transfer._schema.name: Transfer,
     Trip._schema.name: Trip,
     Stop._schema.name: Stop,
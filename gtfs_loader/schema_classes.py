@@ -27,6 +27,10 @@ class Schema:
         # Will be set to point to the class defining this file
         self.class_def = None
 
+        # Will be set to the class instantiated for entities read from this file:
+        # a slotted subclass of class_def for CSV files, class_def otherwise
+        self.entity_def = None
+
     def get_declared_fields(self):
         return {
             k: Field(type=v,
@@ -77,6 +81,8 @@ class FileCollection:
         self.entities = {}
         for file in args:
             file._schema.class_def = file
+            file._schema.entity_def = file._compact_class() \
+                if file._schema.fileType is FileType.CSV else file
             self.entities[file._schema.filename] = file._schema
 
     def keys(self):
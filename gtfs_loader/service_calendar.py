@@ -0,0 +1,176 @@
+"""
+Service calendar compiled from calendar and calendar_dates.
+
+Each service_id gets an int used as a bitset of the days it is active, bit 0
+being the first day of the feed's date range. Testing a service on a date is
+a single bit test; the services and trips active on a date are computed once
+per date and cached.
+"""
+
+from datetime import date, timedelta
+
+from .schema import ExceptionType
+
+# A weekly pattern repeated n times is pattern * (1 + 2^7 + 2^14 + ...)
+_WEEK_MASK = (1 << 7) - 1
+
+
+def service_calendar(gtfs):
+    """
+    Return the ServiceCalendar of the feed, built on first use and rebuilt
+    once calendar or calendar_dates have been modified (see
+    ServiceCalendar.update_service() to avoid a full rebuild).
+    """
+
+    calendar = gtfs.get('calendar')
+    if calendar is None:
+        return ServiceCalendar(gtfs)
+
+    cached = getattr(calendar, '_service_calendar', None)
+    if cached is None or cached.version != cached.current_version():
+        cached = calendar._service_calendar = ServiceCalendar(gtfs)
+
+    return cached
+
+
+class ServiceCalendar:
+
+    def __init__(self, gtfs):
+        self._gtfs = gtfs
+        self._bits = {}
+        self._services_by_day = {}
+        self._trips_by_service = None
+
+        dates = [day for service_id in self._service_ids() for day in self._service_range(service_id)]
+        self.first_date = min(dates) if dates else None
+        self._first_ordinal = self.first_date.toordinal() if dates else 0
+
+        for service_id in self._service_ids():
+            self._bits[service_id] = self._compile(service_id)
+
+        self.version = self.current_version()
+
+    def current_version(self):
+        return tuple(getattr(self._gtfs.get(name), '_version', None) for name in ('calendar', 'calendar_dates'))
+
+    def _calendar(self):
+        return self._gtfs.get('calendar') or {}
+
+    def _calendar_dates(self):
+        return self._gtfs.get('calendar_dates') or {}
+
+    def _service_ids(self):
+        return self._calendar().keys() | self._calendar_dates().keys()
+
+    def _service_range(self, service_id):
+        """
+        Yield the dates bounding the activity of a service.
+        """
+
+        calendar = self._calendar().get(service_id)
+        if calendar is not None:
+            yield _as_date(calendar.start_date)
+            yield _as_date(calendar.end_date)
+
+        for calendar_date in self._calendar_dates().get(service_id, ()):
+            yield _as_date(calendar_date.date)
+
+    def _offset(self, day):
+        return _as_date(day).toordinal() - self._first_ordinal
+
+    def _compile(self, service_id):
+        bits = 0
+
+        calendar = self._calendar().get(service_id)
+        if calendar is not None:
+            start = _as_date(calendar.start_date)
+            days = _as_date(calendar.end_date).toordinal() - start.toordinal() + 1
+            if days > 0:
+                flags = (calendar.monday, calendar.tuesday, calendar.wednesday, calendar.thursday,
+                         calendar.friday, calendar.saturday, calendar.sunday)
+                # Bit i of the pattern is the weekday of start + i days
+                pattern = sum(1 << i for i in range(7) if flags[(start.weekday() + i) % 7])
+                weeks = -(-days // 7)
+                repeated = pattern * (((1 << (7 * weeks)) - 1) // _WEEK_MASK)
+                bits = (repeated & ((1 << days) - 1)) << self._offset(start)
+
+        for calendar_date in self._calendar_dates().get(service_id, ()):
+            bit = 1 << self._offset(calendar_date.date)
+            if calendar_date.exception_type == ExceptionType.ADD:
+                bits |= bit
+            elif calendar_date.exception_type == ExceptionType.REMOVE:
+                bits &= ~bit
+
+        return bits
+
+    def update_service(self, service_id):
+        """
+        Recompute a single service after editing its calendar or
+        calendar_dates entities.
+        """
+
+        for day in self._service_range(service_id):
+            if self.first_date is None or day < self.first_date:
+                # Extend the date range backwards, shifting every service
+                shift = self.first_date.toordinal() - day.toordinal() if self.first_date else 0
+                self._bits = {key: bits << shift for key, bits in self._bits.items()}
+                self.first_date = day
+                self._first_ordinal = day.toordinal()
+
+        if service_id in self._service_ids():
+            self._bits[service_id] = self._compile(service_id)
+        else:
+            self._bits.pop(service_id, None)
+
+        self._services_by_day.clear()
+        self.version = self.current_version()
+
+    def active_on(self, service_id, day):
+        """
+        Return whether the service runs on a date (a date or GTFSDate).
+        """
+
+        offset = self._offset(day)
+        return offset >= 0 and bool(self._bits.get(service_id, 0) >> offset & 1)
+
+    def active_dates(self, service_id):
+        """
+        Return the dates on which the service runs, in order.
+        """
+
+        bits = self._bits.get(service_id, 0)
+        return [self.first_date + timedelta(days=offset)
+                for offset in range(bits.bit_length()) if bits >> offset & 1]
+
+    def services_on(self, day):
+        """
+        Return the frozenset of the service_ids running on a date.
+        """
+
+        offset = self._offset(day)
+        services = self._services_by_day.get(offset)
+        if services is None:
+            services = self._services_by_day[offset] = frozenset(
+                service_id for service_id, bits in self._bits.items() if offset >= 0 and bits >> offset & 1)
+
+        return services
+
+    def trips_on(self, day):
+        """
+        Return the trips whose service runs on a date.
+        """
+
+        trips = self._gtfs.trips
+        if self._trips_by_service is None or self._trips_by_service[0] != trips._version:
+            by_service = {}
+            for trip in trips.values():
+                by_service.setdefault(trip.service_id, []).append(trip)
+            self._trips_by_service = trips._version, by_service
+
+        by_service = self._trips_by_service[1]
+        return [trip for service_id in sorted(self.services_on(day)) for trip in by_service.get(service_id, ())]
+
+
+def _as_date(day):
+    # GTFSDate is a datetime, whose comparisons with dates fail
+    return date(day.year, day.month, day.day)
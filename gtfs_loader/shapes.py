@@ -0,0 +1,169 @@
+"""
+Compact loading of shapes.txt, which is usually too large to load as one
+entity per point.
+
+Each shape is stored as packed arrays of latitudes and longitudes (in degrees)
+ordered by shape_pt_sequence, with the cumulative distance along the shape at
+each point. Points can be projected on shapes, e.g. to find where a trip
+passes by its stops.
+"""
+
+from array import array
+from math import acos, asin, cos, sin
+from operator import itemgetter
+
+from . import archive
+from .lat_lon import LatLon
+
+
+def load_shapes(gtfs_dir, verbose=True, compression=None):
+    """
+    Return a dict of ShapeLines by shape_id, empty if the feed has no shapes.
+    """
+
+    # Imported here to avoid a circular import, as __init__ imports this module
+    from . import check_header, convert_rows, get_file_schema, merge_header_and_declared_fields, open_csv
+
+    file_schema = get_file_schema('shapes')
+    with archive.open_feed(gtfs_dir) as gtfs_dir:
+        filepath = gtfs_dir / file_schema.filename
+        if not filepath.exists():
+            return {}
+
+        if verbose:
+            print(f'Loading {file_schema.name}')
+
+        points = {}
+        with open_csv(filepath, compression) as csv_reader:
+            header_row = next(csv_reader, None)
+            if not check_header(file_schema, header_row):
+                return {}
+
+            fields = merge_header_and_declared_fields(file_schema, header_row)
+            get_point = itemgetter(*(header_row.index(name)
+                                     for name in ('shape_id', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon')))
+            for values in convert_rows(file_schema, fields, header_row, csv_reader):
+                shape_id, sequence, lat, lon = get_point(values)
+                shape_points = points.get(shape_id)
+                if shape_points is None:
+                    shape_points = points[shape_id] = (array('q'), array('d'), array('d'))
+
+                shape_points[0].append(sequence)
+                shape_points[1].append(lat)
+                shape_points[2].append(lon)
+
+    shapes = {}
+    for shape_id, (sequences, lats, lons) in points.items():
+        order = sorted(range(len(sequences)), key=sequences.__getitem__)
+        if order != list(range(len(order))):
+            lats = array('d', (lats[i] for i in order))
+            lons = array('d', (lons[i] for i in order))
+
+        shapes[shape_id] = ShapeLine(shape_id, lats, lons)
+
+    return shapes
+
+
+class ShapeLine:
+    """
+    The points of a shape, with distances in meters along it.
+    """
+
+    __slots__ = ('shape_id', 'lats', 'lons', 'distances')
+
+    def __init__(self, shape_id, lats, lons):
+        self.shape_id = shape_id
+        self.lats = lats
+        self.lons = lons
+        self.distances = array('d', [0.0] * len(lats))
+
+        previous = None
+        for i, point in enumerate(self.points()):
+            if previous is not None:
+                self.distances[i] = self.distances[i - 1] + previous.distance_to(point)
+            previous = point
+
+    def __len__(self):
+        return len(self.lats)
+
+    def __repr__(self):
+        return f'ShapeLine {self.shape_id!r} ({len(self)} points, {self.length:.0f} m)'
+
+    @property
+    def length(self):
+        return self.distances[-1] if self.distances else 0.0
+
+    def point(self, i):
+        return LatLon(self.lats[i], self.lons[i])
+
+    def points(self):
+        return [LatLon(lat, lon) for lat, lon in zip(self.lats, self.lons)]
+
+    def project(self, lat_lon, min_distance_along=0.0):
+        """
+        Return (distance, distance_along) for the point of the shape nearest to
+        lat_lon: its distance to lat_lon and its distance from the start of the
+        shape, both in meters. Only the part of the shape from
+        min_distance_along is considered, so that the stops of a trip can be
+        projected in order.
+        """
+
+        if len(self) == 1:
+            return lat_lon.distance_to(self.point(0)), 0.0
+
+        best = None
+        l1 = None
+        for i in range(len(self)):
+            l2 = self.point(i)
+            if l1 is not None and self.distances[i] >= min_distance_along:
+                distance = _distance_to_segment(lat_lon, l1, l2)
+                if best is None or distance < best[0]:
+                    best = distance, i - 1, l1, l2
+            l1 = l2
+
+        if best is None:
+            return lat_lon.distance_to(self.point(len(self) - 1)), self.length
+
+        distance, i, l1, l2 = best
+        along = max(self.distances[i] + _along_segment(lat_lon, l1, l2), min_distance_along)
+        return distance, min(along, self.distances[i + 1])
+
+    def project_stops(self, locations):
+        """
+        Project the locations of the stops of a trip in order, return their
+        (distance, distance_along) pairs.
+        """
+
+        projected = []
+        distance_along = 0.0
+        for location in locations:
+            distance, distance_along = self.project(location, distance_along)
+            projected.append((distance, distance_along))
+
+        return projected
+
+
+def _distance_to_segment(x, l1, l2):
+    try:
+        return x.distance_to_segment(l1, l2)
+    except ValueError:
+        # Rounding out of the domain of acos, for degenerate segments
+        return min(x.distance_to(l1), x.distance_to(l2))
+
+
+def _along_segment(x, l1, l2):
+    """
+    Return the distance in meters from l1 to the projection of x on the
+    segment l1-l2, as computed by LatLon.distance_to_segment.
+    """
+
+    d_l1_x, t_l1_x = l1.angular_distance_to(x), l1.bearing_to(x)
+    d_l1_l2, t_l1_l2 = l1.angular_distance_to(l2), l1.bearing_to(l2)
+
+    # x is behind l1
+    if cos(t_l1_x - t_l1_l2) <= 0:
+        return 0.0
+
+    d_cross = asin(sin(d_l1_x) * sin(t_l1_x - t_l1_l2))
+    d_along = acos(min(1.0, cos(d_l1_x) / cos(d_cross)))
+    return LatLon.EARTH_RADIUS_M * min(d_along, d_l1_l2)
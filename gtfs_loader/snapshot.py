@@ -0,0 +1,430 @@
+"""
+Binary snapshots of loaded feeds, to skip CSV parsing when the same feed is
+loaded repeatedly.
+
+A snapshot stores each file as typed columns serialized with marshal and
+compressed with ZSTD. Only load snapshots you wrote yourself: like pickle,
+marshal is not meant to read untrusted data.
+
+load(..., cache_dir=...) keeps one snapshot per feed directory and set of load
+options, together with the size, modification time and content hash of every
+input file. The snapshot is used while these still match and rebuilt otherwise.
+"""
+
+import enum
+import functools
+import hashlib
+import json
+import marshal
+import os
+import struct
+import typing
+from pathlib import Path
+
+from zstandard import ZstdCompressor, ZstdDecompressor
+
+from . import archive, columnar, schema, schema_classes, types
+
+SNAPSHOT_MAGIC = b'GTFSSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_EXTENSION = '.snapshot'
+
+# Stands for a field missing from an entity
+_MISSING = ...
+
+_HEADER = struct.Struct('<8sBI')
+
+
+def save_snapshot(gtfs, path, sources=None):
+    """
+    Write every file of a loaded feed to a snapshot at path.
+    """
+
+    files = [_encode_file(name, entities) for name, entities in gtfs.items()
+             if isinstance(entities, (types.EntityDict, types.Entity))]
+    payload = ZstdCompressor(level=3).compress(marshal.dumps({'files': files}))
+    _write_snapshot(Path(path), sources or {}, payload)
+
+
+def _write_snapshot(path, sources, payload):
+    header = marshal.dumps(sources)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+        f.write(payload)
+
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    """
+    Read a feed written by save_snapshot().
+    """
+
+    with open(path, 'rb') as f:
+        _read_sources(f, path)
+        data = marshal.loads(ZstdDecompressor().decompress(f.read()))
+
+    gtfs = types.Entity()
+    for encoded in data['files']:
+        entities = gtfs[encoded['name']] = _decode_file(gtfs, encoded)
+        if encoded.get('projected'):
+            entities._projected = True
+
+    for entities in gtfs.values():
+        if isinstance(entities, types.EntityDict):
+            entities.mark_unmodified()
+
+    return gtfs
+
+
+def read_snapshot_sources(path):
+    """
+    Return the input file metadata recorded in a snapshot.
+    """
+
+    with open(path, 'rb') as f:
+        return _read_sources(f, path)
+
+
+def _read_sources(f, path):
+    magic, version, header_size = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f'{path}: not a GTFS snapshot')
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f'{path}: unsupported snapshot version {version}')
+
+    return marshal.loads(f.read(header_size))
+
+
+def cached_load(gtfs_dir, cache_dir, files_to_load, load_fn, verbose=True, **load_options):
+    """
+    Return the feed from its snapshot in cache_dir if the input files did not
+    change since it was written, otherwise call load_fn() and write a snapshot.
+    """
+
+    archive_path = archive.archive_of(gtfs_dir)
+    if archive_path is not None:
+        # The archive is the source of all the files
+        gtfs_dir, filenames = archive_path.parent, [archive_path.name]
+    else:
+        gtfs_dir = Path(gtfs_dir)
+        filenames = [file_schema.filename for file_schema in files_to_load]
+
+    cache_dir = Path(cache_dir)
+
+    key = hashlib.sha1(repr((str(gtfs_dir.resolve()), sorted(load_options.items()), filenames,
+                             [file_schema.class_def.__name__ for file_schema in files_to_load])).encode())
+    snapshot_path = cache_dir / f'{key.hexdigest()}{SNAPSHOT_EXTENSION}'
+
+    if snapshot_path.exists():
+        try:
+            recorded = read_snapshot_sources(snapshot_path)
+        except (ValueError, EOFError, struct.error):
+            recorded = None  # Unreadable, rebuild it
+
+        current = _current_sources(gtfs_dir, filenames, recorded) if recorded is not None else None
+        if current is not None:
+            if current != recorded:
+                # Touched files kept their content, recorded with their new modification time not to hash
+                # them again on every load
+                _rewrite_sources(snapshot_path, current)
+
+            if verbose:
+                print(f'Loading snapshot {snapshot_path}')
+            return load_snapshot(snapshot_path)
+
+    # Described before loading, so that changes made while loading invalidate it
+    sources = {filename: _describe_source(gtfs_dir / filename) for filename in filenames}
+    gtfs = load_fn()
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    save_snapshot(gtfs, snapshot_path, sources=sources)
+    return gtfs
+
+
+def _describe_source(filepath):
+    try:
+        stat = filepath.stat()
+    except FileNotFoundError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns, _hash_file(filepath)
+
+
+def _current_sources(gtfs_dir, filenames, recorded):
+    """
+    Return the description of the input files if they match the recorded one,
+    modification times being updated for files whose content did not change,
+    or None if the snapshot is stale.
+    """
+
+    if set(filenames) != set(recorded):
+        return None
+
+    current = dict(recorded)
+    for filename in filenames:
+        filepath = gtfs_dir / filename
+        expected = recorded[filename]
+        try:
+            stat = filepath.stat()
+        except FileNotFoundError:
+            if expected is None:
+                continue
+            return None
+
+        if expected is None or stat.st_size != expected[0]:
+            return None
+
+        # A touched file with the same content is still valid
+        if stat.st_mtime_ns != expected[1]:
+            if _hash_file(filepath) != expected[2]:
+                return None
+            current[filename] = stat.st_size, stat.st_mtime_ns, expected[2]
+
+    return current
+
+
+def _rewrite_sources(path, sources):
+    """
+    Replace the input file metadata recorded in a snapshot, keeping its files.
+    """
+
+    with open(path, 'rb') as f:
+        _read_sources(f, path)
+        payload = f.read()
+
+    _write_snapshot(path, sources, payload)
+
+
+def _hash_file(filepath):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _schema_of(name, entities):
+    """
+    Find the schema of a file from its entities, as some names (e.g. trips) are
+    shared by several schemas.
+    """
+
+    sample = next(_iter_entities(entities), None) if isinstance(entities, types.EntityDict) else entities
+    if sample is not None and hasattr(sample, '_schema') and getattr(sample._schema, 'name', None) == name:
+        return sample._schema
+
+    return schema.GTFS_FILENAMES[name]._schema
+
+
+def _iter_entities(entities):
+    for value in entities.values():
+        if isinstance(value, dict):
+            yield from value.values()
+        elif isinstance(value, (list, columnar.ColumnarGroup)):
+            yield from value
+        else:
+            yield value
+
+
+def _encode_file(name, entities):
+    file_schema = _schema_of(name, entities)
+    encoded = {'name': name, 'class': file_schema.class_def.__name__}
+
+    if file_schema.fileType is schema_classes.FileType.GEOJSON and not isinstance(entities, types.EntityDict):
+        encoded['json'] = json.dumps(entities, default=vars)
+        return encoded
+
+    fields = entities._resolved_fields
+    keys = list(entities.keys())
+    if not file_schema.group_id:
+        sizes = None
+        inner_keys = None
+    else:
+        sizes = [len(group) for group in entities.values()]
+        inner_keys = [_encode_generic(key) for group in entities.values() for key in group] \
+            if file_schema.inner_dict else None
+
+    flat = list(_iter_entities(entities))
+    columns = [_encode_column(config, [entity.get(field_name, _MISSING) for entity in flat])
+               for field_name, config in fields.items()]
+
+    encoded.update({
+        'fields': list(fields),
+        'keys': [_encode_generic(key) for key in keys],
+        'sizes': sizes,
+        'inner_keys': inner_keys,
+        'length': len(flat),
+        'columns': columns,
+        'columnar': isinstance(entities, columnar.ColumnarEntityDict),
+        'projected': entities._projected,
+    })
+    return encoded
+
+
+def _decode_file(gtfs, encoded):
+    # Imported here to avoid a circular import, as __init__ imports this module
+    from . import merge_header_and_declared_fields, visit_json
+
+    class_def = getattr(schema, encoded['class'])
+    file_schema = class_def._schema
+
+    if 'json' in encoded:
+        return visit_json(json.loads(encoded['json']), class_def())
+
+    field_names = encoded['fields']
+    fields = merge_header_and_declared_fields(file_schema, field_names)
+    columns = [_decode_column(fields[name], column) for name, column in zip(field_names, encoded['columns'])]
+    rows = zip(*columns) if columns else [()] * encoded['length']
+
+    if encoded['columnar']:
+        return columnar.load_columns(gtfs, file_schema, fields, field_names, rows)
+
+    create_entity = file_schema.entity_def._row_factory(field_names)
+    entities = [create_entity(gtfs, values) for values in rows]
+
+    # Fields that were absent from some entities
+    for name, column in zip(field_names, encoded['columns']):
+        for index in column[2]:
+            del entities[index][name]
+
+    keys = [_decode_generic(key) for key in encoded['keys']]
+    if not file_schema.group_id:
+        return types.EntityDict(fields, zip(keys, entities))
+
+    values = []
+    position = 0
+    inner_keys = [_decode_generic(key) for key in encoded['inner_keys']] if encoded['inner_keys'] is not None else None
+    for key, size in zip(keys, encoded['sizes']):
+        group = entities[position:position + size]
+        if inner_keys is not None:
+            group = dict(zip(inner_keys[position:position + size], group))
+
+        values.append((key, group))
+        position += size
+
+    return types.EntityDict(fields, values)
+
+
+def _encode_column(config, values):
+    """
+    Encode a column as (kind, values, missing indices). Typed columns store
+    plain values decoded according to the field type; others are encoded value
+    by value.
+    """
+
+    missing = [i for i, value in enumerate(values) if value is _MISSING] if values.count(_MISSING) else []
+    if missing:
+        values = [None if value is _MISSING else value for value in values]
+
+    codec = _codec(config.type)
+    if codec:
+        try:
+            return 'typed', list(map(codec[0], values)), missing
+        except (TypeError, ValueError, AttributeError):
+            pass
+    elif all(map(_is_plain, values)):
+        return 'typed', values, missing
+
+    return 'generic', list(map(_encode_generic, values)), missing
+
+
+def _decode_column(config, column):
+    kind, values, _ = column
+    if kind == 'generic':
+        return list(map(_decode_generic, values))
+
+    codec = _codec(config.type)
+    return list(map(codec[1], values)) if codec else values
+
+
+_PLAIN_TYPES = {str, int, float, bool, type(None)}
+
+
+def _is_plain(value):
+    """
+    Return whether marshal stores value as it is, subclasses such as GTFSTime
+    not being supported, in lists as elsewhere.
+    """
+
+    if type(value) is list:
+        return all(map(_is_plain, value))
+
+    return type(value) in _PLAIN_TYPES
+
+
+@functools.lru_cache(maxsize=None)
+def _codec(config_type):
+    """
+    Return the (encode, decode) functions of a field type whose values are not
+    plain marshal values, or None.
+    """
+
+    if typing.get_origin(config_type) is list:
+        return None
+
+    from . import get_inner_type
+
+    inner_type = get_inner_type(config_type)
+    if not isinstance(inner_type, type):
+        return None
+    if issubclass(inner_type, types.GTFSTime):
+        return _encode_int, functools.partial(int.__new__, inner_type)
+    if issubclass(inner_type, types.GTFSDate):
+        return _encode_date, functools.partial(_decode_date, inner_type)
+    if issubclass(inner_type, enum.IntEnum):
+        return _encode_int, {member.value: member for member in inner_type}.__getitem__
+
+    return None
+
+
+def _encode_int(value):
+    if not isinstance(value, int):
+        raise TypeError(f'expected int, got {type(value).__name__}')
+
+    return int(value)
+
+
+def _encode_date(value):
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def _decode_date(date_type, value):
+    return date_type(value // 10000, value // 100 % 100, value % 100)
+
+
+def _encode_generic(value):
+    """
+    Encode a single value of any type found in the schema. Tuples are used to
+    tag values that marshal cannot represent directly.
+    """
+
+    if isinstance(value, types.GTFSTime):
+        return ('time', int(value))
+    if isinstance(value, types.GTFSDate):
+        return ('date', _encode_date(value))
+    if isinstance(value, enum.IntEnum):
+        return ('enum', type(value).__name__, int(value))
+    if isinstance(value, list):
+        return [_encode_generic(item) for item in value]
+    if type(value) in _PLAIN_TYPES:
+        return value
+
+    raise ValueError(f'Cannot store {type(value).__name__} value {repr(value)} in a snapshot')
+
+
+def _decode_generic(value):
+    if isinstance(value, tuple):
+        if value[0] == 'time':
+            return types.GTFSTime(value[1])
+        if value[0] == 'date':
+            return _decode_date(types.GTFSDate, value[1])
+        return getattr(schema, value[1])(value[2])
+
+    if isinstance(value, list):
+        return [_decode_generic(item) for item in value]
+
+    return value
@@ -0,0 +1,141 @@
+"""
+Spatial index over the stops of a feed, for nearest stop, radius and bounding
+box queries.
+
+Stops are bucketed in a grid of cells of about cell_size meters: rows span a
+fixed latitude range and each row is split in as many longitude ranges as fit
+at its latitude, so that cells keep a similar size from the equator to the
+poles. Queries only compute distances to stops of the cells they overlap.
+"""
+
+from math import asin, cos, floor, pi, sin
+
+from .lat_lon import LatLon
+
+
+def stop_index(gtfs, cell_size=250):
+    """
+    Return the index of gtfs.stops, built on first use and rebuilt once stops
+    have been modified.
+    """
+
+    stops = gtfs.stops
+    index = getattr(stops, '_stop_index', None)
+    if index is None or index.version != stops._version or index.cell_size != cell_size:
+        index = stops._stop_index = StopIndex(stops.values(), cell_size)
+        index.version = stops._version
+
+    return index
+
+
+class StopIndex:
+
+    def __init__(self, stops, cell_size=250):
+        self.cell_size = cell_size
+        self.version = None
+        self._d_lat = cell_size / LatLon.EARTH_RADIUS_M
+        self._rows = {}
+        self._count = 0
+
+        for stop in stops:
+            if stop.stop_lat is None or stop.stop_lon is None:
+                continue
+
+            location = LatLon(stop.stop_lat, stop.stop_lon)
+            row = self._row(location.lat)
+            cells = self._rows.setdefault(row, {})
+            cells.setdefault(self._column(row, location.lon), []).append((location, stop))
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def _row(self, lat):
+        return floor(lat / self._d_lat)
+
+    def _columns_in_row(self, row):
+        # Cells are as wide as they are high at the row edge closest to the equator
+        edge = min(abs(row), abs(row + 1)) * self._d_lat
+        return max(1, floor(2 * pi * cos(edge) / self._d_lat))
+
+    def _column(self, row, lon):
+        columns = self._columns_in_row(row)
+        return floor((lon + pi) / (2 * pi) * columns) % columns
+
+    def _candidates(self, min_lat, max_lat, lon_ranges):
+        """
+        Yield the (location, stop) pairs of the cells overlapping the latitude
+        range and one of the (min_lon, max_lon) longitude ranges.
+        """
+
+        for row in range(self._row(min_lat), self._row(max_lat) + 1):
+            cells = self._rows.get(row)
+            if not cells:
+                continue
+
+            columns = self._columns_in_row(row)
+            overlapped = set()
+            for min_lon, max_lon in lon_ranges:
+                first = floor((min_lon + pi) / (2 * pi) * columns)
+                last = min(floor((max_lon + pi) / (2 * pi) * columns), first + columns - 1)
+                overlapped.update(column % columns for column in range(first, last + 1))
+
+            for column in overlapped:
+                yield from cells.get(column, ())
+
+    def within_radius(self, lat_lon, radius):
+        """
+        Return the (stop, distance) pairs of the stops within radius meters of
+        lat_lon, nearest first.
+        """
+
+        d = radius / LatLon.EARTH_RADIUS_M
+        if cos(lat_lon.lat) <= sin(d):
+            lon_ranges = [(-pi, pi)]  # The circle contains a pole
+        else:
+            # Widest longitude extent of the circle
+            d_lon = asin(sin(d) / cos(lat_lon.lat))
+            lon_ranges = [(lat_lon.lon - d_lon, lat_lon.lon + d_lon)]
+
+        found = []
+        for location, stop in self._candidates(lat_lon.lat - d, lat_lon.lat + d, lon_ranges):
+            distance = lat_lon.distance_to(location)
+            if distance <= radius:
+                found.append((stop, distance))
+
+        found.sort(key=lambda pair: pair[1])
+        return found
+
+    def nearest(self, lat_lon, k=1):
+        """
+        Return the (stop, distance) pairs of the k stops nearest to lat_lon,
+        nearest first.
+        """
+
+        k = min(k, self._count)
+        radius = self.cell_size
+        while True:
+            found = self.within_radius(lat_lon, radius)
+            # Stops beyond the radius cannot be nearer than those found within
+            if len(found) >= k or radius >= pi * LatLon.EARTH_RADIUS_M:
+                return found[:k]
+
+            radius *= 2
+
+    def in_bbox(self, south_west, north_east):
+        """
+        Return the stops within the box between two LatLon corners. The box
+        crosses the antimeridian if south_west is east of north_east.
+        """
+
+        if south_west.lon <= north_east.lon:
+            ranges = [(south_west.lon, north_east.lon)]
+        else:
+            ranges = [(south_west.lon, pi), (-pi, north_east.lon)]
+
+        def contains(location):
+            return south_west.lat <= location.lat <= north_east.lat and \
+                any(min_lon <= location.lon <= max_lon for min_lon, max_lon in ranges)
+
+        return [stop for location, stop in self._candidates(south_west.lat, north_east.lat, ranges)
+                if contains(location)]
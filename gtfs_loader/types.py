@@ -7,6 +7,19 @@ from typing import Any
 from .schema_classes import Schema, SchemaCollection
 
 
+# Times parsed from and formatted to strings so far, shared between the many
+# cells of a feed with the same time. Bounded, as they are never evicted.
+_PARSED_TIMES = {}
+_FORMATTED_TIMES = {}
+_MAX_CACHED_TIMES = 1 << 18
+
+# Dates parsed from and formatted to strings so far, as for times. Feeds span a
+# few hundred days, repeated over every row of calendar_dates.
+_PARSED_DATES = {}
+_FORMATTED_DATES = {}
+_MAX_CACHED_DATES = 1 << 16
+
+
 class GTFSTime(int):
     # GTFS allows times exceeding 23:59:59 as it is simpler to describe night
     # services that way in many cases. A trip could theoretically be shifted
@@ -17,31 +30,84 @@ class GTFSTime(int):
         if isinstance(time_str, int):
             return super().__new__(cls, time_str)
 
-        if time_str == '':
-            return super().__new__(cls, -1)
+        if cls is GTFSTime:
+            time = _PARSED_TIMES.get(time_str)
+            if time is not None:
+                return time
 
-        h, m, s = time_str.split(':')
+        time = super().__new__(cls, GTFSTime._parse_seconds(time_str))
+        if cls is GTFSTime and len(_PARSED_TIMES) < _MAX_CACHED_TIMES:
+            _PARSED_TIMES[time_str] = time
 
-        if int(h) > GTFSTime.MAX_HOUR_REPRESENTATION:
+        return time
+
+    @staticmethod
+    def _parse_seconds(time_str):
+        if time_str == '':
+            return -1
+
+        # Fixed-width HH:MM:SS, as written by almost all feeds
+        if len(time_str) == 8 and time_str[2] == ':' and time_str[5] == ':':
+            h = int(time_str[:2])
+            m = int(time_str[3:5])
+            s = int(time_str[6:])
+        else:
+            h, m, s = time_str.split(':')
+            h, m, s = int(h), int(m), int(s)
+
+        if h > GTFSTime.MAX_HOUR_REPRESENTATION:
             raise ValueError(
                 f'Refusing to consider a service day longer than {GTFSTime.MAX_HOUR_REPRESENTATION} hours'
             )
 
-        return super().__new__(cls, 3600 * int(h) + 60 * int(m) + int(s))
+        return 3600 * h + 60 * m + s
 
     def __str__(self):
+        # Also called on plain ints by columnar storage
+        time_str = _FORMATTED_TIMES.get(self)
+        if time_str is not None:
+            return time_str
+
         if self == -1:
-            return ''
+            time_str = ''
+        else:
+            hours, rem = divmod(int(self), 3600)
+            mins, secs = divmod(rem, 60)
+            time_str = '%02d:%02d:%02d' % (hours, mins, secs)
+
+        if len(_FORMATTED_TIMES) < _MAX_CACHED_TIMES:
+            _FORMATTED_TIMES[int(self)] = time_str
 
-        hours, rem = divmod(self, 3600)
-        mins, secs = divmod(rem, 60)
-        return '%02d:%02d:%02d' % (hours, mins, secs)
+        return time_str
 
     def __add__(self, other):
-        return GTFSTime(super().__add__(other))
+        result = int.__add__(self, other)
+        return result if result is NotImplemented else int.__new__(GTFSTime, result)
 
     def __sub__(self, other):
-        return GTFSTime(super().__sub__(other))
+        result = int.__sub__(self, other)
+        return result if result is NotImplemented else int.__new__(GTFSTime, result)
+
+
+def parse_time(time_str):
+    """
+    Return the GTFSTime of a string, as GTFSTime(time_str) does, skipping the
+    class call for times already seen.
+    """
+
+    time = _PARSED_TIMES.get(time_str)
+    return time if time is not None else GTFSTime(time_str)
+
+
+def parse_date(date_str):
+    """
+    Return the GTFSDate of a string, as GTFSDate(date_str) does, skipping the
+    class call for dates already seen.
+    """
+
+    date = _PARSED_DATES.get(date_str)
+    return date if date is not None else GTFSDate(date_str)
+
 
 class GTFSDate(datetime):
 
@@ -56,15 +122,47 @@ class GTFSDate(datetime):
                                    month=iso_str.month,
                                    day=iso_str.day)
 
+        if cls is GTFSDate:
+            date = _PARSED_DATES.get(iso_str)
+            if date is not None:
+                return date
+
         if not iso_str:
             raise ValueError('Invalid date: empty')
+
+        date = cls._parse(iso_str)
+        if cls is GTFSDate and len(_PARSED_DATES) < _MAX_CACHED_DATES:
+            _PARSED_DATES[iso_str] = date
+
+        return date
+
+    @classmethod
+    def _parse(cls, iso_str):
+        # YYYYMMDD, as required by GTFS
+        if len(iso_str) == 8 and iso_str.isascii() and iso_str.isdigit():
+            try:
+                return super().__new__(cls, int(iso_str[:4]), int(iso_str[4:6]), int(iso_str[6:]))
+            except ValueError:
+                pass  # Invalid date, reported by strptime as before
+
         try:
             return cls.strptime(iso_str, '%Y-%m-%d')
         except ValueError:
             return cls.strptime(iso_str, '%Y%m%d')
 
+    def __reduce_ex__(self, protocol):
+        # The datetime implementation would pass a bytes state to __new__
+        return (self.__class__, (self.year, self.month, self.day, self.hour,
+                                 self.minute, self.second, self.microsecond))
+
     def __repr__(self):
-        return self.strftime('%Y%m%d')
+        date_str = _FORMATTED_DATES.get(self)
+        if date_str is None:
+            date_str = self.strftime('%Y%m%d')
+            if len(_FORMATTED_DATES) < _MAX_CACHED_DATES:
+                _FORMATTED_DATES[self] = date_str
+
+        return date_str
 
     def __str__(self):
         return repr(self)
@@ -76,34 +174,181 @@ class EntityDict(dict):
         super().__init__(values if values else [])
         self._resolved_fields = fields
 
+        # Incremented on every change to the entities of the file, including
+        # field writes on the entities themselves (see mark_modified)
+        self._version = 0
+        self._unmodified_state = None
+
+        # Whether only some of the columns of the file were loaded, see load(columns=...)
+        self._projected = False
+
+    def mark_unmodified(self):
+        """
+        Consider the current entities as those of the input file.
+        """
+
+        self._unmodified_state = self._version, self._count()
+
+    def mark_modified(self):
+        """
+        Record a change that is not detected otherwise, see is_modified().
+        """
+
+        self._version += 1
+
+    def is_modified(self):
+        """
+        Return whether the entities changed since mark_unmodified(): entities
+        added, replaced or removed through the dict, and field writes on the
+        entities.
+
+        The lists of grouped entities (e.g. the stop times of a trip) are
+        plain lists, so changes made to them in place are not tracked. Only
+        those changing the number of entities are detected; others, such as
+        replacing an entity (stop_times[i] = stop_time) or reordering the
+        list, are not. Assign the list again (gtfs.stop_times[trip_id] =
+        stop_times) or call mark_modified() after such changes.
+        """
+
+        return self._unmodified_state != (self._version, self._count())
+
+    def _count(self):
+        return sum(1 if isinstance(value, Entity) else len(value) for value in super().values())
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._version += 1
+
+    def pop(self, *args):
+        self._version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self._version += 1
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._version += 1
+
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._version += 1
+
+    def __ior__(self, other):
+        super().__ior__(other)
+        self._version += 1
+        return self
+
+    def clear(self):
+        super().clear()
+        self._version += 1
+
+
+def mark_modified(gtfs, name):
+    """
+    Record a change to an entity of the file stored as gtfs.<name>.
+    """
+
+    if gtfs is None:
+        return
+
+    entities = gtfs.__dict__.get(name)
+    if isinstance(entities, EntityDict):
+        entities._version += 1
+
 
 class Entity:
 
     def __init__(self, **kwargs):
-        self._gtfs = None
-        default_init = {
-            k: v
-            for k, v in self.__class__.__dict__.items()
-            if Entity._is_field(k, v)
-        }
-        self.__dict__.update(default_init)
+        self.__dict__['_gtfs'] = None
+        self.__dict__.update(self.__class__._default_fields())
         self.__dict__.update(kwargs)
 
+    @classmethod
+    def _default_fields(cls):
+        # Computed once per class, the class dict is not expected to change
+        defaults = cls.__dict__.get('_defaults')
+        if defaults is None:
+            defaults = {
+                k: v
+                for k, v in cls.__dict__.items()
+                if Entity._is_field(k, v)
+            }
+            cls._defaults = defaults
+
+        return defaults
+
     @staticmethod
     def _is_field(k, v):
-        if callable(v) or isinstance(v, functools.cached_property):
+        if callable(v) or isinstance(v, (functools.cached_property, property)):
             return False
 
         return not k.startswith('_')
 
+    @classmethod
+    def _compact_class(cls):
+        """
+        Return a subclass of this class storing its fields in __slots__.
+        """
+
+        if issubclass(cls, CompactEntity):
+            return cls
+
+        compact = cls.__dict__.get('_compact_def')
+        if compact is None:
+            compact = cls._compact_def = _make_compact_class(cls)
+
+        return compact
+
+    @classmethod
+    def _row_factory(cls, names):
+        """
+        Return a function creating an entity from the values of the given
+        columns, as read by the loader.
+        """
+
+        def create(gtfs, values):
+            entity = cls()
+            entity.__dict__['_gtfs'] = gtfs
+            entity.__dict__.update(zip(names, values))
+            return entity
+
+        return create
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            self._mark_modified()
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        if not name.startswith('_'):
+            self._mark_modified()
+
+    def _mark_modified(self):
+        gtfs = getattr(self, '_gtfs', None)
+        if gtfs is not None:
+            mark_modified(gtfs, self._schema.name)
+
     def __getitem__(self, item):
         return self.__dict__[item]
 
     def __setitem__(self, key, value):
         self.__dict__[key] = value
+        if not key.startswith('_'):
+            self._mark_modified()
 
     def __delitem__(self, key):
         del self.__dict__[key]
+        if not key.startswith('_'):
+            self._mark_modified()
 
     def keys(self):
         return self.__dict__.keys()
@@ -119,18 +364,151 @@ class Entity:
 
     def __repr__(self):
         filtered_dict = {
-            k: v for k, v in self.__dict__.items() if k not in {'_gtfs'}
+            k: v for k, v in self.items() if k not in {'_gtfs'}
         }
         return f'{self.__class__.__name__} {repr(filtered_dict)}'
 
+    def _asdict(self):
+        """
+        Return the fields of the entity as a new dict. Use it rather than
+        vars(entity) or entity.__dict__, which do not hold the fields of
+        compact entities (see CompactEntity).
+        """
+
+        return {k: v for k, v in self.items() if k != '_gtfs'}
+
     def clone(self, **overrides):
         merged = {
-            k: v for k, v in self.__dict__.items() if Entity._is_field(k, v)
+            k: v for k, v in self.items() if Entity._is_field(k, v)
         }
         merged.update(overrides)
         return self.__class__(**merged)
 
 
+class CompactEntity(Entity):
+    """
+    Base of the classes generated by Entity._compact_class(). Declared fields
+    live in __slots__; other keys (unknown columns, cached properties) still go
+    to the instance __dict__, which is only allocated when first needed. As a
+    result vars(entity) and entity.__dict__ only hold those other keys: use
+    items() or _asdict() to get all fields.
+    """
+
+    __slots__ = ()
+
+    # Set on each generated class
+    _fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, **kwargs):
+        self._gtfs = None
+        for k, v in self._defaults.items():
+            setattr(self, k, v)
+
+        for k, v in kwargs.items():
+            self[k] = v
+
+    @classmethod
+    def _row_factory(cls, names):
+        new = object.__new__
+        set_gtfs = cls.__dict__['_gtfs'].__set__
+        setters = [cls._setter(name) for name in names]
+        missing_defaults = [(cls._setter(k), v) for k, v in cls._defaults.items() if k not in names]
+        header_defaults = [(cls._setter(name), cls._defaults[name]) if name in cls._defaults else None
+                           for name in names]
+        width = len(names)
+
+        def create(gtfs, values):
+            entity = new(cls)
+            set_gtfs(entity, gtfs)
+            for setter, default in missing_defaults:
+                setter(entity, default)
+
+            for setter, value in zip(setters, values):
+                setter(entity, value)
+
+            # Short rows keep the class defaults, as with regular entities
+            if len(values) < width:
+                for header_default in header_defaults[len(values):]:
+                    if header_default:
+                        header_default[0](entity, header_default[1])
+
+            return entity
+
+        return create
+
+    @classmethod
+    def _setter(cls, name):
+        if name in cls._field_set:
+            return cls.__dict__[name].__set__
+
+        return lambda entity, value: entity.__dict__.__setitem__(name, value)
+
+    def __getitem__(self, item):
+        if item in self._field_set:
+            try:
+                return getattr(self, item)
+            except AttributeError:
+                raise KeyError(item) from None
+
+        return self.__dict__[item]
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            super().__delitem__(key)
+
+    def _iter_items(self):
+        yield '_gtfs', self._gtfs
+        for name in self._fields:
+            try:
+                yield name, getattr(self, name)
+            except AttributeError:
+                pass  # Required field that was never set
+
+        yield from self.__dict__.items()
+
+    def keys(self):
+        return [k for k, _ in self._iter_items()]
+
+    def values(self):
+        return [v for _, v in self._iter_items()]
+
+    def items(self):
+        return list(self._iter_items())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def _make_compact_class(cls):
+    defaults = cls._default_fields()
+    fields = tuple(dict.fromkeys([*cls.__annotations__, *defaults]))
+    namespace = {
+        '__slots__': ('_gtfs', *fields),
+        '__module__': cls.__module__,
+        # Lets pickle find the generated class through its parent
+        '__qualname__': f'{cls.__qualname__}._compact_def',
+        '_fields': fields,
+        '_field_set': frozenset(fields),
+        '_defaults': defaults,
+    }
+    return type(cls.__name__, (cls, CompactEntity), namespace)
+
+
 @functools.singledispatch
 def serialize(value: Any):
     if isinstance(value, list):
@@ -139,6 +517,29 @@ def serialize(value: Any):
     return str(value)
 
 
+serialize.register(GTFSTime, GTFSTime.__str__)
+serialize.register(GTFSDate, GTFSDate.__str__)
+
+
+def value_serializer():
+    """
+    Return a function equivalent to serialize() for writing many values,
+    resolving the registered implementation once per value type rather than
+    through the dispatch of every call.
+    """
+
+    implementations = {}
+
+    def serialize_value(value):
+        implementation = implementations.get(value.__class__)
+        if implementation is None:
+            implementation = implementations[value.__class__] = serialize.dispatch(value.__class__)
+
+        return implementation(value)
+
+    return serialize_value
+
+
 @serialize.register
 def _(value: enum.IntEnum):
     return str(int(value))
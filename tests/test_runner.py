@@ -1,22 +1,678 @@
+import operator
+import os
 import pytest
+import random
+import shutil
+import zipfile
+import zstandard
 import gtfs_loader
-from gtfs_loader import test_support
+from datetime import date, timedelta
+from gtfs_loader import (columnar, indexes, parallel, schema, service_calendar, shapes, snapshot, spatial, test_support,
+                         types)
+from gtfs_loader.itineraries import from_itineraries, to_itineraries
+from gtfs_loader.lat_lon import LatLon
+from gtfs_loader.schema_classes import FileType
 
 
 test_support.init(__file__)
 
 
+@pytest.fixture(params=test_support.find_tests(), ids=lambda test_dir: test_dir.name)
+def feed_dir(request):
+    return request.param
+
+
+@pytest.fixture
+def work_dir(feed_dir):
+    # Removed after the test, whether or not it checked the expected output
+    work_dir = test_support.create_test_data(feed_dir)
+    yield work_dir
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def parallel_test_feeds(monkeypatch):
+    # Parse the small test feeds in workers, whatever the number of cores
+    monkeypatch.setattr(parallel, 'CPU_COUNT', max(parallel.CPU_COUNT, 2))
+    monkeypatch.setattr(parallel, 'MIN_FILE_SIZE', 0)
+
+
+def test_default(feed_dir, work_dir):
+    do_test(feed_dir, work_dir)
+
+
+def test_columnar(feed_dir, work_dir):
+    do_test(feed_dir, work_dir, columnar=True)
+
+
+def test_columnar_groups(feed_dir, work_dir, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+    grouped_name = 'itinerary_cells' if itineraries else 'stop_times'
+    file_schema = schema.ItineraryCell._schema if itineraries else schema.StopTime._schema
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, columnar=True)
+    entities = gtfs[grouped_name]
+    key, group = next((key, group) for key, group in entities.items() if len(group) > 1)
+    expected = list(map(fields_of, group))
+
+    # Sorted by the group field without a key
+    group.sort(key=operator.attrgetter(file_schema.group_id), reverse=True)
+    assert list(map(fields_of, group)) == expected[::-1]
+    group.sort()
+    assert list(map(fields_of, group)) == expected
+
+    # Lists are stored as groups however they are assigned
+    def copies(copy_key):
+        return [file_schema.class_def(**{**fields, file_schema.id: copy_key}) for fields in expected]
+
+    entities.update({'updated': copies('updated')})
+    entities.setdefault('set_default', copies('set_default'))
+    entities |= {'merged': copies('merged')}
+
+    gtfs_loader.patch(gtfs, work_dir, tmp_path, verbose=False, itineraries=itineraries)
+    reloaded = gtfs_loader.load(tmp_path, verbose=False, itineraries=itineraries)
+    for copy_key in ('updated', 'set_default', 'merged'):
+        assert isinstance(entities[copy_key], columnar.ColumnarGroup)
+        assert entities_of(reloaded[grouped_name])[copy_key] == list(map(fields_of, copies(copy_key)))
+
+    # Views are created on each access, the same row comparing equal
+    assert group[0] == group[0] and group[0] != group[1]
+    assert group[0] in set(group)
+
+    # Rows of replaced groups are dropped once they outnumber the others
+    replaced = entities[key]
+    contents = {group_key: list(map(fields_of, group)) for group_key, group in entities.items()}
+    rows = len(entities._table)
+    for _ in range(rows // len(expected) + 1):
+        entities[key] = copies(key)
+    assert len(entities._table) <= rows + len(expected)
+    assert list(map(fields_of, replaced)) == expected
+    assert {group_key: list(map(fields_of, group)) for group_key, group in entities.items()} == \
+        {**contents, key: list(map(fields_of, copies(key)))}
+
+
+def test_parallel(feed_dir, work_dir, monkeypatch):
+    # Small enough for the test feeds to be split in several chunks
+    monkeypatch.setattr(parallel, 'CHUNK_SIZE', 64)
+    do_test(feed_dir, work_dir, workers=2)
+
+
+@pytest.mark.parametrize('cpu_count, min_file_size', [(2, 1024 * 1024), (1, 0)], ids=['small_files', 'single_core'])
+def test_parallel_fallback(feed_dir, work_dir, cpu_count, min_file_size, monkeypatch):
+    monkeypatch.setattr(parallel, 'CPU_COUNT', cpu_count)
+    monkeypatch.setattr(parallel, 'MIN_FILE_SIZE', min_file_size)
+    submitted = []
+    monkeypatch.setattr(parallel, '_submit', lambda *args, submit=parallel._submit, **kwargs:
+                        submitted.append(submit(*args, **kwargs)) or submitted[-1])
+
+    # Small files are parsed in the main process, and everything on a single core
+    do_test(feed_dir, work_dir, workers=2)
+    assert bool(submitted) == (cpu_count > 1) and not any(submitted)
+
+
+def test_snapshot(feed_dir, work_dir, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    gtfs_loader.save_snapshot(gtfs, tmp_path / 'feed.snapshot')
+    gtfs = gtfs_loader.load_snapshot(tmp_path / 'feed.snapshot')
+    gtfs_loader.patch(gtfs, work_dir, work_dir, verbose=False, itineraries=itineraries)
+    test_support.check_expected_output(feed_dir, work_dir)
+
+
 @pytest.mark.parametrize('feed_dir',
-                         test_support.find_tests(),
+                         [test_dir for test_dir in test_support.find_tests() if 'itineraries' in test_dir.name],
                          ids=lambda test_dir: test_dir.name)
-def test_default(feed_dir):
-    do_test(feed_dir)
+def test_snapshot_list_of_times(work_dir, tmp_path):
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=True)
 
+    # GTFSTime values in a list field, which marshal cannot store as they are
+    trip = next(iter(gtfs.trips.values()))
+    trip.departure_times = list(map(types.GTFSTime, trip.departure_times))
+    gtfs_loader.save_snapshot(gtfs, tmp_path / 'feed.snapshot')
+    gtfs = gtfs_loader.load_snapshot(tmp_path / 'feed.snapshot')
 
-def do_test(feed_dir):
+    departure_times = gtfs.trips[trip.trip_id].departure_times
+    assert departure_times == trip.departure_times
+    assert all(type(time) is types.GTFSTime for time in departure_times)
+
+
+def test_cache_dir(feed_dir, work_dir, tmp_path, monkeypatch):
     itineraries = 'itineraries' in feed_dir.name
-    work_dir = test_support.create_test_data(feed_dir)
+    cache_dir = tmp_path / 'cache'
 
+    loads = []
+    monkeypatch.setattr(gtfs_loader, 'load_file', lambda *args, load_file=gtfs_loader.load_file, **kwargs:
+                        loads.append(args[2].name) or load_file(*args, **kwargs))
+    hashes = []
+    monkeypatch.setattr(snapshot, '_hash_file', lambda filepath, hash_file=snapshot._hash_file:
+                        hashes.append(filepath.name) or hash_file(filepath))
+
+    def load():
+        loads.clear()
+        hashes.clear()
+        return gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, cache_dir=cache_dir)
+
+    expected = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    load()
+    assert loads and len(list(cache_dir.iterdir())) == 1
+
+    # Hit
+    gtfs = load()
+    assert not loads and not hashes
+    assert entities_of(gtfs.trips) == entities_of(expected.trips)
+
+    # Touched without changes: hashed once, then recorded with its new modification time
+    trips_path = work_dir / 'trips.txt'
+    stat = trips_path.stat()
+    os.utime(trips_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    load()
+    assert not loads and hashes == ['trips.txt']
+    load()
+    assert not loads and not hashes
+
+    # Stale after an edit, then rebuilt
+    trips_path.write_bytes(trips_path.read_bytes().replace(b'\n', b'\r\n'))
+    os.utime(trips_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    gtfs = load()
+    assert loads
+    assert entities_of(gtfs.trips) == entities_of(expected.trips)
+    load()
+    assert not loads and len(list(cache_dir.iterdir())) == 1
+
+
+def test_iter_file(feed_dir, work_dir):
+    itineraries = 'itineraries' in feed_dir.name
     gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+
+    collection = schema.GTFS_SUBSET_SCHEMA_ITINERARIES if itineraries else schema.GTFS_SUBSET_SCHEMA
+    for file_schema in collection.values():
+        entities = gtfs[file_schema.name]
+        if file_schema.fileType is not FileType.CSV:
+            continue
+
+        if file_schema.group_id:
+            streamed = dict(gtfs_loader.iter_file(work_dir, file_schema.name, grouped=True, itineraries=itineraries))
+            assert streamed.keys() == entities.keys()
+            for key, group in entities.items():
+                assert list(map(fields_of, streamed[key])) == list(map(fields_of, group))
+        else:
+            chunks = list(gtfs_loader.iter_file(work_dir, file_schema.name, chunk_size=2, itineraries=itineraries))
+            assert all(len(chunk) <= 2 for chunk in chunks)
+            assert [fields_of(entity) for chunk in chunks for entity in chunk] == \
+                list(map(fields_of, entities.values()))
+
+
+def test_transform(feed_dir, work_dir):
+    itineraries = 'itineraries' in feed_dir.name
+
+    collection = schema.GTFS_SUBSET_SCHEMA_ITINERARIES if itineraries else schema.GTFS_SUBSET_SCHEMA
+    callbacks = {file_schema.name: lambda entity: entity
+                 for file_schema in collection.values() if file_schema.fileType is FileType.CSV}
+    gtfs_loader.transform(work_dir, work_dir, callbacks, verbose=False, itineraries=itineraries)
+    test_support.check_expected_output(feed_dir, work_dir)
+
+
+def test_transform_compressed_in_place(feed_dir, work_dir):
+    itineraries = 'itineraries' in feed_dir.name
+    original = {filename.name: filename.read_bytes() for filename in work_dir.iterdir()}
+
+    # Only trips are transformed, other files being compressed while copied over themselves
+    gtfs_loader.transform(work_dir, work_dir, {'trips': lambda entity: entity}, verbose=False,
+                          itineraries=itineraries, export_compressed=True)
+
+    assert {filename.name for filename in work_dir.iterdir()} == set(original)
+    for name, content in original.items():
+        if name != 'trips.txt':
+            assert zstandard.ZstdDecompressor().stream_reader((work_dir / name).read_bytes()).read() == content
+
+
+def test_only_modified(feed_dir, work_dir, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    gtfs.agency['GT'].agency_name = 'Renamed'
+    gtfs_loader.patch(gtfs, work_dir, tmp_path, verbose=False, itineraries=itineraries, only_modified=True)
+
+    for filename in work_dir.iterdir():
+        unchanged = (tmp_path / filename.name).read_bytes() == filename.read_bytes()
+        assert unchanged == (filename.name != 'agency.txt')
+
+    # Changes through |= and explicitly recorded changes
+    gtfs_loader.mark_unmodified(gtfs)
+    routes = gtfs.routes
+    routes |= {route_id: route for route_id, route in routes.items()}
+    assert routes.is_modified()
+
+    gtfs_loader.mark_unmodified(gtfs)
+    grouped = gtfs.itinerary_cells if itineraries else gtfs.stop_times
+    group = next(iter(grouped.values()))
+    group[0] = group[0]
+    assert not grouped.is_modified()
+    grouped.mark_modified()
+    assert grouped.is_modified()
+
+
+def test_lazy(feed_dir, work_dir, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+
+    loaded = []
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, lazy=True,
+                            on_file_loaded=lambda name, seconds: loaded.append(name))
+    trip = next(iter(gtfs.trips.values()))
+    assert trip.route is gtfs.routes[trip.route_id]
+    assert loaded == ['trips', 'routes']
+    assert list(map(fields_of, gtfs.stops.values())) == \
+        list(map(fields_of, gtfs_loader.load(work_dir, verbose=False, files=['stops']).stops.values()))
+
+    # Patched like an eager feed, whichever files were accessed
+    gtfs_loader.patch(gtfs, work_dir, tmp_path / 'lazy', verbose=False, itineraries=itineraries)
+    eager = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    gtfs_loader.patch(eager, work_dir, tmp_path / 'eager', verbose=False, itineraries=itineraries)
+    for filename in (tmp_path / 'eager').iterdir():
+        assert (tmp_path / 'lazy' / filename.name).read_bytes() == filename.read_bytes()
+
+    # Files never accessed are not modified, so only_modified copies them
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, lazy=True)
+    gtfs_loader.patch(gtfs, work_dir, tmp_path / 'only_modified', verbose=False, itineraries=itineraries,
+                      only_modified=True)
+    for filename in work_dir.iterdir():
+        assert (tmp_path / 'only_modified' / filename.name).read_bytes() == filename.read_bytes()
+
+
+def test_stop_index(feed_dir, work_dir):
+    itineraries = 'itineraries' in feed_dir.name
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+
+    for stop in gtfs.stops.values():
+        expected = sorted(stop.location.distance_to(other.location) for other in gtfs.stops.values())[:3]
+        assert [distance for _, distance in spatial.stop_index(gtfs).nearest(stop.location, k=3)] == expected
+
+    stop = next(iter(gtfs.stops.values()))
+    stop.stop_lat += 1
+    assert spatial.stop_index(gtfs).nearest(LatLon(stop.stop_lat, stop.stop_lon))[0][0] is stop
+
+
+def test_service_calendar(feed_dir, work_dir):
+    itineraries = 'itineraries' in feed_dir.name
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    calendar = service_calendar.service_calendar(gtfs)
+
+    weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+    for day in (date(2021, 3, 1) + timedelta(days=i) for i in range(7)):
+        expected = {service.service_id for service in gtfs.calendar.values() if service[weekdays[day.weekday()]]}
+        assert calendar.services_on(day) == expected
+        assert {trip.trip_id for trip in calendar.trips_on(day)} == \
+            {trip.trip_id for trip in gtfs.trips.values() if trip.service_id in expected}
+
+    assert not calendar.active_on('mon', date(2022, 1, 3))
+    gtfs.calendar['mon'].end_date = types.GTFSDate('20221231')
+    calendar.update_service('mon')
+    assert calendar.active_on('mon', date(2022, 1, 3))
+    assert service_calendar.service_calendar(gtfs) is calendar
+
+
+def test_indexes(feed_dir, work_dir):
+    itineraries = 'itineraries' in feed_dir.name
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    feed_indexes = indexes.indexes(gtfs).build()
+
+    for route_id in gtfs.routes:
+        assert feed_indexes.trips_on_route(route_id) == [trip for trip in gtfs.trips.values()
+                                                         if trip.route_id == route_id]
+
+    grouped = gtfs.itinerary_cells if itineraries else gtfs.stop_times
+    for stop_id in gtfs.stops:
+        assert feed_indexes.stop_times_at(stop_id) == [entity for group in grouped.values() for entity in group
+                                                       if entity.stop_id == stop_id]
+
+    trip = next(iter(gtfs.trips.values()))
+    stop_id = trip.first_stop_time.stop_id if not itineraries else trip.first_itinerary_cell.stop_id
+    gtfs_loader.clone(gtfs.trips, trip.trip_id, 'cloned')
+    if not itineraries:
+        gtfs_loader.clone(gtfs.stop_times, trip.trip_id, 'cloned')
+    assert gtfs.trips['cloned'] in feed_indexes.trips_on_route(trip.route_id)
+    assert gtfs.trips['cloned'] in feed_indexes.trips_at_stop(stop_id)
+
+    del gtfs.trips['cloned']
+    assert gtfs.trips.get('cloned') not in feed_indexes.trips_for_service(trip.service_id)
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_drop_unknown_columns(feed_dir, work_dir, workers, monkeypatch):
+    monkeypatch.setattr(parallel, 'CHUNK_SIZE', 64)
+    itineraries = 'itineraries' in feed_dir.name
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    dropped = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, workers=workers,
+                               drop_unknown_columns=True)
+
+    assert 'stop_name' not in fields_of(next(iter(dropped.stops.values())))
+    for stop_id, stop in gtfs.stops.items():
+        assert fields_of(dropped.stops[stop_id]) == {k: v for k, v in fields_of(stop).items() if k != 'stop_name'}
+    assert list(map(fields_of, dropped.trips.values())) == list(map(fields_of, gtfs.trips.values()))
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_columns(feed_dir, work_dir, workers, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    projected = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, workers=workers,
+                                 columns={'stops': ['stop_lat']})
+
+    for stop_id, stop in gtfs.stops.items():
+        assert fields_of(projected.stops[stop_id]) == {'stop_id': stop_id, 'stop_lat': stop.stop_lat, 'stop_lon': None}
+    assert list(map(fields_of, projected.trips.values())) == list(map(fields_of, gtfs.trips.values()))
+
+    with pytest.raises(ValueError):
+        gtfs_loader.patch(projected, work_dir, tmp_path / 'refused', verbose=False, itineraries=itineraries)
+    assert not (tmp_path / 'refused').exists()
+
+    gtfs_loader.save_snapshot(projected, tmp_path / 'feed.snapshot')
+    projected = gtfs_loader.load_snapshot(tmp_path / 'feed.snapshot')
+    with pytest.raises(ValueError):
+        gtfs_loader.patch(projected, work_dir, tmp_path, verbose=False, itineraries=itineraries)
+    gtfs_loader.patch(projected, work_dir, tmp_path, verbose=False, itineraries=itineraries, allow_projected=True)
+    assert (tmp_path / 'stops.txt').read_text().startswith('stop_id,stop_lat,stop_lon\n')
+
+    with pytest.raises(ValueError, match='unknown column'):
+        gtfs_loader.load(work_dir, verbose=False, files=['stops'], columns={'stops': ['unknown']})
+
+
+@pytest.mark.parametrize('load_options', [{}, {'workers': 2}, {'columnar': True}], ids=['default', 'parallel', 'columnar'])
+def test_where(feed_dir, work_dir, load_options):
+    itineraries = 'itineraries' in feed_dir.name
+    grouped_name = 'itinerary_cells' if itineraries else 'stop_times'
+    group_key = 'itinerary_index' if itineraries else 'trip_id'
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    filtered = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, **load_options,
+                                where={'routes': lambda route: route.route_id == 'red'}, cascade=True)
+
+    assert list(filtered.routes) == ['red']
+    assert list(filtered.trips) == [trip_id for trip_id, trip in gtfs.trips.items() if trip.route_id == 'red']
+    assert set(filtered[grouped_name]) == {trip[group_key] for trip in filtered.trips.values()}
+    assert filtered.routes.is_modified() and filtered[grouped_name].is_modified()
+    assert not filtered.stops.is_modified()
+
+    filtered = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, **load_options,
+                                where={'routes': lambda route: route.route_id == 'red'})
+    assert list(filtered.trips) == list(gtfs.trips)
+    assert not filtered.trips.is_modified()
+
+
+def test_compression(feed_dir, work_dir, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+    grouped_name = 'itinerary_cells' if itineraries else 'stop_times'
+
+    dictionary = gtfs_loader.train_zstd_dictionary(
+        [work_dir / f'{grouped_name}.txt'] * 50, dict_size=4096, sample_size=256)
+    compression = {'level': 19, 'threads': 2, 'long_distance_matching': True,
+                   'dictionaries': {grouped_name: dictionary}}
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    gtfs_loader.patch(gtfs, work_dir, tmp_path, verbose=False, itineraries=itineraries, export_compressed=True,
+                      compression=compression)
+    with open(tmp_path / f'{grouped_name}.txt', 'rb') as f:
+        assert gtfs_loader.check_if_file_zstd_compressed(f)
+
+    with pytest.raises(zstandard.ZstdError):
+        gtfs_loader.load(tmp_path, verbose=False, itineraries=itineraries)
+
+    reloaded = gtfs_loader.load(tmp_path, verbose=False, itineraries=itineraries, compression=compression)
+    assert {key: list(map(fields_of, group)) for key, group in reloaded[grouped_name].items()} == \
+        {key: list(map(fields_of, group)) for key, group in gtfs[grouped_name].items()}
+
+    # The same with a zip archive, its files being compressed with the dictionary
+    gtfs_loader.patch(gtfs, work_dir, tmp_path / 'feed.zip', verbose=False, itineraries=itineraries,
+                      export_compressed=True, compression=compression)
+    reloaded = gtfs_loader.load(tmp_path / 'feed.zip', verbose=False, itineraries=itineraries,
+                                compression=compression)
+    assert {key: list(map(fields_of, group)) for key, group in reloaded[grouped_name].items()} == \
+        {key: list(map(fields_of, group)) for key, group in gtfs[grouped_name].items()}
+
+    # Files copied by transform() are compressed with the same settings
+    gtfs_loader.transform(work_dir, tmp_path / 'transformed', {'trips': lambda entity: entity}, verbose=False,
+                          itineraries=itineraries, export_compressed=True, compression=compression)
+    with pytest.raises(zstandard.ZstdError):
+        gtfs_loader.load(tmp_path / 'transformed', verbose=False, itineraries=itineraries)
+
+    reloaded = gtfs_loader.load(tmp_path / 'transformed', verbose=False, itineraries=itineraries,
+                                compression=compression)
+    assert {key: list(map(fields_of, group)) for key, group in reloaded[grouped_name].items()} == \
+        {key: list(map(fields_of, group)) for key, group in gtfs[grouped_name].items()}
+
+    with pytest.raises(ValueError):
+        gtfs_loader.patch(gtfs, work_dir, tmp_path, verbose=False, compression={'levle': 3})
+
+
+@pytest.mark.parametrize('load_options', [{}, {'workers': 2}, {'lazy': True}], ids=['default', 'parallel', 'lazy'])
+@pytest.mark.parametrize('folder', ['', 'gtfs/'], ids=['root', 'folder'])
+def test_zip(feed_dir, work_dir, load_options, folder, tmp_path, monkeypatch):
+    itineraries = 'itineraries' in feed_dir.name
+
+    with zipfile.ZipFile(tmp_path / 'feed.zip', 'w', compression=zipfile.ZIP_DEFLATED) as feed_zip:
+        for filename in work_dir.iterdir():
+            feed_zip.write(filename, folder + filename.name)
+
+    opened = []
+
+    class TrackedZipFile(zipfile.ZipFile):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            opened.append(self)
+
+    monkeypatch.setattr(zipfile, 'ZipFile', TrackedZipFile)
+    gtfs = gtfs_loader.load(tmp_path / 'feed.zip', verbose=False, itineraries=itineraries, **load_options)
+    gtfs.agency['GT'].agency_name = 'Renamed'
+    gtfs_loader.patch(gtfs, tmp_path / 'feed.zip', tmp_path / 'feed.zip', verbose=False, itineraries=itineraries)
+
+    # Archives are closed once read or written
+    assert opened and all(archive_file.fp is None for archive_file in opened)
+
+    # Patch the same way in the directory to compare the outputs
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, **load_options)
+    gtfs.agency['GT'].agency_name = 'Renamed'
+    gtfs_loader.patch(gtfs, work_dir, work_dir, verbose=False, itineraries=itineraries)
+
+    with zipfile.ZipFile(tmp_path / 'feed.zip') as feed_zip:
+        assert sorted(feed_zip.namelist()) == sorted(filename.name for filename in work_dir.iterdir())
+        for filename in work_dir.iterdir():
+            assert feed_zip.read(filename.name) == filename.read_bytes()
+
+
+@pytest.mark.parametrize('load_options', [{}, {'columnar': True}], ids=['default', 'columnar'])
+def test_sorted_read(feed_dir, work_dir, load_options):
+    itineraries = 'itineraries' in feed_dir.name
+    grouped_name = 'itinerary_cells' if itineraries else 'stop_times'
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, sorted_read=True, **load_options)
+    expected = {key: list(map(fields_of, group)) for key, group in gtfs[grouped_name].items()}
+    assert list(expected) == sorted(expected)
+
+    # Rows in reverse order, as the input already sorted is not sorted again
+    filepath = work_dir / f'{grouped_name}.txt'
+    header, *lines = filepath.read_text().splitlines(keepends=True)
+    filepath.write_text(header + ''.join(reversed(lines)))
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, sorted_read=True, **load_options)
+    assert list(gtfs[grouped_name]) == list(expected)
+    assert {key: list(map(fields_of, group)) for key, group in gtfs[grouped_name].items()} == expected
+
+
+@pytest.mark.parametrize('sorted_read', [False, True], ids=['unsorted', 'sorted'])
+def test_missing_key(sorted_read, tmp_path):
+    (tmp_path / 'stop_times.txt').write_text('stop_id,arrival_time,departure_time,trip_id,stop_sequence\n'
+                                             's1,08:00:00,08:00:00,t1,1\n'
+                                             's2,08:05:00,08:05:00\n')
+
+    with pytest.raises(KeyError, match='trip_id'):
+        gtfs_loader.load(tmp_path, verbose=False, files=['stop_times'], sorted_read=sorted_read)
+
+    # Created without their stop_sequence
+    stop_times = [schema.StopTime(trip_id='t1', stop_id='s1'), schema.StopTime(trip_id='t1', stop_id='s2')]
+    with pytest.raises(KeyError, match='stop_sequence'):
+        gtfs_loader.sorted_entities(schema.StopTime._schema, {'t1': stop_times})
+
+
+def test_asdict(tmp_path):
+    (tmp_path / 'stops.txt').write_text('stop_id,stop_lat,stop_lon,extra\n'
+                                        's1,45.5,-73.5,value\n')
+
+    gtfs = gtfs_loader.load(tmp_path, verbose=False, files=['stops'])
+    stop = gtfs.stops['s1']
+    fields = stop._asdict()
+    assert fields == fields_of(stop)
+    assert fields['stop_lat'] == 45.5 and fields['extra'] == 'value'
+
+    # Declared fields of compact entities are not in their __dict__
+    assert 'stop_lat' not in vars(stop) and vars(stop)['extra'] == 'value'
+    assert schema.Stop(stop_id='s2')._asdict()['stop_id'] == 's2'
+
+
+@pytest.mark.parametrize('load_options', [{}, {'workers': 2}, {'columnar': True}], ids=['default', 'parallel', 'columnar'])
+def test_file_stats(feed_dir, work_dir, load_options, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+    grouped_name = 'itinerary_cells' if itineraries else 'stop_times'
+
+    loaded = []
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, on_file_stats=loaded.append,
+                            **load_options)
+    stats = {file_stats.name: file_stats for file_stats in loaded}
+    assert set(stats) == {name for name in gtfs.keys() if (work_dir / f'{name}.txt').exists()}
+
+    grouped_stats = stats[grouped_name]
+    assert grouped_stats.operation == 'load'
+    assert grouped_stats.rows == sum(map(len, gtfs[grouped_name].values()))
+    assert grouped_stats.bytes_read == (work_dir / f'{grouped_name}.txt').stat().st_size
+    assert set(grouped_stats.timings) >= ({'parse', 'convert', 'index'} if load_options.get('workers')
+                                          else {'read', 'tokenize', 'convert', 'index'})
+    assert all(seconds >= 0 for seconds in grouped_stats.timings.values())
+    assert sum(grouped_stats.timings.values()) <= grouped_stats.seconds
+
+    written = []
+    gtfs_loader.patch(gtfs, work_dir, tmp_path, verbose=False, itineraries=itineraries,
+                      on_file_stats=written.append)
+    stats = {file_stats.name: file_stats for file_stats in written}
+    assert set(stats) == {filepath.name.split('.', 1)[0] for filepath in tmp_path.iterdir()}
+    assert stats[grouped_name].rows == grouped_stats.rows
+    assert stats[grouped_name].bytes_written == (tmp_path / f'{grouped_name}.txt').stat().st_size
+    assert set(stats[grouped_name].timings) == {'serialize', 'write'}
+
+
+def test_itinerary_conversion(feed_dir, work_dir, tmp_path):
+    itineraries = 'itineraries' in feed_dir.name
+    forward, backward = ((from_itineraries, to_itineraries) if itineraries
+                         else (to_itineraries, from_itineraries))
+
+    forward(work_dir, tmp_path / 'converted', verbose=False)
+    backward(tmp_path / 'converted', tmp_path / 'round_trip', verbose=False)
+    original = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries)
+    converted = gtfs_loader.load(tmp_path / 'converted', verbose=False, itineraries=not itineraries)
+    round_trip = gtfs_loader.load(tmp_path / 'round_trip', verbose=False, itineraries=itineraries)
+
+    default, itinerary = (converted, original) if itineraries else (original, converted)
+    assert len(itinerary.itinerary_cells) <= len(itinerary.trips) == len(default.trips)
+    for trip_id, stop_times in default.stop_times.items():
+        trip = itinerary.trips[trip_id]
+        cells = itinerary.itinerary_cells[trip.itinerary_index]
+        assert [stop_time.departure_time for stop_time in stop_times] == trip.departure_times
+        assert [stop_time.arrival_time for stop_time in stop_times] == trip.arrival_times
+        assert [stop_time.stop_id for stop_time in stop_times] == [cell.stop_id for cell in cells]
+
+    assert entities_of(round_trip.trips, ignored={'itinerary_index'}) == \
+        entities_of(original.trips, ignored={'itinerary_index'})
+    if not itineraries:
+        assert entities_of(round_trip.stop_times) == entities_of(original.stop_times)
+
+
+def test_shapes(tmp_path):
+    (tmp_path / 'shapes.txt').write_text('shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n'
+                                         'a,49.0,-117.01,2\n'
+                                         'b,50.0,-118.0,0\n'
+                                         'a,49.0,-117.0,1\n'
+                                         'a,49.0,-117.02,5\n')
+
+    loaded = shapes.load_shapes(tmp_path, verbose=False)
+    line = loaded['a']
+    assert list(line.lons) == [-117.0, -117.01, -117.02]
+    assert line.distances[0] == 0
+    assert line.length == pytest.approx(line.point(0).distance_to(line.point(2)))
+    assert len(loaded['b']) == 1
+
+    distance, along = line.project(LatLon(49.001, -117.015))
+    assert distance == pytest.approx(111, abs=1)
+    assert along == pytest.approx(line.length * 0.75, rel=1e-3)
+
+    # Stops are projected in order along the shape
+    (_, first), (_, second) = line.project_stops([LatLon(49.0, -117.015), LatLon(49.0, -117.005)])
+    assert second == first
+
+
+def test_lat_lon_batch():
+    np = pytest.importorskip('numpy')
+    lat_lon_batch = pytest.importorskip('gtfs_loader.lat_lon_batch')
+
+    rng = random.Random(0)
+    xs, l1s, l2s = ([LatLon(rng.uniform(-60, 60), rng.uniform(-180, 180)) for _ in range(1000)] for _ in range(3))
+    x, l1, l2 = (lat_lon_batch.from_lat_lons(points) for points in (xs, l1s, l2s))
+
+    np.testing.assert_allclose(lat_lon_batch.distance(*x, *l1), [a.distance_to(b) for a, b in zip(xs, l1s)])
+    np.testing.assert_allclose(lat_lon_batch.bearing(*x, *l1), [a.bearing_to(b) for a, b in zip(xs, l1s)])
+    np.testing.assert_allclose(lat_lon_batch.distance_to_segment(*x, *l1, *l2),
+                               [a.distance_to_segment(b, c) for a, b, c in zip(xs, l1s, l2s)], atol=1e-6)
+
+    moved = [a.add_bearing_and_angular_distance(0.5, 0.01) for a in xs]
+    np.testing.assert_allclose(lat_lon_batch.add_bearing_and_angular_distance(*x, 0.5, 0.01),
+                               lat_lon_batch.from_lat_lons(moved))
+
+
+def test_time_strings():
+    for seconds in range(0, 36 * 3600 + 1, 7):
+        hours, rem = divmod(seconds, 3600)
+        time_str = '%02d:%02d:%02d' % (hours, rem // 60, rem % 60)
+        assert types.parse_time(time_str) == types.GTFSTime(time_str) == seconds
+        assert str(types.GTFSTime(seconds)) == types.serialize(types.GTFSTime(time_str)) == time_str
+
+    assert types.parse_time('7:05:00') == 7 * 3600 + 300
+    assert str(types.parse_time('7:05:00')) == '07:05:00'
+    assert str(types.parse_time('')) == ''
+    assert type(types.parse_time('01:00:00') + 60) is types.GTFSTime
+    assert str(types.parse_time('01:00:00') - 60) == '00:59:00'
+    with pytest.raises(ValueError):
+        types.parse_time('37:00:00')
+    with pytest.raises(ValueError):
+        types.parse_time('1:00')
+
+
+def test_date_strings():
+    day = date(2023, 12, 25)
+    while day < date(2025, 1, 5):
+        date_str = day.strftime('%Y%m%d')
+        assert types.parse_date(date_str) == types.GTFSDate(date_str) == types.GTFSDate(day.isoformat())
+        assert types.parse_date(date_str).date() == day
+        assert repr(types.parse_date(date_str)) == types.serialize(types.GTFSDate(date_str)) == date_str
+        day += timedelta(days=3)
+
+    for invalid in ['20240230', '20241301', '2024-13-01', '']:
+        with pytest.raises(ValueError):
+            types.parse_date(invalid)
+
+
+def fields_of(entity):
+    return {k: v for k, v in entity.items() if k != '_gtfs'}
+
+
+def entities_of(index, ignored=()):
+    return {key: [{name: value for name, value in fields_of(entity).items() if name not in ignored}
+                  for entity in (value if isinstance(value, list) else [value])]
+            for key, value in index.items()}
+
+
+def do_test(feed_dir, work_dir, **load_options):
+    itineraries = 'itineraries' in feed_dir.name
+
+    gtfs = gtfs_loader.load(work_dir, verbose=False, itineraries=itineraries, **load_options)
     gtfs_loader.patch(gtfs, work_dir, work_dir, verbose=False, itineraries=itineraries)
     test_support.check_expected_output(feed_dir, work_dir)